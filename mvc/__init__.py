@@ -1,6 +1,6 @@
 import os
 
-import multiprocessing
+from mvc import capabilities
 from mvc import converter
 from mvc import conversion
 from mvc import signals
@@ -13,6 +13,9 @@ class Application(signals.SignalEmitter):
     def __init__(self, simultaneous=None):
 	signals.SignalEmitter.__init__(self)
         if simultaneous is None:
+            # imported here, since it's slow to import and only needed to
+            # pick a default
+            import multiprocessing
             try:
                 simultaneous = multiprocessing.cpu_count()
             except NotImplementedError:
@@ -25,13 +28,26 @@ class Application(signals.SignalEmitter):
         if self.started:
             return
         self.converter_manager.startup()
+        # hide the converters that our ffmpeg can't run.  The capabilities
+        # are cached, so this only runs ffmpeg when it has changed.
+        caps = capabilities.get_capabilities()
+        if caps is not None:
+            self.converter_manager.check_capabilities(caps)
         self.started = True
 
     def start_conversion(self, filename, converter_id):
         self.startup()
         converter = self.converter_manager.get_by_id(converter_id)
-        v = video.VideoFile(filename)
+        v = video.get_video_file(filename)
         return self.conversion_manager.start_conversion(v, converter)
 
+    def queue_conversion(self, filename, converter_id):
+        """Like start_conversion(), but queue a compact Job, which doesn't
+        probe the file until it's started.
+        """
+        self.startup()
+        converter = self.converter_manager.get_by_id(converter_id)
+        return self.conversion_manager.queue_job(filename, converter)
+
     def run(self):
         raise NotImplementedError
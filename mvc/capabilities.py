@@ -0,0 +1,268 @@
+"""capabilities.py -- Find out what our ffmpeg binary can do.
+
+Builds of ffmpeg differ in which encoders, muxers, filters and hardware
+accelerations they include.  Capabilities records that for a binary, so that
+converters that need something missing can be hidden at startup, rather than
+failing with "Unknown encoder" partway through a conversion.
+
+Asking ffmpeg means running it several times, so the results are cached on
+disk, keyed by the path, size and modification time of the binary.
+"""
+
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+
+from mvc import execute
+from mvc import settings
+
+logger = logging.getLogger(__name__)
+
+# bump this when the format of the cache file changes
+CACHE_VERSION = 1
+
+class Capabilities(object):
+    """What an ffmpeg binary supports.
+
+    :attribute version: the version string, for example "1.2.1" or
+    "N-45279-g4f8d7c5"
+    :attribute encoders: set of encoder names
+    :attribute muxers: set of muxer (output format) names
+    :attribute filters: set of filter names
+    :attribute hwaccels: set of hardware acceleration method names
+
+    The sets are None if the binary couldn't tell us, for example because
+    it's too old to support the option.  Nothing is assumed to be missing
+    in that case.
+    """
+    FIELDS = ('encoders', 'muxers', 'filters', 'hwaccels')
+
+    def __init__(self, version=None, encoders=None, muxers=None,
+                 filters=None, hwaccels=None):
+        self.version = version
+        self.encoders = encoders
+        self.muxers = muxers
+        self.filters = filters
+        self.hwaccels = hwaccels
+
+    def __repr__(self):
+        return '<Capabilities %s>' % (self.version,)
+
+    def to_dict(self):
+        data = {'version': self.version}
+        for field in self.FIELDS:
+            values = getattr(self, field)
+            data[field] = sorted(values) if values is not None else None
+        return data
+
+    @classmethod
+    def from_dict(klass, data):
+        capabilities = klass(data.get('version'))
+        for field in klass.FIELDS:
+            values = data.get(field)
+            if values is not None:
+                setattr(capabilities, field, set(values))
+        return capabilities
+
+    def get_missing(self, requirements):
+        """Check what's missing to meet requirements.
+
+        :param requirements: dict mapping a field name ('encoders',
+        'muxers', 'filters' or 'hwaccels') to a list of names that are
+        needed
+        :returns: list of (field, name) tuples for the names that we don't
+        have
+        """
+        missing = []
+        for field in self.FIELDS:
+            available = getattr(self, field)
+            if available is None:
+                continue
+            for name in requirements.get(field, ()):
+                if name not in available:
+                    missing.append((field, name))
+        return missing
+
+def _run(executable, option):
+    commandline = [executable, option]
+    try:
+        p = execute.Popen(commandline, stderr=open(os.devnull, 'wb'))
+        stdout, _ = p.communicate()
+    except EnvironmentError:
+        logger.warn('error running %r', commandline, exc_info=True)
+        return None
+    if p.returncode != 0:
+        logger.info('%r returned %s', commandline, p.returncode)
+        return None
+    return stdout
+
+VERSION_RE = re.compile(r'^\S+ version (\S+)')
+
+def parse_version(output):
+    """Get the version string from the output of "ffmpeg -version"."""
+    line = output.split('\n', 1)[0]
+    match = VERSION_RE.match(line)
+    if match is not None:
+        return match.group(1)
+    return line.rsplit(' ', 1)[-1]
+
+SEPARATOR_RE = re.compile(r'^\s*-+\s*$')
+
+def _parse_table(output, line_re):
+    # ffmpeg prints a legend, then a line of dashes, then the table
+    if output is None:
+        return None
+    names = set()
+    in_table = False
+    for line in output.splitlines():
+        if not in_table:
+            in_table = SEPARATOR_RE.match(line) is not None
+            continue
+        match = line_re.match(line)
+        if match is not None:
+            names.update(match.group('name').split(','))
+    return names
+
+ENCODER_RE = re.compile(r'^\s*[A-Z.]{6}\s+(?P<name>\S+)')
+MUXER_RE = re.compile(r'^\s*[D ]E[d ]?\s+(?P<name>\S+)')
+FILTER_RE = re.compile(r'^\s*(?:[A-Z.|]{2,3}\s+)?(?P<name>\S+)\s+\S*->\S*\s')
+
+def parse_encoders(output):
+    """Get the set of encoder names from "ffmpeg -encoders"."""
+    return _parse_table(output, ENCODER_RE)
+
+def parse_muxers(output):
+    """Get the set of muxer names from "ffmpeg -muxers"."""
+    return _parse_table(output, MUXER_RE)
+
+def parse_filters(output):
+    """Get the set of filter names from "ffmpeg -filters".
+
+    The filter list doesn't have a line of dashes before the table, so
+    every line that looks like a filter counts.
+    """
+    if output is None:
+        return None
+    names = set()
+    for line in output.splitlines():
+        match = FILTER_RE.match(line)
+        if match is not None:
+            names.add(match.group('name'))
+    return names
+
+def parse_hwaccels(output):
+    """Get the set of hardware acceleration methods from
+    "ffmpeg -hwaccels".
+    """
+    if output is None:
+        return None
+    lines = [line.strip() for line in output.splitlines()]
+    return set(line for line in lines[1:] if line)
+
+def detect_capabilities(executable):
+    """Run ffmpeg to find out what it supports."""
+    logger.info('detecting the capabilities of %r', executable)
+    version_output = _run(executable, '-version')
+    return Capabilities(
+        version=(parse_version(version_output)
+                 if version_output is not None else None),
+        encoders=parse_encoders(_run(executable, '-encoders')),
+        muxers=parse_muxers(_run(executable, '-muxers')),
+        filters=parse_filters(_run(executable, '-filters')),
+        hwaccels=parse_hwaccels(_run(executable, '-hwaccels')))
+
+class CapabilityCache(object):
+    """Keep the Capabilities of ffmpeg binaries in a JSON file at path."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # executable path -> Capabilities, for this process
+        self.memo = {}
+
+    def _get_key(self, executable):
+        stat = os.stat(executable)
+        return {'mtime': stat.st_mtime, 'size': stat.st_size}
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (EnvironmentError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get('version') != CACHE_VERSION:
+            return {}
+        return data.get('executables', {})
+
+    def _save(self, executables):
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            temp = tempfile.NamedTemporaryFile(dir=directory, prefix='.',
+                                               delete=False)
+            with temp:
+                json.dump({'version': CACHE_VERSION,
+                           'executables': executables}, temp, indent=2,
+                          sort_keys=True, separators=(',', ': '))
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.unlink(self.path)
+            os.rename(temp.name, self.path)
+        except EnvironmentError:
+            logger.warn('cannot write %r', self.path, exc_info=True)
+
+    def get(self, executable):
+        """Get the Capabilities of executable, running it only if the cache
+        doesn't know about this build of it yet.
+        """
+        executable = os.path.realpath(executable)
+        with self.lock:
+            if executable in self.memo:
+                return self.memo[executable]
+            key = self._get_key(executable)
+            executables = self._load()
+            entry = executables.get(executable)
+            if (entry is not None and entry.get('key') == key and
+                entry['capabilities'].get('version') is not None):
+                capabilities = Capabilities.from_dict(entry['capabilities'])
+            else:
+                capabilities = detect_capabilities(executable)
+                if capabilities.version is None:
+                    # ffmpeg didn't run properly, maybe only this time.
+                    # Don't remember that, so that we ask again next time.
+                    return capabilities
+                executables[executable] = {
+                    'key': key,
+                    'capabilities': capabilities.to_dict(),
+                }
+                self._save(executables)
+            self.memo[executable] = capabilities
+            return capabilities
+
+_cache = None
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = CapabilityCache(os.path.join(settings.get_cache_directory(),
+                                              'ffmpeg-capabilities.json'))
+    return _cache
+
+def set_cache(cache):
+    global _cache
+    _cache = cache
+
+def get_capabilities(executable=None):
+    """Get the Capabilities of an ffmpeg binary.
+
+    :param executable: path to the binary, by default the one from
+    settings.get_ffmpeg_executable_path()
+    :returns: Capabilities, or None if there's no ffmpeg binary
+    """
+    if executable is None:
+        executable = settings.get_ffmpeg_executable_path()
+    if executable is None or not os.path.exists(executable):
+        return None
+    return get_cache().get(executable)
@@ -1,5 +1,7 @@
 import collections
 import errno
+import hashlib
+import itertools
 import os
 import time
 import tempfile
@@ -8,31 +10,110 @@ import shutil
 import logging
 
 from mvc import execute
-from mvc.utils import line_reader
-from mvc.video import get_thumbnail_synchronous
+from mvc import stats
+from mvc import supervisor
+from mvc.thumbnails import write_storyboard_index
+from mvc import utils
+from mvc.utils import line_reader, rescale_video, LineBuffer, IndexedQueue
+from mvc.video import (get_video_file, invalidate_video_file,
+                       prefetch_probes,
+                       get_cached_thumbnail_synchronous,
+                       get_cached_storyboard_synchronous,
+                       tile_storyboard_synchronous)
 from mvc.widgets import get_conversion_directory
 
 logger = logging.getLogger(__name__)
 
+class Job(object):
+    """Compact record of a conversion that's waiting or has ended.
+
+    Queueing a Job rather than a Conversion keeps large job lists cheap: the
+    file isn't probed until the job is nearly due to start, the Conversion
+    isn't created until it is started, and once it ends only its outcome is
+    kept.
+
+    While the job is running, conversion is its Conversion.  Otherwise it's
+    None.  video is a lazy VideoFile once the manager has started probing the
+    file ahead of time.
+    """
+    __slots__ = ('filename', 'converter', 'output_dir', 'status', 'error',
+                 'output', 'conversion', 'video')
+
+    def __init__(self, filename, converter, output_dir=None):
+        self.filename = filename
+        self.converter = converter
+        self.output_dir = output_dir
+        self.status = 'initialized'
+        self.error = None
+        self.output = None
+        self.conversion = None
+        self.video = None
+
+    def __repr__(self):
+        return '<Job (%s) %r: %s>' % (self.converter.name, self.filename,
+                                      self.status)
+
+    def make_conversion(self, manager):
+        """Create the Conversion to run this job.
+
+        :raises ValueError: if the file can't be parsed
+        """
+        video = self.video
+        if video is None:
+            video = get_video_file(self.filename)
+        elif not video.probed:
+            video.parse()
+        conversion = manager.get_conversion(video, self.converter,
+                                            output_dir=self.output_dir)
+        conversion.job = self
+        self.conversion = conversion
+        self.output = conversion.output
+        return conversion
+
+    def finish(self, conversion):
+        """Record the outcome of our conversion and drop it."""
+        self.status = conversion.status
+        self.error = conversion.error
+        self.output = conversion.output
+        self.conversion = None
+        self.video = None
+
+
 class Conversion(object):
     def __init__(self, video, converter, manager, output_dir=None):
         self.video = video
         self.manager = manager
+        # the Job that we were created for, if any
+        self.job = None
         if output_dir is None:
             output_dir = get_conversion_directory()
         self.output_dir = output_dir
-        self.lines = []
+        self.lines = LineBuffer()
         self.thread = None
         self.popen = None
+        self.stderr = None
         self.status = 'initialized'
         self.temp_output = None
         self.error = None
         self.started_at = None
+        self.last_progress_at = None
+        self.retries = 0
+        self.timed_out = False
         self.duration = None
         self.progress = None
         self.progress_percent = None
         self.create_thumbnail = False
+        self.thumbnail_output = None
+        self.create_storyboard = False
+        self.storyboard_output = None
         self.eta = None
+        # size of the output file, once we've finished
+        self.output_size = None
+        # directory to write temporary files to, if not the output
+        # directory, and the space we expect to need; see
+        # ConversionManager.get_scratch_dir() and get_space_needs()
+        self.scratch_dir = None
+        self.space_needs = []
         self.listeners = set()
         self.set_converter(converter)
         logger.info('created %r', self)
@@ -67,24 +148,84 @@ class Conversion(object):
     def run(self):
         logger.info('starting %r', self)
         try:
-            self.temp_output = tempfile.mktemp(
-                dir=os.path.dirname(self.output))
+            self.lines = LineBuffer(spill_path=self.get_log_path())
+            temp_dir = self.get_temp_dir()
+            if not os.path.exists(temp_dir):
+                os.makedirs(temp_dir)
+            self.temp_output = tempfile.mktemp(dir=temp_dir)
+            if (self.create_thumbnail and self.manager.inline_thumbnails and
+                self.converter.can_create_thumbnail(self.video)):
+                self.thumbnail_output = tempfile.mktemp(
+                    suffix='.png', dir=temp_dir)
+            if (self.create_storyboard and self.manager.inline_thumbnails and
+                self.converter.can_create_thumbnail(self.video) and
+                self.video.duration):
+                self.storyboard_output = tempfile.mkdtemp(dir=temp_dir)
         except EnvironmentError,e :
             logger.exception('while creating temp file for %r',
                              self.output)
             self.error = str(e)
             self.finalize()
             return
-        logger.info('commandline: %r', ' '.join(
-                self.get_subprocess_arguments(self.temp_output)))
+        try:
+            commandline = self.get_subprocess_arguments(self.temp_output)
+        except ValueError, e:
+            # for example, we couldn't find out the ffmpeg version
+            logger.exception('while getting the commandline for %r',
+                             self.output)
+            self.error = str(e)
+            self.finalize()
+            return
+        logger.info('commandline: %r', ' '.join(commandline))
+        if self.manager.supervisor is not None:
+            self._start_supervised()
+            return
         self.thread = threading.Thread(target=self._thread,
                                        name="Thread:%s" % (self,))
         self.thread.setDaemon(True)
         self.thread.start()
 
-    def stop(self):
+    def get_temp_dir(self):
+        """Get the directory that we write the output to while converting.
+        """
+        if self.scratch_dir is not None:
+            return self.scratch_dir
+        return os.path.dirname(self.output)
+
+    def get_log_path(self):
+        """Get the path to write the complete ffmpeg output to.
+
+        Returns None if the manager doesn't have a log_dir set, in which case
+        only the start and end of the output is kept in memory.
+
+        This method will create the log directory if it doesn't exist
+        """
+        if self.manager.log_dir is None:
+            return None
+        if not os.path.exists(self.manager.log_dir):
+            os.makedirs(self.manager.log_dir)
+        # outputs in different directories can have the same name, so add
+        # a hash of the full path
+        output_basename = os.path.basename(self.output)
+        output_path = os.path.abspath(self.output)
+        if isinstance(output_path, unicode):
+            output_path = output_path.encode('utf-8')
+        output_hash = hashlib.sha1(output_path).hexdigest()[:8]
+        return os.path.join(self.manager.log_dir, '%s.%s.log.gz' % (
+            output_basename, output_hash))
+
+    def stop(self, reason=None):
+        """Stop the conversion.
+
+        :param reason: if given, the conversion was stopped because something
+        went wrong (for example it stalled).  It will end up 'failed' with
+        reason as its error, rather than 'canceled'.
+        """
         logger.info('stopping %r', self)
-        self.error = 'manually stopped'
+        if reason is None:
+            self.error = 'manually stopped'
+        else:
+            self.error = reason
         if self.popen is None:
             status = 'canceled'
             try:
@@ -101,37 +242,153 @@ class Conversion(object):
                 # set the status transition last, if we had hit an exception
                 # then we will transition the next state to 'failed' in
                 # finalize()
-                self.status = 'canceled'
+                if reason is None:
+                    self.status = 'canceled'
             except EnvironmentError, e:
                 logger.exception('while stopping %s' % (self,))
                 self.error = str(e)
         self.popen = None
-        self.manager.conversion_finished(self)
+        self.lines.close()
+        if reason is None:
+            self.manager.conversion_finished(self)
+        # otherwise, finalize() will mark us as failed and the manager will
+        # free our slot once it sees that.
+
+    def reset(self):
+        """Reset a finished conversion, so that it can be run again."""
+        self.lines.close()
+        self.status = 'initialized'
+        self.thread = None
+        self.popen = None
+        self.temp_output = None
+        self.thumbnail_output = None
+        self.storyboard_output = None
+        self.error = None
+        self.timed_out = False
+        self.started_at = None
+        self.last_progress_at = None
+        self.duration = None
+        self.progress = None
+        self.progress_percent = None
+        self.eta = None
+
+    def check_stalled(self, now):
+        """Check if the conversion has stopped making progress.
+
+        :returns: a string describing the problem if the conversion
+        should be stopped, otherwise None
+        """
+        if (self.status != 'converting' or self.started_at is None or
+            self.timed_out or self.popen is None):
+            # not running, or already being stopped
+            return None
+        stall_timeout = self.manager.stall_timeout
+        if (stall_timeout is not None and
+            now - self.last_progress_at > stall_timeout):
+            return 'stalled: no progress for %.1f seconds' % (
+                now - self.last_progress_at)
+        budget = self.manager.get_time_budget(self)
+        if budget is not None and now - self.started_at > budget:
+            return 'timed out after %.1f seconds' % (now - self.started_at)
+        return None
 
     def _thread(self):
         try:
-            commandline = self.get_subprocess_arguments(self.temp_output)
-            self.popen = execute.Popen(commandline, bufsize=1)
-            self.process_output()
-            if self.popen:
-                # if we stop the thread, we can get here after `.stop()`
-                # finishes.
-                self.popen.wait()
-        except OSError, e:
-            if e.errno == errno.ENOENT:
-                self.error = '%r does not exist' % (
-                    self.converter.get_executable(),)
+            self.start_process()
+            if self.stderr is not None:
+                self.process_progress_output()
             else:
-                logger.exception('OSError in %s' % (self.thread.name,))
-                self.error = str(e)
+                self.process_output()
+            self.wait_for_process()
+        except Exception, e:
+            self.handle_process_error(e)
+        self.finish()
+
+    def _start_supervised(self):
+        """Start the conversion and have the manager's supervisor read its
+        output, rather than blocking a thread on it.
+        """
+        try:
+            self.start_process()
+        except Exception, e:
+            self.handle_process_error(e)
+            self.manager.supervisor.finisher.add_task(self.finish)
+            return
+        self.start_processing_output()
+        self.manager.supervisor.watch(self.popen.stdout,
+                                      self.handle_output_line,
+                                      self._finish_supervised)
+
+    def _finish_supervised(self):
+        try:
+            self.wait_for_process()
         except Exception, e:
-            logger.exception('in %s' % (self.thread.name,))
+            self.handle_process_error(e)
+        self.finish()
+
+    def start_process(self):
+        commandline = self.get_subprocess_arguments(self.temp_output)
+        if self.converter.uses_progress_pipe():
+            # progress comes in on stdout; keep stderr in a temporary file
+            # so that a chatty ffmpeg can't fill up the pipe and block while
+            # we're only reading stdout.
+            self.stderr = tempfile.TemporaryFile()
+            self.popen = execute.Popen(commandline, bufsize=1,
+                                       stderr=self.stderr)
+        else:
+            self.popen = execute.Popen(commandline, bufsize=1)
+
+    def wait_for_process(self):
+        if self.popen:
+            # if we stop the conversion, we can get here after `.stop()`
+            # finishes.
+            self.popen.wait()
+        if self.stderr is not None:
+            self.process_error_output(self.stderr)
+
+    def handle_process_error(self, e):
+        if isinstance(e, OSError) and e.errno == errno.ENOENT:
+            self.error = '%r does not exist' % (
+                self.converter.get_executable(),)
+        else:
+            logger.exception('while running %s' % (self,))
             self.error = str(e)
 
-        if self.create_thumbnail:
+    def finish(self):
+        if self.stderr is not None:
+            self.stderr.close()
+            self.stderr = None
+        if self.thumbnail_output is not None:
+            self.move_thumbnail_file()
+        elif self.create_thumbnail:
             self.write_thumbnail_file()
+        if self.storyboard_output is not None:
+            self.tile_storyboard_file()
+        elif self.create_storyboard:
+            self.write_storyboard_file()
         self.finalize()
 
+    def move_thumbnail_file(self):
+        """Move the thumbnail that the converter wrote along with the
+        conversion into place.
+        """
+        try:
+            if self.error is None and os.path.exists(self.thumbnail_output):
+                thumbnail_path = self._get_thumbnail_path()
+                logging.info("moving thumbnail: %s", thumbnail_path)
+                shutil.move(self.thumbnail_output, thumbnail_path)
+            elif self.error is None:
+                logging.warning("converter didn't write a thumbnail for %s",
+                                self.video.filename)
+                self.write_thumbnail_file()
+        except EnvironmentError:
+            logging.warn("Error moving thumbnail", exc_info=True)
+        if os.path.exists(self.thumbnail_output):
+            try:
+                os.unlink(self.thumbnail_output)
+            except EnvironmentError:
+                pass
+
     def write_thumbnail_file(self):
         try:
             self._write_thumbnail_file()
@@ -143,21 +400,100 @@ class Conversion(object):
             logging.warning("write_thumbnail_file: audio_only=True "
                     "not writing thumbnail %s", self.video.filename)
             return
-        output_basename = os.path.splitext(os.path.basename(self.output))[0]
-        logging.info("td: %s ob: %s", self._get_thumbnail_dir(),
-                output_basename)
-        thumbnail_path = os.path.join(self._get_thumbnail_dir(),
-                output_basename + '.png')
+        thumbnail_path = self._get_thumbnail_path()
         logging.info("creating thumbnail: %s", thumbnail_path)
-        width, height = self.converter.get_target_size(self.video)
-        get_thumbnail_synchronous(self.video.filename, width, height,
-                thumbnail_path)
+        width, height, skip = self.get_thumbnail_spec()
+        cached_path = get_cached_thumbnail_synchronous(
+            self.video.filename, width, height, skip)
+        if cached_path is not None:
+            shutil.copyfile(cached_path, thumbnail_path)
         if os.path.exists(thumbnail_path):
             logging.info("thumbnail successful: %s", thumbnail_path)
         else:
-            logging.warning("get_thumbnail_synchronous() succeeded, but the "
+            logging.warning("get_cached_thumbnail_synchronous() succeeded, but the "
                     "thumbnail file is missing!")
 
+    def tile_storyboard_file(self):
+        """Tile the storyboard frames that the converter wrote along with
+        the conversion, and write the storyboard index.
+        """
+        try:
+            if self.error is None and os.listdir(self.storyboard_output):
+                image_path, index_path = self._get_storyboard_paths()
+                logging.info("creating storyboard: %s", image_path)
+                width, height, count, columns = self.get_storyboard_spec()
+                if tile_storyboard_synchronous(self._get_storyboard_pattern(),
+                                               image_path, count, columns):
+                    write_storyboard_index(index_path, self.video.duration,
+                                           width, height, count, columns)
+            elif self.error is None:
+                logging.warning("converter didn't write a storyboard for %s",
+                                self.video.filename)
+                self.write_storyboard_file()
+        except EnvironmentError:
+            logging.warn("Error creating storyboard", exc_info=True)
+        shutil.rmtree(self.storyboard_output, ignore_errors=True)
+
+    def write_storyboard_file(self):
+        try:
+            self._write_storyboard_file()
+        except StandardError:
+            logging.warn("Error writing storyboard", exc_info=True)
+
+    def _write_storyboard_file(self):
+        if self.video.audio_only or not self.video.duration:
+            logging.warning("write_storyboard_file: not writing storyboard "
+                            "for %s", self.video.filename)
+            return
+        width, height, count, columns = self.get_storyboard_spec()
+        cached_paths = get_cached_storyboard_synchronous(
+            self.video.filename, self.video.duration, width, height, count,
+            columns)
+        if cached_paths is None:
+            logging.warning("couldn't create storyboard for %s",
+                            self.video.filename)
+            return
+        for cached_path, path in zip(cached_paths,
+                                     self._get_storyboard_paths()):
+            shutil.copyfile(cached_path, path)
+
+    def get_storyboard_spec(self):
+        """Get the (width, height, count, columns) of the storyboard that
+        we write when create_storyboard is set.
+
+        width and height are the size of each frame in the storyboard.
+        """
+        max_width, max_height = self.manager.storyboard_size
+        width, height = rescale_video((self.video.width, self.video.height),
+                                      (max_width, max_height),
+                                      dont_upsize=False)
+        return (width, height, self.manager.storyboard_frames,
+                self.manager.storyboard_columns)
+
+    def _get_storyboard_paths(self):
+        """Get the paths of the storyboard image and its index."""
+        output_basename = os.path.splitext(os.path.basename(self.output))[0]
+        base_path = os.path.join(self._get_thumbnail_dir(),
+                                 output_basename + '.storyboard')
+        return (base_path + '.jpg', base_path + '.json')
+
+    def _get_storyboard_pattern(self):
+        return os.path.join(self.storyboard_output, '%03d.jpg')
+
+    def get_thumbnail_spec(self):
+        """Get the (width, height, skip) of the thumbnail that we write when
+        create_thumbnail is set.
+        """
+        width, height = self.converter.get_target_size(self.video)
+        return (width, height, 0)
+
+    def _get_thumbnail_path(self):
+        output_basename = os.path.splitext(os.path.basename(self.output))[0]
+        logging.info("td: %s ob: %s", self._get_thumbnail_dir(),
+                output_basename)
+        return os.path.join(self._get_thumbnail_dir(),
+                output_basename + '.png')
+
     def _get_thumbnail_dir(self):
         """Get the directory to store thumbnails in it.
 
@@ -171,62 +507,117 @@ class Conversion(object):
     def calc_progress_percent(self):
         if not self.duration:
             return 0.0
+        return self.progress / self.duration
 
-        if self.create_thumbnail:
-            # assume that thumbnail creation takes as long as 2 seconds of
-            # video processing
-            effective_duration = self.duration + 2.0
-        else:
-            effective_duration = self.duration
-        return self.progress / effective_duration
+    def start_processing_output(self):
+        self.started_at = self.last_progress_at = time.time()
+        self.status = 'converting'
+        if self.stderr is not None and self.video.duration:
+            # the progress output doesn't include the duration, so we get it
+            # from the video.
+            self.process_status({'duration': self.video.duration})
 
     def process_output(self):
-        self.started_at = time.time()
-        self.status = 'converting'
+        self.start_processing_output()
         # We use line_reader, rather than just iterating over the file object,
         # because iterating over the file object gives us all the lines when
         # the process ends, and we're looking for real-time updates.
         for line in line_reader(self.popen.stdout):
+            if self.handle_output_line(line):
+                break
+
+    def process_progress_output(self):
+        """Read machine-readable progress from the converter's stdout.
+
+        This is used when the converter uses_progress_pipe().
+        """
+        self.start_processing_output()
+        # readline() returns as soon as a line is available, unlike
+        # iterating over the file object
+        for line in iter(self.popen.stdout.readline, ''):
+            if self.handle_output_line(line.rstrip()):
+                break
+
+    def handle_output_line(self, line):
+        """Handle a line of output from the converter's stdout.
+
+        :returns: True if the conversion is finished
+        """
+        if self.stderr is not None:
+            parse = self.converter.process_progress_line
+        else:
             self.lines.append(line) # for debugging, if needed
+            parse = self.converter.process_status_line
+        try:
+            status = parse(self.video, line)
+        except StandardError:
+            logging.warn("error in %s()", parse.__name__, exc_info=True)
+            return False
+        return self.process_status(status)
+
+    def process_error_output(self, stderr):
+        """Look for errors in the stderr output of a progress pipe
+        conversion.
+        """
+        stderr.seek(0)
+        for line in line_reader(stderr):
+            self.lines.append(line)
+            if self.error is not None:
+                continue
             try:
                 status = self.converter.process_status_line(self.video, line)
             except StandardError:
                 logging.warn("error in process_status_line()", exc_info=True)
                 continue
-            if status is None:
-                continue
-            updated = set()
-            if 'finished' in status:
-                self.error = status.get('error', None)
-                break
-            if 'duration' in status:
-                updated.update(('duration', 'progress'))
-                self.duration = float(status['duration'])
-                if self.progress is None:
-                    self.progress = 0.0
-            if 'progress' in status:
-                updated.add('progress')
-                self.progress = min(float(status['progress']),
-                                    self.duration)
-            if 'eta' in status:
-                updated.add('eta')
-                self.eta = float(status['eta'])
-
-            if updated:
-                self.progress_percent = self.calc_progress_percent()
-                if 'eta' not in updated:
-                    if self.duration and 0 < self.progress_percent < 1.0:
-                        progress = self.progress_percent * 100
-                        elapsed = time.time() - self.started_at
-                        time_per_percent = elapsed / progress
-                        self.eta = float(
-                            time_per_percent * (100 - progress))
-                    else:
-                        self.eta = 0.0
-
-                self.notify_listeners()
+            if status is not None and status.get('error'):
+                self.error = status['error']
+        if (self.error is None and self.popen is not None and
+            self.popen.returncode):
+            self.error = '%s exited with code %s' % (
+                self.converter.get_executable(), self.popen.returncode)
+
+    def process_status(self, status):
+        """Handle a status dict from the converter.
+
+        :returns: True if the status says the conversion is finished
+        """
+        if status is None:
+            return False
+        updated = set()
+        if 'finished' in status:
+            self.error = status.get('error', None)
+            return True
+        if 'duration' in status:
+            updated.update(('duration', 'progress'))
+            self.duration = float(status['duration'])
+            if self.progress is None:
+                self.progress = 0.0
+        if 'progress' in status:
+            updated.add('progress')
+            self.progress = min(float(status['progress']),
+                                self.duration)
+        if 'eta' in status:
+            updated.add('eta')
+            self.eta = float(status['eta'])
+
+        if updated:
+            self.last_progress_at = time.time()
+            self.progress_percent = self.calc_progress_percent()
+            if 'eta' not in updated:
+                if self.duration and 0 < self.progress_percent < 1.0:
+                    progress = self.progress_percent * 100
+                    elapsed = time.time() - self.started_at
+                    time_per_percent = elapsed / progress
+                    self.eta = float(
+                        time_per_percent * (100 - progress))
+                else:
+                    self.eta = 0.0
+
+            self.notify_listeners()
+        return False
 
     def finalize(self):
+        self.lines.close()
         self.progress = self.duration
         self.progress_percent = 1.0
         self.eta = 0
@@ -242,6 +633,15 @@ class Conversion(object):
                 self.status = 'failed'
             else:
                 self.status = 'finished'
+                # the output may replace a file that we've already probed
+                invalidate_video_file(self.output)
+                try:
+                    self.output_size = os.path.getsize(self.output)
+                except EnvironmentError:
+                    pass
+                else:
+                    self.converter.record_output_size(self.video,
+                                                      self.output_size)
         else:
             if self.temp_output is not None:
                 try:
@@ -256,60 +656,426 @@ class Conversion(object):
         logger.info('finished %r; status: %s', self, self.status)
 
     def get_subprocess_arguments(self, output):
-        return ([self.converter.get_executable()] +
+        args = ([self.converter.get_executable()] +
+                list(self.converter.get_progress_arguments()) +
                 list(self.converter.get_arguments(self.video, output)))
+        if self.thumbnail_output is not None:
+            width, height, skip = self.get_thumbnail_spec()
+            args.extend(self.converter.get_thumbnail_arguments(
+                self.video, self.thumbnail_output, width, height, skip))
+        if self.storyboard_output is not None:
+            width, height, count, columns = self.get_storyboard_spec()
+            args.extend(self.converter.get_storyboard_arguments(
+                self.video, self._get_storyboard_pattern(), width, height,
+                count))
+        return args
 
 
 class ConversionManager(object):
-    def __init__(self, simultaneous=None):
+    def __init__(self, simultaneous=None, use_supervisor=None):
         self.notify_queue = set()
         self.in_progress = set()
-        self.waiting = collections.deque()
+        self.waiting = IndexedQueue()
         self.simultaneous = simultaneous
         self.running = False
         self.create_thumbnails = False
+        # if the converter supports it, write thumbnails as part of the
+        # conversion, rather than decoding the video again afterwards.
+        self.inline_thumbnails = True
+        # storyboards are a grid of storyboard_frames frames taken evenly
+        # through the video, with storyboard_columns frames in each row.
+        # Each frame fits in storyboard_size.
+        self.create_storyboards = False
+        self.storyboard_size = (160, 120)
+        self.storyboard_frames = 16
+        self.storyboard_columns = 4
+        self.log_dir = None
+        # watchdog settings: stop conversions that haven't made progress for
+        # stall_timeout seconds, or that have run for longer than
+        # time_budget_factor times their duration plus time_budget_minimum
+        # seconds.  None disables the check.
+        self.stall_timeout = None
+        self.time_budget_factor = None
+        self.time_budget_minimum = 60.0
+        # number of times to retry conversions stopped by the watchdog, and
+        # the delay before the first retry (doubled after each one)
+        self.max_retries = 0
+        self.retry_backoff = 5.0
+        self.retry_queue = []
+        # the most recent Jobs that have ended, and functions to call when a
+        # job changes.  A long headless run can end a lot of jobs, so older
+        # ones are dropped rather than kept for the life of the manager.
+        self.finished_jobs = collections.deque(maxlen=1000)
+        self.job_listeners = set()
+        # functions to call once per check_notifications() with all the
+        # conversions that changed
+        self.batch_listeners = set()
+        # running totals over everything we've been given to convert
+        self.stats = stats.ConversionStats()
+        # number of waiting jobs to probe in the background while
+        # conversions run, so that they can start straight away.  Jobs
+        # being probed are kept in probing_jobs until the stats have their
+        # durations.
+        self.probe_ahead = 2
+        self.probing_jobs = set()
+        # hold back waiting conversions until their estimated output fits
+        # on the output filesystem, along with what the running ones still
+        # need, leaving disk_space_margin bytes free
+        self.check_disk_space = True
+        self.disk_space_margin = 64 * 1024 * 1024
+        # directory on fast local storage to write outputs to while they're
+        # being converted, for when the output directory is slow (for
+        # example on a network share).  Only the finished output is copied
+        # over.  None writes them next to the outputs.
+        self.scratch_dir = None
+        if use_supervisor is None:
+            use_supervisor = supervisor.is_supported()
+        if use_supervisor:
+            self.supervisor = supervisor.Supervisor()
+        else:
+            self.supervisor = None
+
+    def shutdown(self):
+        """Free the resources that the manager holds: the supervisor's
+        thread and pipes.  Call this once conversions have ended and the
+        manager won't be used again.
+        """
+        if self.supervisor is not None:
+            self.supervisor.close()
+            self.supervisor = None
 
     def get_conversion(self, video, converter, **kwargs):
         return Conversion(video, converter, self, **kwargs)
 
     def remove(self, conversion):
         self.waiting.remove(conversion)
+        self.probing_jobs.discard(conversion)
+        self.stats.remove(conversion)
+
+    def remove_many(self, conversions):
+        """Remove several conversions from the waiting queue at once.
+
+        Conversions that aren't waiting are ignored.
+
+        :returns: list of the conversions that were removed
+        """
+        removed = self.waiting.remove_many(conversions)
+        for conversion in removed:
+            self.probing_jobs.discard(conversion)
+            self.stats.remove(conversion)
+        return removed
+
+    def forget(self, conversion):
+        """Stop counting a conversion in the stats, whatever its state.
+
+        Call this when a conversion that has ended is cleared away, so that
+        the stats don't hold on to it.
+        """
+        self.probing_jobs.discard(conversion)
+        self.stats.remove(conversion)
 
     def start_conversion(self, video, converter):
         return self.run_conversion(self.get_conversion(video, converter))
 
+    def queue_job(self, filename, converter, output_dir=None):
+        """Queue a conversion of filename, without creating a Conversion
+        for it until it's started.
+
+        Use listen_jobs() to keep track of the Job.
+        """
+        return self.run_conversion(Job(filename, converter, output_dir))
+
+    def listen_jobs(self, f):
+        """Call f with a Job whenever a job's conversion changes, or the
+        job fails to start.
+        """
+        self.job_listeners.add(f)
+
+    def unlisten_jobs(self, f):
+        self.job_listeners.remove(f)
+
+    def listen_batch(self, f):
+        """Call f with a list of the conversions that changed, once each
+        time check_notifications() finds some.
+
+        This is cheaper than listening to each conversion when there are a
+        lot of them, for example to update totals once rather than once per
+        conversion.
+        """
+        self.batch_listeners.add(f)
+
+    def unlisten_batch(self, f):
+        self.batch_listeners.remove(f)
+
     def run_conversion(self, conversion):
-        if (self.simultaneous is not None and
-            len(self.in_progress) >= self.simultaneous):
-            self.waiting.append(conversion)
-        else:
-            self._start_conversion(conversion)
-            self.running = True
+        self.stats.update(conversion)
+        self.waiting.append(conversion)
+        self.running = True
+        self._start_waiting()
+        self._probe_waiting_jobs()
         return conversion
 
-    def _start_conversion(self, conversion):
+    def _has_free_slot(self):
+        return (self.simultaneous is None or
+                len(self.in_progress) < self.simultaneous)
+
+    def _start_waiting(self):
+        while self.waiting and self._has_free_slot():
+            conversion = next(iter(self.waiting))
+            # get_scratch_dir() only picks the scratch directory if there's
+            # room for the conversion with it
+            scratch_dir = self.get_scratch_dir(conversion)
+            if scratch_dir is None and not self.has_space_for(conversion):
+                if self.in_progress:
+                    # wait for a running conversion to end and free up the
+                    # space it's holding
+                    logger.info('not enough disk space to start %r yet',
+                                conversion)
+                    break
+                # nothing will free up space, so there's no point waiting
+                self.waiting.popleft()
+                self._fail_waiting(conversion, 'not enough disk space')
+                continue
+            self.waiting.popleft()
+            self._start_conversion(conversion, scratch_dir)
+
+    def _get_output_dir(self, conversion):
+        if isinstance(conversion, Job):
+            return conversion.output_dir or get_conversion_directory()
+        return os.path.dirname(conversion.output)
+
+    def get_scratch_dir(self, conversion):
+        """Pick the directory for a conversion's temporary files.
+
+        Returns scratch_dir if it's set and there's room there, otherwise
+        None to write them next to the output.
+        """
+        if self.scratch_dir is None:
+            return None
+        # get_space_reserved() compares it with the directory of the temp
+        # output, so it mustn't be relative or have a trailing slash
+        scratch_dir = os.path.abspath(self.scratch_dir)
+        if not self.has_space_for(conversion, scratch_dir):
+            logger.info('not enough space in %r for %r; using the output '
+                        'directory', scratch_dir, conversion)
+            return None
+        return scratch_dir
+
+    def get_space_needs(self, conversion, scratch_dir=None):
+        """Estimate the disk space that a Conversion or Job needs.
+
+        :param scratch_dir: directory that the conversion writes its
+        temporary files to, if it's not the output directory
+        :returns: list of (directory, bytes) tuples, one for each
+        filesystem that the conversion writes to.  The list is empty if we
+        can't tell, for example because the file can't be parsed.
+        """
+        if isinstance(conversion, Job):
+            if conversion.video is None:
+                conversion.video = get_video_file(conversion.filename,
+                                                  lazy=True)
+                self.probing_jobs.add(conversion)
+        converter = conversion.converter
+        try:
+            needed = converter.get_space_needed(conversion.video)
+            if not needed:
+                return []
+            output_dir = self._get_output_dir(conversion)
+            if (scratch_dir is None or utils.get_device(scratch_dir) ==
+                utils.get_device(output_dir)):
+                return [(output_dir, needed)]
+            # the output is made in scratch_dir, then copied to output_dir
+            size = converter.get_output_size_guess(conversion.video)
+            return [(scratch_dir, size), (output_dir, size)]
+        except ValueError:
+            # the lazy video couldn't be parsed; starting the job will
+            # report that.
+            return []
+
+    def get_space_reserved(self, device):
+        """Get the bytes that running conversions still need on the
+        filesystem with the id device (see utils.get_device()).
+        """
+        reserved = 0
+        for conversion in self.in_progress:
+            for directory, needed in conversion.space_needs:
+                if utils.get_device(directory) != device:
+                    continue
+                written = 0
+                if (conversion.temp_output is not None and
+                    os.path.abspath(os.path.dirname(conversion.temp_output))
+                    == os.path.abspath(directory)):
+                    try:
+                        written = os.path.getsize(conversion.temp_output)
+                    except EnvironmentError:
+                        pass
+                reserved += max(needed - written, 0)
+        return reserved
+
+    def has_space_for(self, conversion, scratch_dir=None):
+        """Check if there's room for a waiting Conversion or Job on the
+        filesystems it writes to, along with the running conversions.
+        """
+        if not self.check_disk_space:
+            return True
+        for directory, needed in self.get_space_needs(conversion,
+                                                      scratch_dir):
+            free = utils.get_free_space(directory)
+            if free is None:
+                continue
+            reserved = self.get_space_reserved(utils.get_device(directory))
+            if needed + reserved + self.disk_space_margin > free:
+                return False
+        return True
+
+    def _fail_waiting(self, conversion, error):
+        logger.warn('%r: %s', conversion, error)
+        if isinstance(conversion, Job):
+            self._job_failed(conversion, error)
+        else:
+            conversion.error = error
+            conversion.finalize()
+
+    def _job_failed(self, job, error):
+        job.status = 'failed'
+        job.error = error
+        self.probing_jobs.discard(job)
+        self.stats.update(job)
+        self._job_changed(job)
+        self.finished_jobs.append(job)
+
+    def _start_conversion(self, conversion, scratch_dir=None):
+        if isinstance(conversion, Job):
+            job = conversion
+            try:
+                conversion = job.make_conversion(self)
+            except ValueError, e:
+                logger.warn('could not parse %r: %s', job.filename, e)
+                self._job_failed(job, 'could not parse %r' % (job.filename,))
+                return
+            # the file has been probed now, so the stats can count it
+            self.stats.update(conversion)
+            self._job_changed(job)
+        conversion.scratch_dir = scratch_dir
+        if self.check_disk_space:
+            conversion.space_needs = self.get_space_needs(conversion,
+                                                          scratch_dir)
         self.in_progress.add(conversion)
         conversion.create_thumbnail = self.create_thumbnails
+        conversion.create_storyboard = self.create_storyboards
         conversion.run()
+        self._probe_waiting_jobs()
+
+    def _probe_waiting_jobs(self):
+        to_probe = []
+        for job in itertools.islice(self.waiting, self.probe_ahead):
+            if isinstance(job, Job) and job.video is None:
+                job.video = get_video_file(job.filename, lazy=True)
+                to_probe.append(job.video)
+                self.probing_jobs.add(job)
+        if to_probe:
+            prefetch_probes(to_probe)
+
+    def _update_probed_jobs(self):
+        # count the durations of waiting jobs that have been probed since
+        # the last time
+        for job in list(self.probing_jobs):
+            if job.conversion is not None:
+                # the Conversion keeps the stats up to date now
+                self.probing_jobs.discard(job)
+            elif job.video.probed:
+                self.probing_jobs.discard(job)
+                self.stats.update(job)
+
+    def get_time_budget(self, conversion):
+        """Get the number of seconds a conversion is allowed to run for.
+
+        Returns None if there's no limit.
+        """
+        if self.time_budget_factor is None or not conversion.duration:
+            return None
+        return (self.time_budget_factor * conversion.duration +
+                self.time_budget_minimum)
+
+    def check_stalled(self):
+        """Stop any conversions that are stalled or have run for too long.
+
+        Their slots get freed up for waiting conversions.  If max_retries is
+        set, they are run again later; see check_notifications().
+        """
+        now = time.time()
+        for conversion in list(self.in_progress):
+            if conversion.timed_out:
+                # already stopped; finalize() will mark it as failed
+                continue
+            reason = conversion.check_stalled(now)
+            if reason is not None:
+                logger.warn('%s: %s', conversion, reason)
+                conversion.timed_out = True
+                conversion.stop(reason)
+
+    def _schedule_retry(self, conversion):
+        delay = self.retry_backoff * (2 ** conversion.retries)
+        logger.info('retrying %s in %i seconds', conversion, delay)
+        conversion.retries += 1
+        self.retry_queue.append((time.time() + delay, conversion))
+
+    def _run_retries(self):
+        now = time.time()
+        due = [c for (retry_at, c) in self.retry_queue if retry_at <= now]
+        self.retry_queue = [(retry_at, c)
+                            for (retry_at, c) in self.retry_queue
+                            if retry_at > now]
+        for conversion in due:
+            conversion.reset()
+            conversion.notify_listeners()
+            self.run_conversion(conversion)
 
     def check_notifications(self):
         if not self.running:
             # don't bother checking if we're not running
             return
 
+        self.check_stalled()
+        if self.retry_queue:
+            self._run_retries()
+        if self.probing_jobs:
+            self._update_probed_jobs()
+
         self.notify_queue, changed = set(), self.notify_queue
 
         for conversion in changed:
+            ended = conversion.status in ('canceled', 'finished', 'failed')
+            if (conversion.status == 'failed' and conversion.timed_out and
+                conversion.retries < self.max_retries):
+                conversion.timed_out = False
+                self._schedule_retry(conversion)
+                ended = False
+            self.stats.update(conversion)
             if conversion.status in ('canceled', 'finished', 'failed'):
                 self.conversion_finished(conversion)
             for listener in conversion.listeners:
                 listener(conversion)
+            job = conversion.job
+            if job is not None:
+                job.status = conversion.status
+                self._job_changed(job)
+                if ended:
+                    job.finish(conversion)
+                    self.finished_jobs.append(job)
+        if changed:
+            changed = list(changed)
+            for listener in self.batch_listeners:
+                listener(changed)
+        if not self.in_progress and not self.waiting and not self.retry_queue:
+            self.running = False
+
+    def _job_changed(self, job):
+        for listener in self.job_listeners:
+            listener(job)
 
     def conversion_finished(self, conversion):
         self.in_progress.discard(conversion)
-        while (self.waiting and self.simultaneous is not None and
-               len(self.in_progress) < self.simultaneous):
-            c = self.waiting.popleft()
-            self._start_conversion(c)
-        if not self.in_progress:
+        self._start_waiting()
+        if not self.in_progress and not self.retry_queue:
             self.running = False
@@ -1,19 +1,135 @@
+import collections
+import hashlib
 import json
 import logging
+import operator
 import os
 import re
-import shutil
+import sys
+import tempfile
 
-from mvc import resources, settings, utils
+from mvc import resources, settings, thumbnails, utils
 from mvc.utils import hms_to_seconds
 
 from mvc.qtfaststart import processor
-from mvc.qtfaststart.exceptions import FastStartException
+from mvc.qtfaststart.exceptions import (FastStartException,
+                                       AlreadyFastStartException)
 
 logger = logging.getLogger(__name__)
 
 NON_WORD_CHARS = re.compile(r"[^a-zA-Z0-9]+")
 
+def _parse_progress_time(value):
+    if ':' in value:
+        hours, minutes, seconds = [float(m) for m in value.split(':')[:3]]
+        return hms_to_seconds(hours, minutes, seconds)
+    return float(value)
+
+def _parse_progress_size(value):
+    for suffix, multiplier in (('KiB', 1024), ('kB', 1024),
+                               ('MiB', 1024 * 1024), ('mB', 1024 * 1024),
+                               ('B', 1)):
+        if value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * multiplier)
+    return int(value)
+
+def _parse_progress_rate(value):
+    for suffix in ('kbits/s', 'x'):
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)])
+    return float(value)
+
+def parse_bitrate(value):
+    """Parse a bitrate option value as ffmpeg does, for example "112k",
+    "2M" or "64000".
+
+    :returns: bits per second, or None if value isn't a bitrate
+    """
+    multiplier = 1
+    for suffix, suffix_multiplier in (('k', 1000), ('K', 1000),
+                                      ('M', 1000 ** 2), ('G', 1000 ** 3)):
+        if value.endswith(suffix):
+            value = value[:-len(suffix)]
+            multiplier = suffix_multiplier
+            break
+    try:
+        return int(float(value) * multiplier)
+    except ValueError:
+        return None
+
+def _parse_number(value):
+    # a number option like -ar 48000 or -r 30000/1001, or None
+    try:
+        if '/' in value:
+            numerator, denominator = value.split('/', 1)
+            return float(numerator) / float(denominator)
+        return float(value)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+def get_input_bitrate(video):
+    """Get the average bitrate of a media file, in bits per second, or None
+    if we don't know its duration.
+    """
+    if not video.duration:
+        return None
+    try:
+        return os.path.getsize(video.filename) * 8.0 / video.duration
+    except EnvironmentError:
+        return None
+
+PCM_CODEC_RE = re.compile(r'^pcm_[suf](\d+)')
+
+def get_pcm_bitrate(codec, sample_rate=48000, channels=2):
+    """Get the bitrate of uncompressed audio, or None if codec isn't a PCM
+    codec.
+    """
+    if codec in ('pcm_alaw', 'pcm_mulaw'):
+        bits = 8
+    else:
+        match = PCM_CODEC_RE.match(codec)
+        if match is None:
+            return None
+        bits = int(match.group(1))
+    return int(sample_rate * channels * bits)
+
+# Apple's target bitrates for each ProRes profile (as numbered by ffmpeg's
+# -profile option), at 1920x1080 and 29.97 frames per second
+PRORES_BITRATES = {
+    0: 45000000,    # proxy
+    1: 102000000,   # LT
+    2: 147000000,   # standard
+    3: 220000000,   # HQ
+    4: 330000000,   # 4444
+    5: 500000000,   # 4444 XQ
+}
+PRORES_PROFILE_NAMES = {
+    'proxy': 0, 'lt': 1, 'standard': 2, 'hq': 3, '4444': 4, '4444xq': 5,
+}
+
+def get_prores_bitrate(profile, width, height, frame_rate=30):
+    """Estimate the bitrate of a ProRes video.
+
+    ProRes is intra-only, so its bitrate goes with the number of pixels per
+    second rather than with the input's bitrate.
+
+    :param profile: value of the -profile option, or None for the default
+    """
+    if profile is None:
+        profile = 2
+    elif profile in PRORES_PROFILE_NAMES:
+        profile = PRORES_PROFILE_NAMES[profile]
+    else:
+        try:
+            profile = int(profile)
+        except ValueError:
+            profile = 2
+    # unknown profiles are assumed to be the biggest one
+    bitrate = PRORES_BITRATES.get(profile, max(PRORES_BITRATES.values()))
+    scale = (float(width * height) / (1920 * 1080) *
+             float(frame_rate) / 29.97)
+    return int(bitrate * scale)
+
 class ConverterInfo(object):
     """Describes a particular output converter
 
@@ -28,9 +144,15 @@ class ConverterInfo(object):
     :attribute height: output height for this converter.  Works just like
     width
     :attribute dont_upsize: should we allow upsizing for conversions? 
+    :attribute bitrate: bitrate of the output in bits per second, if the
+    converter knows it.  Used to guess the size of the output.
+    :attribute observed_bitrate: average bitrate of the outputs that we've
+    made so far, for converters whose bitrate depends on the input (for
+    example because they use -crf)
     """
     media_type = None
     bitrate = None
+    observed_bitrate = None
     extension = None
     audio_only = False
 
@@ -55,43 +177,105 @@ class ConverterInfo(object):
         extension = self.extension if self.extension else ext
         return '%s.%s.%s' % (name, self.identifier, extension)
 
+    def get_bitrate(self, video):
+        """Guess the bitrate of the output for video, in bits per second.
+
+        Returns None if we can't tell.
+        """
+        return self.bitrate or self.observed_bitrate
+
     def get_output_size_guess(self, video):
-        if not self.bitrate or not video.duration:
+        """Guess the size of the output for video, in bytes.
+
+        Returns None if we can't tell.
+        """
+        if not video.duration:
+            return None
+        bitrate = self.get_bitrate(video)
+        if not bitrate:
             return None
-        if video.duration:
-            return self.bitrate * video.duration / 8
+        return int(bitrate * video.duration / 8)
 
-    def finalize(self, temp_output, output):
-        err = None
-        needs_remove = False
-        if self.media_type == 'format' and self.extension == 'mp4':
-            needs_remove = True
-            logging.debug('generic mp4 format detected.  '
-                          'Running qtfaststart...')
-            try:
-                processor.process(temp_output, output)
-            except FastStartException:
-                logging.exception('qtfaststart: exception occurred')
-                err = EnvironmentError('qtfaststart exception')
+    def get_space_needed(self, video):
+        """Guess the space that converting video needs on the output
+        filesystem, in bytes.
+
+        This is more than the size of the output when finalize() makes a
+        second copy of it.  Returns None if we can't tell.
+        """
+        size = self.get_output_size_guess(video)
+        if size is not None and self.needs_faststart():
+            # qtfaststart writes the finished file before the temporary one
+            # is removed
+            size *= 2
+        return size
+
+    def record_output_size(self, video, size):
+        """Remember the size of an output that we made from video, so that
+        later guesses are better.
+        """
+        if not video.duration:
+            return
+        bitrate = size * 8.0 / video.duration
+        if self.observed_bitrate is None:
+            self.observed_bitrate = bitrate
         else:
-            try:
-                shutil.move(temp_output, output)
-            except EnvironmentError, e:
-                needs_remove = True
-                err = e
-        # If it didn't work for some reason try to clean up the stale stuff.
-        # And if that doesn't work ... just log, and re-raise the original
-        # error.
-        if needs_remove:
-            try:
-                os.remove(temp_output)
-            except EnvironmentError, e:
-                logging.error('finalize(): cannot remove stale file %r',
-                              temp_output)
-                if err:
-                    logging.error('finalize(): removal was in response to '
-                                  'error: %s', str(err))
-                    raise err
+            # weight recent outputs more, but don't let one odd file throw
+            # off the guess
+            self.observed_bitrate = (self.observed_bitrate * 3 + bitrate) / 4
+
+    def needs_faststart(self):
+        """Check if finalize() runs qtfaststart on the output."""
+        return self.media_type == 'format' and self.extension == 'mp4'
+
+    def finalize(self, temp_output, output):
+        """Move the finished temp_output to output.
+
+        MP4 files are run through qtfaststart on the way, so that they can
+        be played while they download.  Either way the data is read and
+        written once, output is replaced atomically, and temp_output is
+        removed, even if something goes wrong.
+
+        :raises EnvironmentError: if output couldn't be written
+        """
+        try:
+            if self.needs_faststart():
+                logging.debug('generic mp4 format detected.  '
+                              'Running qtfaststart...')
+                try:
+                    utils.install_file(temp_output, output,
+                                       self._write_faststart)
+                except AlreadyFastStartException:
+                    utils.install_file(temp_output, output)
+                except FastStartException:
+                    logging.exception('qtfaststart: exception occurred')
+                    raise EnvironmentError('qtfaststart exception')
+            else:
+                utils.install_file(temp_output, output)
+        except EnvironmentError, err:
+            self._remove_stale_file(temp_output, err)
+            raise
+
+    @staticmethod
+    def _remove_stale_file(temp_output, err):
+        # If finalize() didn't work for some reason try to clean up the stale
+        # stuff.  And if that doesn't work ... just log; finalize() re-raises
+        # the original error.
+        if not os.path.exists(temp_output):
+            return
+        try:
+            os.remove(temp_output)
+        except EnvironmentError:
+            logging.error('finalize(): cannot remove stale file %r',
+                          temp_output)
+            logging.error('finalize(): removal was in response to '
+                          'error: %s', str(err))
+
+    @staticmethod
+    def _write_faststart(source, outfile):
+        with open(source, 'rb') as datastream:
+            index, moov = processor.prepare(datastream)
+            processor.write(datastream, index, moov, outfile)
 
     def get_target_size(self, video):
         """Get the size that we will convert to for a given video.
@@ -105,6 +289,64 @@ class ConverterInfo(object):
     def process_status_line(self, line):
         raise NotImplementedError
 
+    def get_requirements(self):
+        """Get what the converter's executable needs to support to run this
+        conversion.
+
+        :returns: dict mapping 'encoders', 'muxers', 'filters' or 'hwaccels'
+        to a list of names; see capabilities.Capabilities.get_missing()
+        """
+        return {}
+
+    def can_create_thumbnail(self, video):
+        """Can this converter write a thumbnail while it converts video?
+
+        If so, get_thumbnail_arguments() returns the extra arguments to do
+        that.
+        """
+        return False
+
+    def get_thumbnail_arguments(self, video, output, width, height, skip=0):
+        """Get extra arguments that make the converter also write a
+        thumbnail of video to output.
+
+        :param skip: number of seconds into the video to take the thumbnail
+        """
+        raise NotImplementedError
+
+    def get_storyboard_arguments(self, video, output_pattern, width, height,
+                                 count=16):
+        """Get extra arguments that make the converter also write the frames
+        for a storyboard of video.
+
+        The frames are written as separate images, named using
+        output_pattern (for example "frames/%03d.jpg").  Writing a single
+        tiled image would hold back ffmpeg's progress output until the last
+        frame; video.tile_storyboard_synchronous() tiles them afterwards.
+
+        This is supported if can_create_thumbnail() returns True.
+        """
+        raise NotImplementedError
+
+    def uses_progress_pipe(self):
+        """Does this converter write machine-readable progress to stdout?
+
+        If this returns True, stdout lines are handled by
+        process_progress_line() and stderr is kept separately and checked for
+        errors with process_status_line() once the process exits.
+        """
+        return False
+
+    def get_progress_arguments(self):
+        """Get the command line arguments that enable the progress pipe.
+
+        These go in front of the arguments from get_arguments().
+        """
+        return []
+
+    def process_progress_line(self, video, line):
+        raise NotImplementedError
+
 class FFmpegConverterInfo(ConverterInfo):
     """Base class for all ffmpeg-based conversions.
 
@@ -115,10 +357,26 @@ class FFmpegConverterInfo(ConverterInfo):
     """
     DURATION_RE = re.compile(r'\W*Duration: (\d\d):(\d\d):(\d\d)\.(\d\d)'
                              '(, start:.*)?(, bitrate:.*)?')
-    PROGRESS_RE = re.compile(r'(?:frame=.* fps=.* q=.* )?size=.* time=(.*) '
-                             'bitrate=(.*)')
-    LAST_PROGRESS_RE = re.compile(r'frame=.* fps=.* q=.* Lsize=.* time=(.*) '
-                                  'bitrate=(.*)')
+    # A single pattern that pulls all the fields out of a progress line.
+    # ffmpeg pads the values with spaces, so allow whitespace after each '='.
+    PROGRESS_RE = re.compile(r'(?:frame=\s*(?P<frame>\S+)\s+)?'
+                             r'(?:fps=\s*(?P<fps>\S+)\s+)?'
+                             r'(?:q=\s*(?P<q>\S+)\s+)*'
+                             r'(?P<last>L)?size=\s*(?P<size>\S+)\s+'
+                             r'time=\s*(?P<time>\S+)\s+'
+                             r'bitrate=\s*(?P<bitrate>\S+)'
+                             r'(?:.*?speed=\s*(?P<speed>\S+))?')
+    PROGRESS_PREFIXES = ('frame=', 'size=', 'Lsize=')
+    PROGRESS_FIELD_PARSERS = (
+        ('frame', int),
+        ('fps', float),
+        ('q', float),
+        ('size', _parse_progress_size),
+        ('time', _parse_progress_time),
+        ('bitrate', _parse_progress_rate),
+        ('speed', _parse_progress_rate),
+    )
+    ERROR_PREFIXES = ('Unknown', 'Error')
 
     extension = None
     parameters = None
@@ -139,6 +397,137 @@ class FFmpegConverterInfo(ConverterInfo):
 	args.append(self.convert_output_path(output))
         return args
 
+    # options in parameters that name an encoder or a muxer
+    ENCODER_OPTIONS = ('-vcodec', '-acodec', '-scodec', '-c', '-codec',
+                       '-c:v', '-c:a', '-c:s', '-codec:v', '-codec:a',
+                       '-codec:s')
+    MUXER_OPTIONS = ('-f',)
+
+    def get_requirements(self):
+        # this only looks at the parameters attribute, so subclasses that
+        # override get_parameters() should override this too.
+        if self.parameters is None:
+            return {}
+        if isinstance(self.parameters, basestring):
+            parameters = self.parameters.split()
+        else:
+            parameters = list(self.parameters)
+        requirements = {}
+        for option, value in zip(parameters, parameters[1:]):
+            if option in self.ENCODER_OPTIONS and value != 'copy':
+                field = 'encoders'
+            elif option in self.MUXER_OPTIONS:
+                field = 'muxers'
+            else:
+                continue
+            if value not in requirements.setdefault(field, []):
+                requirements[field].append(value)
+        return requirements
+
+    VIDEO_BITRATE_OPTIONS = ('-b:v', '-vb', '-b')
+    AUDIO_BITRATE_OPTIONS = ('-b:a', '-ab')
+    VIDEO_CODEC_OPTIONS = ('-vcodec', '-c:v', '-codec:v')
+    AUDIO_CODEC_OPTIONS = ('-acodec', '-c:a', '-codec:a')
+    # what ffmpeg's audio encoders use if we don't give a bitrate
+    DEFAULT_AUDIO_BITRATE = 128000
+
+    def get_bitrate(self, video):
+        if self.bitrate:
+            return self.bitrate
+        try:
+            parameters = self.get_parameters(video)
+        except ValueError:
+            return self.observed_bitrate
+        options = {}
+        for option, value in zip(parameters, parameters[1:]):
+            options.setdefault(option, value)
+
+        def get_option(names, parse=parse_bitrate):
+            for name in names:
+                if name in options:
+                    return parse(options[name])
+            return None
+
+        def is_copied(names):
+            return get_option(names, lambda value: value == 'copy')
+
+        def get_codec(names):
+            return get_option(names, lambda value: value)
+
+        audio_only = (self.audio_only or video.audio_only or
+                      '-vn' in parameters)
+        if (is_copied(self.VIDEO_CODEC_OPTIONS) or
+            (audio_only and is_copied(self.AUDIO_CODEC_OPTIONS))):
+            # the streams are copied, so the output is about as big as the
+            # input
+            return get_input_bitrate(video)
+        audio_bitrate = get_option(self.AUDIO_BITRATE_OPTIONS)
+        if audio_bitrate is None:
+            # uncompressed audio doesn't take a bitrate, and is a lot bigger
+            # than what ffmpeg's encoders default to
+            audio_bitrate = get_pcm_bitrate(
+                get_codec(self.AUDIO_CODEC_OPTIONS) or '',
+                get_option(('-ar',), _parse_number) or 48000,
+                get_option(('-ac',), _parse_number) or 2)
+        if audio_bitrate is None:
+            audio_bitrate = self.DEFAULT_AUDIO_BITRATE
+        if audio_only:
+            return audio_bitrate
+        video_bitrate = get_option(self.VIDEO_BITRATE_OPTIONS)
+        if (video_bitrate is None and
+            get_codec(self.VIDEO_CODEC_OPTIONS) == 'prores'):
+            video_bitrate = self._get_prores_bitrate(
+                video, get_codec(('-profile:v', '-profile')),
+                get_option(('-r',), _parse_number))
+        if video_bitrate is None:
+            # the bitrate depends on the input (for example with -crf), so
+            # go by the outputs we've made so far.  Before the first one,
+            # assume that it's no bigger than -maxrate or the input.
+            if self.observed_bitrate:
+                return self.observed_bitrate
+            video_bitrate = get_option(('-maxrate',))
+            if video_bitrate is None:
+                return get_input_bitrate(video)
+        return video_bitrate + audio_bitrate
+
+    def _get_prores_bitrate(self, video, profile, frame_rate):
+        try:
+            width, height = self.get_target_size(video)
+        except TypeError:
+            # we don't know the input size
+            width, height = 1920, 1080
+        if frame_rate is None:
+            # we don't know the input's frame rate, assume it's no more
+            # than 30
+            frame_rate = 30
+        return get_prores_bitrate(profile, width, height, frame_rate)
+
+    def can_create_thumbnail(self, video):
+        return not (self.audio_only or video.audio_only)
+
+    def get_thumbnail_arguments(self, video, output, width, height, skip=0):
+        # these options come after the conversion output, so ffmpeg treats
+        # them as a second output of the same run, using the frames it has
+        # already decoded.
+        args = []
+        if skip:
+            args.extend(['-ss', str(skip)])
+        args.extend(['-an', '-vf', 'scale=%i:%i' % (width, height),
+                     '-vframes', '1', self.convert_output_path(output)])
+        return args
+
+    def get_storyboard_arguments(self, video, output_pattern, width, height,
+                                 count=16):
+        offset = thumbnails.get_storyboard_layout(video.duration, count,
+                                                  count)[0]
+        # the offset has to be skipped inside the filter; see
+        # get_storyboard_filter()
+        return ['-an',
+                '-vf', thumbnails.get_storyboard_filter(
+                    video.duration, width, height, count, offset=offset),
+                '-vframes', str(count),
+                self.convert_output_path(output_pattern)]
+
     def convert_output_path(self, output_path):
 	"""Convert our output path so that it can be passed to ffmpeg."""
 	# this is a bit tricky, because output_path doesn't exist on windows
@@ -174,30 +563,92 @@ class FFmpegConverterInfo(ConverterInfo):
 
     @classmethod
     def process_status_line(klass, video, line):
-        error = klass._check_for_errors(line)
-        if error:
-            return {'finished': True, 'error': error}
+        # Dispatch on the start of the line, so that we only run a single
+        # regex for each line.  This gets called for every line of output
+        # from every conversion, so it needs to be cheap.
+        if line.startswith(klass.PROGRESS_PREFIXES):
+            match = klass.PROGRESS_RE.match(line)
+            if match is None:
+                return None
+            if match.group('last'):
+                return {'finished': True}
+            try:
+                return {'progress': _parse_progress_time(match.group('time'))}
+            except ValueError:
+                # time=N/A
+                return None
 
-        match = klass.DURATION_RE.match(line)
-        if match is not None:
-            hours, minutes, seconds, centi = [
-                int(m) for m in match.groups()[:4]]
-            return {'duration': hms_to_seconds(hours, minutes,
-                                               seconds + 0.01 * centi)}
+        if line.startswith(klass.ERROR_PREFIXES):
+            error = klass._check_for_errors(line)
+            if error:
+                return {'finished': True, 'error': error}
+            return None
 
-        match = klass.PROGRESS_RE.match(line)
-        if match is not None:
-            t = match.group(1)
-            if ':' in t:
-                hours, minutes, seconds = [float(m) for m in t.split(':')[:3]]
-                return {'progress': hms_to_seconds(hours, minutes, seconds)}
-            else:
-                return {'progress': float(t)}
+        if line.lstrip().startswith('Duration:'):
+            match = klass.DURATION_RE.match(line)
+            if match is not None:
+                hours, minutes, seconds, centi = [
+                    int(m) for m in match.groups()[:4]]
+                return {'duration': hms_to_seconds(hours, minutes,
+                                                   seconds + 0.01 * centi)}
 
-        match = klass.LAST_PROGRESS_RE.match(line)
-        if match is not None:
+    def uses_progress_pipe(self):
+        return settings.ffmpeg_supports_progress_pipe()
+
+    def get_progress_arguments(self):
+        if not self.uses_progress_pipe():
+            return []
+        # -nostats turns off the human-readable progress on stderr, we only
+        # want errors there.
+        return ['-progress', 'pipe:1', '-nostats']
+
+    @classmethod
+    def process_progress_line(klass, video, line):
+        """Handle a line of output from ffmpeg -progress.
+
+        The progress output is a series of key=value lines, with a
+        progress=continue or progress=end line at the end of each block.  We
+        only need out_time and the progress key.
+        """
+        key, sep, value = line.partition('=')
+        if key == 'out_time':
+            # out_time is N/A or negative before the first frame is written
+            if value.startswith(('N', '-')):
+                return None
+            return {'progress': _parse_progress_time(value)}
+        elif key == 'progress' and value == 'end':
             return {'finished': True}
 
+    @classmethod
+    def parse_progress_line(klass, line):
+        """Parse an ffmpeg/avconv progress line.
+
+        Progress lines look like:
+
+        frame=  257 fps= 45 q=27.0 size=    1033kB time=00:00:08.70 \
+                bitrate= 971.4kbits/s speed=1.5x
+
+        :returns: dict containing frame, fps, q, size (in bytes), time (in
+        seconds), bitrate (in kbits/s) and speed, for the values that were
+        present and could be parsed.  The final key is True if this is the
+        last progress line of the conversion.  Returns None if line isn't a
+        progress line.
+        """
+        match = klass.PROGRESS_RE.match(line)
+        if match is None:
+            return None
+        stats = {'final': bool(match.group('last'))}
+        for key, parse in klass.PROGRESS_FIELD_PARSERS:
+            value = match.group(key)
+            if value is None:
+                continue
+            try:
+                stats[key] = parse(value)
+            except ValueError:
+                # "N/A" and friends
+                pass
+        return stats
+
 class FFmpegConverterInfo1080p(FFmpegConverterInfo):
     def __init__(self, name):
         FFmpegConverterInfo.__init__(self, name, 1920, 1080)
@@ -210,26 +661,256 @@ class FFmpegConverterInfo480p(FFmpegConverterInfo):
     def __init__(self, name):
         FFmpegConverterInfo.__init__(self, name, 720, 480)
 
+def _iter_converters(converters):
+    """Iterate through (brand, converter) pairs for a converters list from
+    basicconverters or a converter script.
+    """
+    for converter in converters:
+        if isinstance(converter, tuple):
+            brand, realconverters = converter
+            for realconverter in realconverters:
+                yield brand, realconverter
+        else:
+            yield None, converter
+
+def _run_converter_script(converter_file):
+    global_dict = {}
+    execfile(converter_file, global_dict)
+    return global_dict.get('converters')
+
+def get_metadata(converter, brand=None):
+    """Get the information about a converter that's stored in the converter
+    catalog, as a dict.
+    """
+    return {
+        'identifier': converter.identifier,
+        'name': converter.name,
+        'brand': brand,
+        'media_type': converter.media_type,
+        'extension': converter.extension,
+        'audio_only': converter.audio_only,
+        'width': converter.width,
+        'height': converter.height,
+        'requirements': converter.get_requirements(),
+        }
+
+# Converter catalogs are JSON files that describe the converters defined by
+# each converter script, so that we don't have to run the scripts to find
+# out.  The version changes whenever the format does.
+CONVERTER_CATALOG_VERSION = 3
+
+def _hash_script(converter_file):
+    with open(converter_file, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def _catalog_entry(converter_file, converters):
+    stat = os.stat(converter_file)
+    return {
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'sha1': _hash_script(converter_file),
+        'converters': [get_metadata(converter, brand)
+                       for (brand, converter)
+                       in _iter_converters(converters or [])],
+        }
+
+def _check_catalog_entry(entry, converter_file):
+    """Check if a catalog entry still describes converter_file.
+
+    :returns: 'current' if the script hasn't been touched, 'moved' if its
+    modification time has changed but its contents haven't (for example
+    because it has been installed or checked out again), or None if the
+    entry is out of date.
+    """
+    try:
+        stat = os.stat(converter_file)
+    except EnvironmentError:
+        return None
+    if entry['size'] != stat.st_size:
+        return None
+    if entry['mtime'] == stat.st_mtime:
+        return 'current'
+    if entry['sha1'] == _hash_script(converter_file):
+        return 'moved'
+    return None
+
+def build_converter_index(converter_files):
+    """Run converter scripts and build a catalog of their converters.
+
+    :returns: dict with the catalog version and a dict mapping the name of
+    each script to its modification time, size, SHA-1 hash and a list of
+    metadata dicts for its converters
+    """
+    index = {'version': CONVERTER_CATALOG_VERSION, 'scripts': {}}
+    for converter_file in converter_files:
+        index['scripts'][os.path.basename(converter_file)] = _catalog_entry(
+            converter_file, _run_converter_script(converter_file))
+    return index
+
+def write_converter_index(path, converter_files=None, index=None):
+    """Write a converter catalog to path.
+
+    The catalog is either index, or built from converter_files; see
+    build_converter_index().  The file is replaced atomically, so that
+    other processes never read half of it.
+    """
+    if index is None:
+        index = build_converter_index(converter_files)
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    temp = tempfile.NamedTemporaryFile(dir=directory or '.', prefix='.',
+                                       delete=False)
+    try:
+        with temp:
+            json.dump(index, temp, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            temp.write('\n')
+        if sys.platform == 'win32' and os.path.exists(path):
+            os.unlink(path)
+        os.rename(temp.name, path)
+    except:
+        os.unlink(temp.name)
+        raise
+
+def read_converter_index(path):
+    """Read a catalog written by write_converter_index().
+
+    :returns: the catalog, or None if it's missing, can't be read or is
+    from a different version
+    """
+    try:
+        with open(path) as f:
+            index = json.load(f)
+    except (EnvironmentError, ValueError):
+        logger.info('read_converter_index: cannot read %r', path,
+                    exc_info=True)
+        return None
+    if (not isinstance(index, dict) or
+        index.get('version') != CONVERTER_CATALOG_VERSION):
+        logger.info('read_converter_index: %r is out of date', path)
+        return None
+    return index
+
+def get_converter_cache_path():
+    """Get the path of the converter catalog that we keep up to date with
+    the converter scripts.
+    """
+    return os.path.join(settings.get_cache_directory(), 'converters.json')
+
 class ConverterManager(object):
+    """Keep track of the available converters.
+
+    Converters defined in resources/converters are described by a catalog
+    (see build_converter_index()), so startup doesn't need to run the
+    scripts.  The catalog shipped with MVC is used if it matches the
+    scripts.  Otherwise the scripts that have changed are run and a new
+    catalog is written to the cache directory for next time.
+
+    A script is run the first time that one of its converters is needed.
+    Until then, list_metadata(), find_converters() and get_menu() can
+    describe its converters.
+
+    After check_capabilities(), converters that need something that our
+    ffmpeg doesn't have are left out of find_converters() and get_menu().
+    """
+    # fields that find_converters() can look converters up by
+    LOOKUP_FIELDS = ('extension', 'media_type', 'size', 'brand')
+    # the order of the brands in the format menu; other menus are sorted by
+    # name
+    FORMAT_MENU_ORDER = ['Audio', 'Video', 'Ingest Formats', 'Same Format']
+
     def __init__(self):
         self.converters = {}
         # converter -> brand reverse map.  XXX: this code, really, really sucks
         # and not very scalable.
         self.brand_rmap = {}
         self.brand_map = {}
+        # identifier -> (script path, metadata dict) for converters in
+        # scripts that haven't been run yet
+        self.unloaded = {}
+        # identifier -> metadata dict for every converter, in the order they
+        # were defined
+        self.metadata = collections.OrderedDict()
+        # field -> value -> set of identifiers, for find_converters()
+        self.lookups = dict((field, {}) for field in self.LOOKUP_FIELDS)
+        # media type -> menu options, for get_menu()
+        self.menus = {}
+        # the capabilities.Capabilities that check_capabilities() was last
+        # called with, and identifier -> list of (field, name) tuples for
+        # the converters that need something that it doesn't have
+        self.capabilities = None
+        self.unsupported = {}
 
-    def add_converter(self, converter):
+    def add_converter(self, converter, brand=None):
         self.converters[converter.identifier] = converter
+        self._add_metadata(get_metadata(converter, brand))
+
+    def _add_metadata(self, metadata):
+        identifier = metadata['identifier']
+        old_metadata = self.metadata.get(identifier)
+        if old_metadata == metadata:
+            return
+        if old_metadata is not None:
+            for field, value in self._lookup_values(old_metadata):
+                self.lookups[field][value].discard(identifier)
+        self.metadata[identifier] = metadata
+        for field, value in self._lookup_values(metadata):
+            self.lookups[field].setdefault(value, set()).add(identifier)
+        self._check_metadata(metadata)
+        self.menus = {}
+
+    def _check_metadata(self, metadata):
+        identifier = metadata['identifier']
+        self.unsupported.pop(identifier, None)
+        if self.capabilities is None:
+            return
+        missing = self.capabilities.get_missing(
+            metadata.get('requirements', {}))
+        if missing:
+            self.unsupported[identifier] = missing
+
+    def check_capabilities(self, capabilities):
+        """Check which converters our ffmpeg can run.
+
+        :param capabilities: capabilities.Capabilities for the ffmpeg binary
+        """
+        self.capabilities = capabilities
+        for metadata in self.metadata.values():
+            self._check_metadata(metadata)
+        self.menus = {}
+        for identifier, missing in self.unsupported.items():
+            logger.info('hiding %s: ffmpeg is missing %s', identifier,
+                        ', '.join('%s %s' % (field[:-1], name)
+                                  for (field, name) in missing))
+
+    def get_missing(self, identifier):
+        """Get what our ffmpeg is missing to run a converter.
+
+        :returns: list of (field, name) tuples, empty if the converter is
+        supported or check_capabilities() hasn't been called
+        """
+        return self.unsupported.get(identifier, [])
+
+    def _lookup_values(self, metadata):
+        for field in self.LOOKUP_FIELDS:
+            if field == 'size':
+                yield field, (metadata['width'], metadata['height'])
+            else:
+                yield field, metadata[field]
 
     def startup(self):
         self.load_simple_converters()
-        self.load_converters(resources.converter_scripts())
+        self.load_converter_index(resources.converter_index(),
+                                  resources.converter_scripts(),
+                                  get_converter_cache_path())
 
     def brand_to_converters(self, brand):
-        try:
-            return self.brand_map[brand]
-        except KeyError:
+        identifiers = self.lookups['brand'].get(brand)
+        if not identifiers:
             return None
+        self._load_identifiers(identifiers)
+        return self.brand_map[brand]
 
     def converter_to_brand(self, converter):
         try:
@@ -239,40 +920,171 @@ class ConverterManager(object):
 
     def load_simple_converters(self):
         from mvc import basicconverters
-        for converter in basicconverters.converters:
-            if isinstance(converter, tuple):
-                brand, realconverters = converter
-                for realconverter in realconverters:
-                    self.brand_rmap[realconverter] = brand
-                    self.brand_map.setdefault(brand, []).append(realconverter)
-                    self.add_converter(realconverter)
-            else:
-                self.brand_rmap[converter] = None
-                self.brand_map.setdefault(None, []).append(converter)
-                self.add_converter(converter)
+        self.add_converters(basicconverters.converters)
+
+    def add_converters(self, converters):
+        """Add a converters list from basicconverters or a converter
+        script.
+        """
+        for brand, converter in _iter_converters(converters):
+            self.brand_rmap[converter] = brand
+            self.brand_map.setdefault(brand, []).append(converter)
+            self.add_converter(converter, brand)
 
     def load_converters(self, converters):
         for converter_file in converters:
-            global_dict = {}
-            execfile(converter_file, global_dict)
-            if 'converters' in global_dict:
-                for converter in global_dict['converters']:
-                    if isinstance(converter, tuple):
-                        brand, realconverters = converter
-                        for realconverter in realconverters:
-                            self.brand_rmap[realconverter] = brand
-                            self.brand_map.setdefault(brand, []).append(realconverter)
-                            self.add_converter(realconverter)
-                    else:
-                        self.brand_rmap[converter] = None
-                        self.brand_map.setdefault(None, []).append(converter)
-                        self.add_converter(converter)
-                logger.info('load_converters: loaded %i from %r',
-                            len(global_dict['converters']),
+            self._run_script(converter_file)
+
+    def _run_script(self, converter_file):
+        script_converters = _run_converter_script(converter_file)
+        for identifier, (path, metadata) in self.unloaded.items():
+            if path == converter_file:
+                del self.unloaded[identifier]
+        if script_converters is not None:
+            self.add_converters(script_converters)
+            logger.info('load_converters: loaded %i from %r',
+                        len(script_converters), converter_file)
+        return script_converters
+
+    def load_converter_index(self, index_path, converters, cache_path=None):
+        """Read the converters in the converter scripts from a catalog,
+        without running the scripts.
+
+        The catalog at cache_path is tried first, then the one at
+        index_path.  Scripts that aren't in either catalog, or that have
+        changed since, are run straight away.  If that happens, and
+        cache_path is given, an up to date catalog is written there.
+        """
+        indexes = [read_converter_index(path)
+                   for path in (cache_path, index_path) if path is not None]
+        indexes = [index for index in indexes if index is not None]
+        catalog = {'version': CONVERTER_CATALOG_VERSION, 'scripts': {}}
+        changed = False
+        for converter_file in converters:
+            name = os.path.basename(converter_file)
+            entry = None
+            for index in indexes:
+                entry = index['scripts'].get(name)
+                if entry is None:
+                    continue
+                state = _check_catalog_entry(entry, converter_file)
+                if state == 'moved':
+                    # save the new mtime, so that we don't have to hash the
+                    # script next time
+                    entry = dict(entry, mtime=os.stat(converter_file).st_mtime)
+                    changed = True
+                if state is not None:
+                    break
+                entry = None
+            if entry is None:
+                logger.info('load_converter_index: %r is not in a catalog',
                             converter_file)
+                entry = _catalog_entry(converter_file,
+                                       self._run_script(converter_file))
+                changed = True
+            else:
+                for metadata in entry['converters']:
+                    self.unloaded[metadata['identifier']] = (converter_file,
+                                                             metadata)
+                    self._add_metadata(metadata)
+            catalog['scripts'][name] = entry
+        if changed and cache_path is not None:
+            try:
+                write_converter_index(cache_path, index=catalog)
+            except EnvironmentError:
+                logger.warn('cannot write converter catalog to %r',
+                            cache_path, exc_info=True)
+
+    def _load_identifiers(self, identifiers):
+        scripts = set(self.unloaded[identifier][0]
+                      for identifier in identifiers
+                      if identifier in self.unloaded)
+        self.load_converters(sorted(scripts))
+
+    def load_all(self):
+        """Run any converter scripts that haven't been run yet."""
+        self._load_identifiers(self.unloaded.keys())
 
     def list_converters(self):
+        self.load_all()
         return self.converters.values()
 
+    def list_metadata(self):
+        """Get the metadata for every converter, without running the
+        converter scripts.
+
+        :returns: list of dicts; see get_metadata()
+        """
+        return self.metadata.values()
+
+    def find_converters(self, include_unsupported=False, **criteria):
+        """Find converters without running the converter scripts.
+
+        Keyword arguments give the extension, media_type, size (a (width,
+        height) tuple) or brand to look for.  brand=None finds the
+        converters that don't have a brand.  Unsupported converters are left
+        out, unless include_unsupported is True.
+
+        :returns: list of metadata dicts, sorted by name
+        """
+        found = None
+        for field, value in criteria.items():
+            if field not in self.lookups:
+                raise TypeError('cannot find converters by %r' % (field,))
+            identifiers = self.lookups[field].get(value, set())
+            if found is None:
+                found = set(identifiers)
+            else:
+                found &= identifiers
+        if found is None:
+            found = self.metadata.keys()
+        if not include_unsupported:
+            found = [identifier for identifier in found
+                     if identifier not in self.unsupported]
+        return sorted((self.metadata[identifier] for identifier in found),
+                      key=operator.itemgetter('name'))
+
+    def get_menu(self, media_type):
+        """Get the options for the menu of converters with media_type, in
+        the order that they're shown.
+
+        The menus are built from the converter metadata, without running
+        the converter scripts, and cached until the converters change.
+
+        :returns: list of (name, identifier) tuples for converters without
+        a brand and (brand, [(name, identifier), ...]) tuples for brands.
+        """
+        if media_type not in self.menus:
+            options = []
+            brands = {}
+            for metadata in self.metadata.values():
+                if (metadata['media_type'] != media_type or
+                    metadata['identifier'] in self.unsupported):
+                    continue
+                option = (metadata['name'], metadata['identifier'])
+                brand = metadata['brand']
+                if brand is None:
+                    options.append(option)
+                elif brand in brands:
+                    brands[brand].append(option)
+                else:
+                    brands[brand] = [option]
+                    options.append((brand, brands[brand]))
+            if media_type == 'format':
+                order = self.FORMAT_MENU_ORDER
+                options.sort(key=lambda (name, menu): order.index(name))
+            else:
+                options.sort()
+            self.menus[media_type] = options
+        return self.menus[media_type]
+
     def get_by_id(self, id_):
+        if id_ not in self.converters and id_ in self.unloaded:
+            self.load_converters([self.unloaded[id_][0]])
         return self.converters[id_]
+
+
+if __name__ == '__main__':
+    # rebuild the converter catalog after changing the converter scripts
+    write_converter_index(resources.converter_index(),
+                          resources.converter_scripts())
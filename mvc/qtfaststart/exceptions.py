@@ -2,4 +2,11 @@ class FastStartException(Exception):
     """
     Raised when something bad happens during processing.
     """
-    pass
\ No newline at end of file
+    pass
+
+class AlreadyFastStartException(FastStartException):
+    """
+    Raised when a file doesn't need processing, because its metadata is
+    already at the front.
+    """
+    pass
@@ -9,9 +9,10 @@ import struct
 
 from StringIO import StringIO
 
-from mvc.qtfaststart.exceptions import FastStartException
+from mvc.qtfaststart.exceptions import (FastStartException,
+                                        AlreadyFastStartException)
 
-CHUNK_SIZE = 8192
+CHUNK_SIZE = 1024 * 1024
 
 log = logging.getLogger("qtfaststart")
 
@@ -63,7 +64,11 @@ def get_index(datastream):
         if atom_size == 0:
             # Some files may end in mdat with no size set, which generally
             # means to seek to the end of the file. We can just stop indexing
-            # as no more entries will be found!
+            # as no more entries will be found!  Record the real size, so
+            # that the whole atom gets copied.
+            start = index[-1][1]
+            datastream.seek(0, os.SEEK_END)
+            index[-1] = (atom_type, start, datastream.tell() - start)
             break
 
         datastream.seek(atom_size - skip, os.SEEK_CUR)
@@ -120,7 +125,26 @@ def process(infilename, outfilename, limit=0):
         which can then be used in bug reports and such.
     """
     datastream = open(infilename, "rb")
+    try:
+        index, moov = prepare(datastream)
+        outfile = open(outfilename, "wb")
+        try:
+            write(datastream, index, moov, outfile, limit)
+        finally:
+            outfile.close()
+    finally:
+        datastream.close()
+
+
+def prepare(datastream):
+    """
+        Read the atom index of a Quicktime/MP4 file and build its patched
+        moov atom, without writing anything.
 
+        Returns an (index, moov) tuple to pass to write().  Raises
+        AlreadyFastStartException if the file is already set up for
+        streaming.
+    """
     # Get the top level atom index
     index = get_index(datastream)
 
@@ -148,8 +172,8 @@ def process(infilename, outfilename, limit=0):
         offset -= moov_size
         if not free_size:
             # No free atoms and moov is correct, we are done!
-            log.error("This file appears to already be setup for streaming!")
-            raise FastStartException()
+            log.info("This file appears to already be setup for streaming!")
+            raise AlreadyFastStartException()
 
     # Read and fix moov
     datastream.seek(moov_pos)
@@ -176,8 +200,18 @@ def process(infilename, outfilename, limit=0):
         moov.write(struct.pack(">" + ctype * entry_count,
                                *[entry + offset for entry in entries]))
 
+    return index, moov.getvalue()
+
+
+def write(datastream, index, moov, outfile, limit=0):
+    """
+        Write the file read from datastream, set up for streaming, to
+        outfile in a single pass.  index and moov come from prepare().
+
+        outfile only has to support write(), so it can be any file-like
+        object, for example one on another filesystem.
+    """
     log.info("Writing output...")
-    outfile = open(outfilename, "wb")
 
     # Write ftype
     for atom, pos, size in index:
@@ -186,8 +220,7 @@ def process(infilename, outfilename, limit=0):
             outfile.write(datastream.read(size))
 
     # Write moov
-    moov.seek(0)
-    outfile.write(moov.read())
+    outfile.write(moov)
 
     # Write the rest
     written = 0
@@ -196,16 +229,14 @@ def process(infilename, outfilename, limit=0):
         datastream.seek(pos)
 
         # Write in chunks to not use too much memory
-        for x in range(size / CHUNK_SIZE):
-            outfile.write(datastream.read(CHUNK_SIZE))
-            written += CHUNK_SIZE
-            if limit and written >= limit:
-                # A limit was set and we've just passed it, stop writing!
-                break
-
-        if size % CHUNK_SIZE:
-            outfile.write(datastream.read(size % CHUNK_SIZE))
-            written += (size % CHUNK_SIZE)
+        while size:
+            chunk = datastream.read(min(size, CHUNK_SIZE))
+            if not chunk:
+                log.error("%s atom is truncated" % atom)
+                raise FastStartException()
+            outfile.write(chunk)
+            size -= len(chunk)
+            written += len(chunk)
             if limit and written >= limit:
                 # A limit was set and we've just passed it, stop writing!
-                break
+                return
@@ -8,6 +8,9 @@ def image_path(name):
 def converter_scripts():
     return glob.glob(os.path.join(resources_dir(), 'converters', '*.py'))
 
+def converter_index():
+    return os.path.join(resources_dir(), 'converters', 'index.json')
+
 
 def resources_dir():
     if in_py2exe():
@@ -2,8 +2,6 @@ import logging
 import os
 import sys
 
-from mvc import execute
-
 ffmpeg_version = None
 
 _search_path_extra = []
@@ -49,19 +47,53 @@ def get_ffmpeg_executable_path():
 def get_ffmpeg_version():
     global ffmpeg_version
     if ffmpeg_version is None:
-        commandline = [get_ffmpeg_executable_path(), '-version']
-        p = execute.Popen(commandline, stderr=open(os.devnull, "wb"))
-        stdout, _ = p.communicate()
-        lines = stdout.split('\n')
-        version = lines[0].rsplit(' ', 1)[1].split('.')
+        # the version comes from the capability cache, so that we don't run
+        # "ffmpeg -version" every time we start
+        from mvc import capabilities
+        caps = capabilities.get_capabilities(get_ffmpeg_executable_path())
+        if caps is None or caps.version is None:
+            raise ValueError("can't get the ffmpeg version")
         def maybe_int(v):
             try:
                 return int(v)
             except ValueError:
                 return v
-        ffmpeg_version = tuple(maybe_int(v) for v in version)
+        ffmpeg_version = tuple(maybe_int(v) for v in caps.version.split('.'))
     return ffmpeg_version
 
+def ffmpeg_supports_progress_pipe():
+    """Can we use "-progress pipe:1" to get machine-readable progress?
+
+    ffmpeg added -progress in version 1.0.  avconv doesn't support it.
+    """
+    executable = get_ffmpeg_executable_path()
+    if executable is None or 'avconv' in os.path.basename(executable):
+        return False
+    try:
+        version = get_ffmpeg_version()
+    except ValueError:
+        # we don't know what we've got, so play it safe
+        logging.warn("can't get the ffmpeg version; not using -progress")
+        return False
+    # git builds have versions like "N-45279-g4f8d7c5", which we assume are
+    # recent enough.
+    return not isinstance(version[0], int) or version >= (1, 0)
+
+def get_cache_directory():
+    """Get the directory to store cached data (thumbnails, etc.) in."""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.environ.get('APPDATA')
+        if base is None:
+            base = os.path.expanduser('~')
+        return os.path.join(base, 'Miro Video Converter', 'cache')
+    elif sys.platform == 'darwin':
+        return os.path.expanduser('~/Library/Caches/Miro Video Converter')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME')
+        if not base:
+            base = os.path.expanduser('~/.cache')
+        return os.path.join(base, 'mirovideoconverter')
+
 def customize_ffmpeg_parameters(params):
     """Takes a list of parameters and modifies it based on
     platform-specific issues.  Returns the newly modified list of
@@ -49,9 +49,9 @@ class WeakMethodReference:
     gives us enough info to recreate the bound method when we need it.
     """
 
-    def __init__(self, method):
-        self.object = weakref.ref(method.im_self)
-        self.func = weakref.ref(method.im_func)
+    def __init__(self, method, on_dead=None):
+        self.object = weakref.ref(method.im_self, on_dead)
+        self.func = weakref.ref(method.im_func, on_dead)
         # don't create a weak reference to the class.  That only works for
         # new-style classes.  It's highly unlikely the class will ever need to
         # be garbage collected anyways.
@@ -79,8 +79,8 @@ class Callback:
         return False
 
 class WeakCallback:
-    def __init__(self, method, extra_args):
-        self.ref = WeakMethodReference(method)
+    def __init__(self, method, extra_args, on_dead=None):
+        self.ref = WeakMethodReference(method, on_dead)
         self.extra_args = extra_args
 
     def compare_function(self, func):
@@ -99,9 +99,18 @@ class WeakCallback:
 class SignalEmitter(object):
     def __init__(self, *signal_names):
         self.signal_callbacks = {}
+        # maps signal name -> {function key: callback id}, so that connect()
+        # can check for duplicates without looking at every callback.  See
+        # _function_key().
+        self.signal_functions = {}
+        # maps signal name -> name of the do_* method that handles it
+        self.signal_handler_names = {}
         self.id_generator = itertools.count()
         self._currently_emitting = set()
         self._frozen = False
+        # set when the target of a weak callback goes away, so that emit()
+        # only looks for dead callbacks when there are some
+        self._dead_weak_references = False
         for name in signal_names:
             self.create_signal(name)
 
@@ -113,6 +122,8 @@ class SignalEmitter(object):
 
     def create_signal(self, name):
         self.signal_callbacks[name] = {}
+        self.signal_functions[name] = {}
+        self.signal_handler_names[name] = 'do_' + name.replace('-', '_')
 
     def get_callbacks(self, signal_name):
         try:
@@ -120,12 +131,50 @@ class SignalEmitter(object):
         except KeyError:
             raise KeyError("Signal: %s doesn't exist" % signal_name)
 
+    @staticmethod
+    def _function_key(func):
+        # Bound methods are keyed by their object's id rather than the object
+        # itself, so that weak callbacks don't keep it alive.  Returns None
+        # for functions that can't be hashed.
+        if getattr(func, 'im_self', None) is not None:
+            return (id(func.im_self), func.im_func)
+        try:
+            hash(func)
+        except TypeError:
+            return None
+        return func
+
     def _check_already_connected(self, name, func):
-        for callback in self.get_callbacks(name).values():
+        callbacks = self.get_callbacks(name)
+        key = self._function_key(func)
+        if key is None:
+            # can't index it, check every callback
+            possible = callbacks.values()
+        else:
+            id_ = self.signal_functions[name].get(key)
+            possible = [callbacks[id_]] if id_ in callbacks else []
+        for callback in possible:
             if callback.compare_function(func):
                 raise ValueError("signal %s already connected to %s" %
                         (name, func))
 
+    def _add_callback(self, name, func, callback):
+        id_ = self.id_generator.next()
+        self.get_callbacks(name)[id_] = callback
+        callback.function_key = self._function_key(func)
+        if callback.function_key is not None:
+            self.signal_functions[name][callback.function_key] = id_
+        return (name, id_)
+
+    def _forget_callback(self, name, id_):
+        callback = self.signal_callbacks[name].pop(id_)
+        functions = self.signal_functions[name]
+        if functions.get(callback.function_key) == id_:
+            del functions[callback.function_key]
+
+    def _on_weak_reference_dead(self, ref):
+        self._dead_weak_references = True
+
     def connect(self, name, func, *extra_args):
         """Connect a callback to a signal.  Returns an callback handle that
         can be passed into disconnect().
@@ -134,10 +183,7 @@ class SignalEmitter(object):
         raised.
         """
         self._check_already_connected(name, func)
-        id_ = self.id_generator.next()
-        callbacks = self.get_callbacks(name)
-        callbacks[id_] = Callback(func, extra_args)
-        return (name, id_)
+        return self._add_callback(name, func, Callback(func, extra_args))
 
     def connect_weak(self, name, method, *extra_args):
         """Connect a callback weakly.  Callback must be a method of some
@@ -150,10 +196,15 @@ class SignalEmitter(object):
         self._check_already_connected(name, method)
         if not hasattr(method, 'im_self'):
             raise TypeError("connect_weak must be called with object methods")
-        id_ = self.id_generator.next()
-        callbacks = self.get_callbacks(name)
-        callbacks[id_] = WeakCallback(method, extra_args)
-        return (name, id_)
+        # use a weak reference to ourself too, so that the callback doesn't
+        # keep us alive
+        self_ref = weakref.ref(self)
+        def on_dead(ref):
+            emitter = self_ref()
+            if emitter is not None:
+                emitter._on_weak_reference_dead(ref)
+        return self._add_callback(name, method,
+                                  WeakCallback(method, extra_args, on_dead))
 
     def disconnect(self, callback_handle):
         """Disconnect a signal.  callback_handle must be the return value from
@@ -161,7 +212,7 @@ class SignalEmitter(object):
         """
         callbacks = self.get_callbacks(callback_handle[0])
         if callback_handle[1] in callbacks:
-            del callbacks[callback_handle[1]]
+            self._forget_callback(*callback_handle)
         else:
             logging.warning(
                 "disconnect called but callback_handle not in the callback")
@@ -169,6 +220,7 @@ class SignalEmitter(object):
     def disconnect_all(self):
         for signal in self.signal_callbacks:
             self.signal_callbacks[signal] = {}
+            self.signal_functions[signal] = {}
 
     def emit(self, name, *args):
         if self._frozen:
@@ -181,30 +233,30 @@ class SignalEmitter(object):
             callback_returned_true = self._run_signal(name, args)
         finally:
             self._currently_emitting.discard(name)
-            self.clear_old_weak_references()
+            if self._dead_weak_references:
+                self.clear_old_weak_references()
         return callback_returned_true
 
     def _run_signal(self, name, args):
         callback_returned_true = False
-        try:
-            self_callback = getattr(self, 'do_' + name.replace('-', '_'))
-        except AttributeError:
-            pass
-        else:
+        callbacks = self.get_callbacks(name)
+        self_callback = getattr(self, self.signal_handler_names[name], None)
+        if self_callback is not None:
             if self_callback(*args):
                 callback_returned_true = True
         if not callback_returned_true:
-            for callback in self.get_callbacks(name).values():
+            for callback in callbacks.values():
                 if callback.invoke(self, args):
                     callback_returned_true = True
                     break
         return callback_returned_true
 
     def clear_old_weak_references(self):
-        for callback_map in self.signal_callbacks.values():
+        self._dead_weak_references = False
+        for name, callback_map in self.signal_callbacks.items():
             for id_ in callback_map.keys():
                 if callback_map[id_].is_dead():
-                    del callback_map[id_]
+                    self._forget_callback(name, id_)
 
 class SystemSignals(SignalEmitter):
     """System wide signals for Miro.  These can be accessed from the singleton
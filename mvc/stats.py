@@ -0,0 +1,246 @@
+"""stats.py -- Aggregate progress of a ConversionManager.
+
+ConversionStats keeps running totals over all the conversions given to a
+ConversionManager: how many are in each state, how many seconds of media
+there are to convert and have been converted, the bytes read and written,
+and how fast we're going.  The totals are updated as each conversion
+changes, so reading them never has to look at every conversion.
+
+StatsServer serves the totals as JSON over HTTP on the loopback interface,
+so that a dashboard can follow a headless run.
+"""
+
+import BaseHTTPServer
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+STATUSES = ('initialized', 'converting', 'staging', 'finished', 'failed',
+            'canceled')
+# statuses that still have work to do
+ACTIVE_STATUSES = ('initialized', 'converting', 'staging')
+
+# what we remember about each conversion, so that we can take back its
+# contribution to the totals when it changes.  known is False if we don't
+# know the duration yet, for example for a Job that hasn't been probed.
+_Entry = collections.namedtuple('_Entry', 'status duration known progress '
+                                'bytes_in bytes_out')
+
+def _get_size(path):
+    try:
+        return os.stat(path).st_size
+    except (EnvironmentError, TypeError):
+        return 0
+
+class ConversionStats(object):
+    """Running totals over a set of conversions.
+
+    Conversions and Jobs are tracked together: a Conversion that was
+    created for a Job updates the Job's entry.  A Job counts towards the
+    totals once its VideoFile has been probed; update it again then.  Until
+    every active item's duration is known, the ETA is unknown.
+
+    :param window: number of seconds over which to measure the realtime
+    factor
+    :param clock: function returning the current time, for testing
+    """
+    def __init__(self, window=10.0, clock=time.time):
+        self.window = window
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.counts = dict((status, 0) for status in STATUSES)
+        self.total_seconds = 0.0
+        self.completed_seconds = 0.0
+        self.remaining_seconds = 0.0
+        # number of active items whose duration we don't know yet
+        self.unknown_durations = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # (time, completed_seconds) samples, for the realtime factor
+        self.samples = collections.deque()
+
+    @staticmethod
+    def _get_key(item):
+        return getattr(item, 'job', None) or item
+
+    def _apply(self, entry, sign):
+        # must be called with the lock held
+        self.counts[entry.status] = (self.counts.get(entry.status, 0) +
+                                     sign)
+        self.total_seconds += sign * entry.duration
+        self.completed_seconds += sign * entry.progress
+        if entry.status in ACTIVE_STATUSES:
+            self.remaining_seconds += sign * (entry.duration -
+                                              entry.progress)
+            if not entry.known:
+                self.unknown_durations += sign
+        self.bytes_in += sign * entry.bytes_in
+        self.bytes_out += sign * entry.bytes_out
+
+    def _make_entry(self, item, old):
+        status = item.status
+        if hasattr(item, 'progress'):
+            # a Conversion.  Until ffmpeg tells us the duration, use the one
+            # from probing the file.
+            duration = item.duration
+            if duration is None:
+                duration = getattr(item.video, 'duration', None)
+            progress = item.progress or 0.0
+            filename = item.video.filename
+            known = True
+        else:
+            # a Job, which knows its duration once its VideoFile has been
+            # probed (see ConversionManager.probe_ahead).  Don't probe it
+            # here.
+            video = item.video
+            known = video is not None and video.probed
+            duration = video.duration if known else None
+            progress = None
+            filename = item.filename
+        if duration is None:
+            duration = old.duration if old is not None else 0.0
+        if not known and old is not None:
+            known = old.known
+        if progress is None:
+            progress = old.progress if old is not None else 0.0
+        if status == 'finished':
+            progress = duration
+        if old is not None:
+            bytes_in = old.bytes_in
+            bytes_out = old.bytes_out
+        else:
+            bytes_in = _get_size(filename)
+            bytes_out = 0
+        if status == 'finished' and not bytes_out:
+            bytes_out = _get_size(item.output)
+        return _Entry(status, duration, known, progress, bytes_in,
+                      bytes_out)
+
+    def update(self, item):
+        """Add a Conversion or Job, or update the totals after it changed.
+        """
+        key = self._get_key(item)
+        # work out the new entry outside the lock, since it might stat files
+        old = self.entries.get(key)
+        entry = self._make_entry(item, old)
+        with self.lock:
+            old = self.entries.get(key)
+            if old is not None:
+                self._apply(old, -1)
+            self.entries[key] = entry
+            self._apply(entry, 1)
+            self._add_sample()
+
+    def remove(self, item):
+        """Stop counting a Conversion or Job."""
+        with self.lock:
+            entry = self.entries.pop(self._get_key(item), None)
+            if entry is not None:
+                self._apply(entry, -1)
+                self._add_sample()
+
+    def _add_sample(self):
+        # must be called with the lock held
+        now = self.clock()
+        self.samples.append((now, self.completed_seconds))
+        # keep one sample from before the window, so that we can measure
+        # over all of it
+        while len(self.samples) > 2 and self.samples[1][0] <= now - self.window:
+            self.samples.popleft()
+
+    def get_realtime_factor(self):
+        """Get the seconds of media converted per second recently, or None
+        if we don't know yet.
+        """
+        with self.lock:
+            return self._get_realtime_factor()
+
+    def _get_realtime_factor(self):
+        if len(self.samples) < 2 or not self.counts['converting']:
+            return None
+        now = self.clock()
+        then, completed = self.samples[0]
+        if now <= then:
+            return None
+        return max(self.completed_seconds - completed, 0) / (now - then)
+
+    def all_done(self):
+        """Check if there are conversions and they've all ended."""
+        with self.lock:
+            return (bool(self.entries) and
+                    not any(self.counts[status]
+                            for status in ACTIVE_STATUSES))
+
+    def to_dict(self):
+        """Get the totals, as a dict that can be encoded as JSON."""
+        with self.lock:
+            realtime_factor = self._get_realtime_factor()
+            if self.unknown_durations:
+                # some of the work still to do could be any length
+                eta = None
+            elif not self.remaining_seconds > 0:
+                eta = 0.0
+            elif realtime_factor:
+                eta = self.remaining_seconds / realtime_factor
+            else:
+                eta = None
+            return {
+                'counts': dict(self.counts),
+                'total': len(self.entries),
+                'total_seconds': self.total_seconds,
+                'completed_seconds': self.completed_seconds,
+                'remaining_seconds': self.remaining_seconds,
+                'unknown_durations': self.unknown_durations,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'realtime_factor': realtime_factor,
+                'eta': eta,
+            }
+
+class _StatsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/stats'):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.stats.to_dict())
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+class StatsServer(object):
+    """Serve a ConversionStats as JSON at http://127.0.0.1:<port>/stats.
+
+    :param port: port to listen on, or 0 to pick a free one (see the port
+    attribute)
+    """
+    def __init__(self, stats, port=0, host='127.0.0.1'):
+        self.server = BaseHTTPServer.HTTPServer((host, port), _StatsHandler)
+        self.server.stats = stats
+        self.port = self.server.server_address[1]
+        self.url = 'http://%s:%i/stats' % (host, self.port)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='Stats server')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
@@ -0,0 +1,191 @@
+"""supervisor.py -- Watch the output of running conversion processes.
+
+Rather than running a thread per conversion that blocks reading its pipe,
+Supervisor uses a single thread that select()s over the output pipes of all
+the running processes.  Lines of output are handed to a callback as they
+arrive.  When a pipe hits EOF, its finish callback is run in a small pool
+of worker threads, since finishing a conversion (waiting for the process,
+writing thumbnails, running qtfaststart) can block for a while.
+
+select() only works on pipes on POSIX systems, use is_supported() to check.
+"""
+
+import errno
+import logging
+import os
+import select
+import threading
+
+from mvc import utils
+
+logger = logging.getLogger(__name__)
+
+def is_supported():
+    return os.name == 'posix'
+
+class _Watch(object):
+    def __init__(self, pipe, line_callback, finish_callback):
+        self.pipe = pipe
+        self.line_callback = line_callback
+        self.finish_callback = finish_callback
+        self.splitter = utils.LineSplitter()
+        self.done = False
+
+    def handle_lines(self, lines):
+        for line in lines:
+            if self.done:
+                # keep draining the pipe so the process doesn't block on a
+                # full pipe, but ignore the output.
+                return
+            try:
+                self.done = self.line_callback(line)
+            except Exception:
+                logger.exception('error handling line %r', line)
+
+class Supervisor(object):
+    """Read the output of many processes from a single thread.
+
+    :param finishers: number of threads to use for the finish callbacks
+    """
+    READ_SIZE = 65536
+
+    def __init__(self, finishers=2):
+        self.lock = threading.Lock()
+        self.watches = {}
+        self.thread = None
+        self.closed = False
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.finisher = utils.WorkerPool(finishers, 'Supervisor finisher')
+
+    def watch(self, pipe, line_callback, finish_callback):
+        """Start watching a pipe.
+
+        line_callback is called in the supervisor thread with each line read
+        from pipe.  If it returns True, the rest of the output is read but
+        ignored.
+
+        finish_callback is called without arguments in a worker thread once
+        pipe has been closed by the process.
+        """
+        with self.lock:
+            if self.closed:
+                raise ValueError('supervisor is closed')
+            self.watches[pipe.fileno()] = _Watch(pipe, line_callback,
+                                                 finish_callback)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._thread,
+                                               name='Supervisor')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        self._wakeup()
+
+    def close(self):
+        """Stop the supervisor thread and free its resources.
+
+        Pipes that are still being watched are closed, and their finish
+        callbacks are run as if they had hit EOF.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            thread = self.thread
+        if thread is not None:
+            self._wakeup()
+            if thread is not threading.current_thread():
+                thread.join()
+        for fd in self.watches.keys():
+            self._drop(fd)
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+        self.finisher.shutdown()
+
+    def _wakeup(self):
+        # tell the supervisor thread to re-read the watches
+        os.write(self.wakeup_write, 'x')
+
+    def _thread(self):
+        try:
+            self._run()
+        except Exception:
+            logger.exception('supervisor thread failed')
+        finally:
+            # let the next watch() start a new thread
+            with self.lock:
+                self.thread = None
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if self.closed:
+                    return
+                fds = self.watches.keys()
+            fds.append(self.wakeup_read)
+            try:
+                readable, _, _ = select.select(fds, [], [])
+            except (select.error, EnvironmentError), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                # probably a pipe that was closed from under us.  If we
+                # can't find it, give up rather than spinning.
+                if not self._drop_bad_watches():
+                    raise
+                continue
+            for fd in readable:
+                if fd == self.wakeup_read:
+                    os.read(self.wakeup_read, 4096)
+                    continue
+                try:
+                    self._read(fd)
+                except Exception:
+                    logger.exception('error reading from fd %i', fd)
+                    self._drop(fd)
+
+    def _drop_bad_watches(self):
+        """Stop watching pipes that select() can't handle.
+
+        :returns: True if any were dropped
+        """
+        with self.lock:
+            fds = self.watches.keys()
+        dropped = False
+        for fd in fds:
+            try:
+                select.select([fd], [], [], 0)
+            except (select.error, EnvironmentError, ValueError):
+                logger.exception('cannot select on fd %i', fd)
+                self._drop(fd)
+                dropped = True
+        return dropped
+
+    def _drop(self, fd):
+        # stop watching fd and finish its process as if it had hit EOF
+        with self.lock:
+            watch = self.watches.pop(fd, None)
+        if watch is None:
+            return
+        try:
+            watch.pipe.close()
+        except EnvironmentError:
+            pass
+        self.finisher.add_task(watch.finish_callback)
+
+    def _read(self, fd):
+        with self.lock:
+            watch = self.watches[fd]
+        try:
+            data = os.read(fd, self.READ_SIZE)
+        except EnvironmentError, e:
+            if e.errno == errno.EINTR:
+                return
+            logger.exception('error reading from %r', watch.pipe)
+            data = ''
+        if data:
+            watch.handle_lines(watch.splitter.feed(data))
+            return
+        # EOF
+        watch.handle_lines(watch.splitter.flush())
+        with self.lock:
+            del self.watches[fd]
+        watch.pipe.close()
+        self.finisher.add_task(watch.finish_callback)
@@ -0,0 +1,352 @@
+"""thumbnails.py -- Persistent cache of thumbnail images.
+
+Thumbnails are stored in a single directory, named after a hash of the
+source file's contents and the parameters used to create them.  Hashing
+the contents (rather than the path) means that a thumbnail survives the
+source being moved or copied and is never stale if the source is rewritten.
+Only the size and the first and last blocks of the source are hashed, so
+fingerprinting a large video stays cheap.
+
+Storyboards -- a grid of frames taken evenly through a video, along with a
+JSON index of where each frame came from -- are stored in the same cache.
+
+The cache is limited by the total size of the files in it.  Files are
+evicted in least-recently-used order, which is tracked on disk using the
+file modification times so that it carries over between runs.
+"""
+
+import collections
+import fractions
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from mvc import settings
+from mvc import utils
+
+logger = logging.getLogger(__name__)
+
+class FingerprintCache(utils.ThreadSafeCache):
+    """Remember the fingerprints of files, so that we don't re-read the
+    same file for each thumbnail size.
+
+    Keys are (path, size, mtime) tuples, so a file that changes gets a new
+    fingerprint.
+    """
+    def __init__(self, sample_size, size=1000):
+        utils.ThreadSafeCache.__init__(self, size)
+        self.sample_size = sample_size
+
+    def create_new_value(self, key, invalidator=None):
+        path, size, mtime = key
+        sha1 = hashlib.sha1(str(size))
+        with open(path, 'rb') as f:
+            sha1.update(f.read(self.sample_size))
+            if size > self.sample_size * 2:
+                f.seek(-self.sample_size, os.SEEK_END)
+            sha1.update(f.read(self.sample_size))
+        return sha1.hexdigest()
+
+class ThumbnailCache(object):
+    """Store thumbnails in directory, using at most max_bytes of disk."""
+
+    SAMPLE_SIZE = 65536
+
+    def __init__(self, directory, max_bytes=50 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        # maps cache file name -> size, in least-recently-used order.  Built
+        # from the directory the first time we need it.
+        self.entries = None
+        self.total_bytes = 0
+        self.fingerprints = FingerprintCache(self.SAMPLE_SIZE)
+
+    def fingerprint(self, filename):
+        """Get a hash that identifies the contents of filename."""
+        stat = os.stat(filename)
+        return self.fingerprints.get((os.path.realpath(filename),
+                                      stat.st_size, stat.st_mtime))
+
+    def get_name(self, filename, width, height, skip, type_='.png'):
+        """Get the name of the cache file for a thumbnail."""
+        return self._get_name(filename, '%sx%s@%s' % (width, height, skip),
+                              type_)
+
+    def get_storyboard_names(self, filename, width, height, count, columns):
+        """Get the names of the cache files for a storyboard image and its
+        index.
+        """
+        params = 'storyboard:%sx%s:%i/%i' % (width, height, count, columns)
+        return (self._get_name(filename, params, '.jpg'),
+                self._get_name(filename, params, '.json'))
+
+    def _get_name(self, filename, params, type_):
+        key = '%s:%s' % (self.fingerprint(filename), params)
+        return hashlib.sha1(key).hexdigest() + type_
+
+    def _load(self):
+        # must be called with the lock held
+        if self.entries is not None:
+            return
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        found = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                # partially written file from a previous run
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except EnvironmentError:
+                continue
+            found.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(found):
+            self.entries[name] = size
+            self.total_bytes += size
+
+    def get(self, filename, width, height, skip, type_='.png'):
+        """Get the path to a cached thumbnail.
+
+        :returns: the path, or None if the thumbnail isn't in the cache
+        """
+        return self._get_path(self.get_name(filename, width, height, skip,
+                                            type_))
+
+    def _get_path(self, name):
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            self._load()
+            if name not in self.entries:
+                return None
+            if not os.path.exists(path):
+                # removed from under us
+                self.total_bytes -= self.entries.pop(name)
+                return None
+            self.entries[name] = self.entries.pop(name)
+        try:
+            os.utime(path, None)
+        except EnvironmentError:
+            pass
+        return path
+
+    def create(self, filename, width, height, skip, type_, create_func):
+        """Get a cached thumbnail, creating it if needed.
+
+        create_func is called as create_func(output_path) to write the
+        thumbnail.
+
+        :returns: the path to the thumbnail, or None if it couldn't be
+        created
+        """
+        def create_one(missing):
+            create_func(missing[0][3])
+        return self.create_many(filename, [(width, height, skip)], type_,
+                                create_one)[0]
+
+    def create_many(self, filename, specs, type_, create_func):
+        """Get several cached thumbnails for a file, creating the missing
+        ones with a single call to create_func.
+
+        :param specs: list of (width, height, skip) tuples
+
+        create_func is called as create_func(missing), where missing is a
+        list of (width, height, skip, output_path) tuples for the thumbnails
+        that aren't cached yet.  It should create as many of them as it can.
+
+        :returns: list with the path for each thumbnail in specs, or None for
+        the ones that couldn't be created
+        """
+        paths = [self.get(filename, width, height, skip, type_)
+                 for (width, height, skip) in specs]
+        missing = {}
+        for spec, path in zip(specs, paths):
+            if path is None and spec not in missing:
+                # write to a temporary file first, so that other readers
+                # never see a partial thumbnail
+                missing[spec] = tempfile.mktemp(prefix='.', suffix=type_,
+                                                dir=self.directory)
+        if not missing:
+            return paths
+        created = {}
+        try:
+            create_func([spec + (temp_path,)
+                         for spec, temp_path in missing.items()])
+            for spec, temp_path in missing.items():
+                if os.path.exists(temp_path):
+                    name = self.get_name(filename, *(spec + (type_,)))
+                    created[spec] = self.add(name, temp_path)
+        finally:
+            for temp_path in missing.values():
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+        return [path or created.get(spec) for spec, path in zip(specs, paths)]
+
+    def get_storyboard(self, filename, width, height, count, columns):
+        """Get the paths to a cached storyboard.
+
+        :returns: (image_path, index_path) tuple, or None if the storyboard
+        isn't in the cache
+        """
+        paths = [self._get_path(name) for name in self.get_storyboard_names(
+            filename, width, height, count, columns)]
+        if None in paths:
+            return None
+        return tuple(paths)
+
+    def create_storyboard(self, filename, width, height, count, columns,
+                          create_func):
+        """Get a cached storyboard, creating it if needed.
+
+        create_func is called as create_func(image_path, index_path) to
+        write the storyboard.
+
+        :returns: (image_path, index_path) tuple, or None if the storyboard
+        couldn't be created
+        """
+        paths = self.get_storyboard(filename, width, height, count, columns)
+        if paths is not None:
+            return paths
+        names = self.get_storyboard_names(filename, width, height, count,
+                                          columns)
+        temp_paths = [tempfile.mktemp(prefix='.', suffix=type_,
+                                      dir=self.directory)
+                      for type_ in ('.jpg', '.json')]
+        try:
+            create_func(*temp_paths)
+            if all(os.path.exists(path) for path in temp_paths):
+                return tuple(self.add(name, temp_path)
+                             for name, temp_path in zip(names, temp_paths))
+        finally:
+            for temp_path in temp_paths:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+        return None
+
+    def add(self, name, source_path):
+        """Move the file at source_path into the cache as name."""
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            self._load()
+            if name in self.entries:
+                self.total_bytes -= self.entries.pop(name)
+            os.rename(source_path, path)
+            size = os.path.getsize(path)
+            self.entries[name] = size
+            self.total_bytes += size
+            self.shrink()
+        return path
+
+    def shrink(self):
+        """Remove least-recently-used thumbnails until we fit in
+        max_bytes.
+        """
+        with self.lock:
+            self._load()
+            # never evict the most recently added thumbnail; the caller is
+            # about to use it.
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                name, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except EnvironmentError:
+                    logger.warn('error removing thumbnail %r', name,
+                                exc_info=True)
+
+def get_storyboard_layout(duration, count, columns):
+    """Work out which frames go into a storyboard.
+
+    Frames are taken every interval seconds, starting at offset so that they
+    come from the middle of each section of the video rather than the
+    (often black) first frame.
+
+    :returns: (offset, interval, rows) tuple
+    """
+    interval = float(duration) / count
+    rows = (count + columns - 1) // columns
+    return (interval / 2, interval, rows)
+
+def get_storyboard_rate(duration, count):
+    """Get the frame rate that picks count frames evenly from duration
+    seconds, as a rational that ffmpeg understands (for example "2/15").
+
+    A rational rather than a decimal keeps the frames from drifting off
+    their times in long videos.
+    """
+    milliseconds = max(int(round(duration * 1000)), 1)
+    rate = fractions.Fraction(count * 1000, milliseconds)
+    return '%i/%i' % (rate.numerator, rate.denominator)
+
+def get_storyboard_filter(duration, width, height, count, columns=None,
+                          offset=None):
+    """Get an ffmpeg filter that turns a video into a storyboard.
+
+    The filter picks frames evenly as the video is decoded and tiles them
+    into a single image, so it takes one pass over the video.
+
+    If offset is None, the input should already start at the offset from
+    get_storyboard_layout(), for example by seeking with -ss before -i.
+    Otherwise the filter skips the first offset seconds itself, which is
+    what an extra output of a conversion needs: an output -ss is applied
+    after the frames are picked, and would cut the first one.
+
+    If columns is None, the frames are output separately rather than tiled.
+    """
+    filter_ = ''
+    if offset is not None:
+        filter_ += 'trim=start=%.3f,setpts=PTS-STARTPTS,' % (offset,)
+    # round=up makes each frame the one at the start of its interval, rather
+    # than the last one before the next interval
+    filter_ += 'fps=fps=%s:round=up,scale=%i:%i' % (
+        get_storyboard_rate(duration, count), width, height)
+    if columns is not None:
+        offset, interval, rows = get_storyboard_layout(duration, count,
+                                                       columns)
+        filter_ += ',tile=%ix%i' % (columns, rows)
+    return filter_
+
+def write_storyboard_index(path, duration, width, height, count, columns):
+    """Write the JSON index for a storyboard to path.
+
+    The index gives the size of the grid and the time and position of each
+    frame in the image.
+    """
+    offset, interval, rows = get_storyboard_layout(duration, count, columns)
+    frames = []
+    for i in range(count):
+        frames.append({
+            'time': round(offset + i * interval, 3),
+            'x': (i % columns) * width,
+            'y': (i // columns) * height,
+        })
+    index = {
+        'duration': duration,
+        'width': width,
+        'height': height,
+        'columns': columns,
+        'rows': rows,
+        'frames': frames,
+    }
+    with open(path, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+
+_cache = None
+
+def get_cache():
+    """Get the ThumbnailCache that VideoFile and Conversion use."""
+    global _cache
+    if _cache is None:
+        _cache = ThumbnailCache(os.path.join(settings.get_cache_directory(),
+                                             'thumbnails'))
+    return _cache
+
+def set_cache(cache):
+    """Change the ThumbnailCache that VideoFile and Conversion use."""
+    global _cache
+    _cache = cache
@@ -1,10 +1,11 @@
 import json
-import operator
 import optparse
+import os
 import time
 import sys
 
 import mvc
+from mvc.stats import StatsServer
 from mvc.widgets import app
 from mvc.widgets import initialize
 
@@ -20,6 +21,13 @@ parser.add_option('-l', '--list-converters', action='store_true',
                   help="Print a list of supported converter types.")
 parser.add_option('-c', '--converter', dest='converter',
                   help="Specify the type of conversion to make.")
+parser.add_option('--scratch-dir', dest='scratch_dir',
+                  help=("Write outputs to this directory while converting, "
+                        "and copy them to the output directory when "
+                        "they're done."))
+parser.add_option('--stats-port', type='int', dest='stats_port',
+                  help=("Serve the overall progress as JSON at "
+                        "http://127.0.0.1:<port>/stats (0 picks a port)."))
 
 class Application(mvc.Application):
 
@@ -27,17 +35,30 @@ class Application(mvc.Application):
         (options, args) = parser.parse_args()
 
         if options.list_converters:
-            for c in sorted(self.converter_manager.list_converters(),
-                            key=operator.attrgetter('name')):
+            # find_converters() doesn't need to run the converter scripts,
+            # and leaves out the ones that our ffmpeg can't run
+            for c in self.converter_manager.find_converters():
                 if options.json:
-                    print json.dumps({'name': c.name,
-                                      'identifier': c.identifier})
+                    print json.dumps({'name': c['name'],
+                                      'identifier': c['identifier']})
                 else:
                     print '%s (-c %s)' % (
-                        c.name,
-                        c.identifier)
+                        c['name'],
+                        c['identifier'])
             return
 
+        missing = self.converter_manager.get_missing(options.converter)
+        if missing:
+            message = 'ffmpeg does not support %r: missing %s' % (
+                options.converter,
+                ', '.join('%s %s' % (field[:-1], name)
+                          for (field, name) in missing))
+            if options.json:
+                print json.dumps({'error': message})
+            else:
+                print 'ERROR:', message
+            sys.exit(1)
+
         try:
             self.converter_manager.get_by_id(options.converter)
         except KeyError:
@@ -53,11 +74,23 @@ class Application(mvc.Application):
                 parser.print_help()
             sys.exit(1)
 
-        any_failed = False
+        # a list, so that changed() can update it
+        failed = []
 
-        def changed(c):
+        def changed(job):
+            c = job.conversion
+            if c is None:
+                # the job failed before it could start
+                message = job.error
+                failed.append(job)
+                if options.json:
+                    print json.dumps({'status': 'failed', 'error': message,
+                                      'filename': job.filename})
+                else:
+                    print 'ERROR:', message
+                return
             if c.status == 'failed':
-                any_failed = True
+                failed.append(job)
             if options.json:
                 output = {
                     'filename': c.video.filename,
@@ -90,28 +123,32 @@ class Application(mvc.Application):
                     line = c.status
                 print '%s: %s' % (c.video.filename, line)
 
+        if options.scratch_dir is not None:
+            self.conversion_manager.scratch_dir = os.path.abspath(
+                options.scratch_dir)
+
+        # queue compact jobs, so that we don't probe every file up front
+        self.conversion_manager.listen_jobs(changed)
         for filename in args:
-            try:
-                c = app.start_conversion(filename, options.converter)
-            except ValueError:
-                message = 'could not parse %r' % filename
-                if options.json:
-                    any_failed = True
-                    print json.dumps({'status': 'failed', 'error': message,
-                                      'filename': filename})
-                else:
-                    print 'ERROR:', message
-                continue
-            changed(c)
-            c.listen(changed)
+            self.queue_conversion(filename, options.converter)
+
+        stats_server = None
+        if options.stats_port is not None:
+            stats_server = StatsServer(self.conversion_manager.stats,
+                                       options.stats_port)
+            stats_server.start()
+            print >> sys.stderr, 'serving progress at %s' % (stats_server.url,)
 
         # XXX real mainloop
         while self.conversion_manager.running:
             self.conversion_manager.check_notifications()
             time.sleep(1)
         self.conversion_manager.check_notifications() # one last time
+        if stats_server is not None:
+            stats_server.stop()
+        self.conversion_manager.shutdown()
 
-        sys.exit(0 if not any_failed else 1)
+        sys.exit(0 if not failed else 1)
 
 if __name__ == "__main__":
     initialize(None)
@@ -12,6 +12,7 @@ except ImportError:
     sys.path.append(mvc_path)
     import mvc
 
+import collections
 import copy
 import tempfile
 import urllib
@@ -27,9 +28,10 @@ from mvc.widgets import widgetutil
 from mvc.widgets import app
 
 from mvc.converter import ConverterInfo
-from mvc.video import VideoFile
+from mvc.video import get_video_file
 from mvc.resources import image_path
-from mvc.utils import size_string, round_even, convert_path_for_subprocess
+from mvc.utils import (Cache, size_string, round_even,
+                       convert_path_for_subprocess)
 from mvc import openfiles
 
 BUTTON_FONT = widgetutil.font_scale_from_osx_points(15.0)
@@ -667,6 +669,22 @@ EMPTY_CONVERTER = ConverterInfo("")
 
 
 class ConversionModel(widgetset.TableModel):
+    """Table model with a row for each conversion.
+
+    Rows hold the path to their thumbnail rather than the decoded image;
+    ConversionCellRenderer loads the images it draws through an LRU cache.
+    Thumbnails are only created for rows that have been drawn (and the
+    OVERSCAN rows either side of them), so a long queue doesn't run ffmpeg
+    for files that are never scrolled to.
+
+    Only the thumbnails are virtualized: every row's other values are still
+    stored in the underlying ListStore/table on each update, whether or not
+    the row is visible.  Updates are coalesced by mark_dirty()/flush(), so
+    the cost is one row write per changed conversion per main loop pass.
+    """
+    # number of rows either side of a drawn row to load thumbnails for
+    OVERSCAN = 5
+
     def __init__(self):
         super(ConversionModel, self).__init__(
             'text', # filename
@@ -676,73 +694,158 @@ class ConversionModel(widgetset.TableModel):
             'numeric', # duration
             'numeric', # progress
             'numeric', # eta,
-            'object', # image
+            'object', # thumbnail path
             'object', # the actual conversion
             )
         self.conversion_to_iter = {}
-        self.thumbnail_to_image = {None: widgetset.Image(
-                image_path('audio.png'))}
+        # conversions in row order, and a map of conversion -> index in rows
+        # which is rebuilt when needed after a row is removed
+        self.rows = []
+        self.row_indexes = {}
+        # conversions whose rows have asked for a thumbnail
+        self.thumbnails_wanted = set()
+        # conversions whose rows need updating, in the order they changed
+        # (so new rows get appended in order).  Used as an ordered set.
+        self.dirty = collections.OrderedDict()
+        # conversion -> the status its row was last drawn with
+        self.statuses = {}
 
     def conversions(self):
         return iter(self.conversion_to_iter)
 
+    def has_conversion(self, conversion):
+        return conversion in self.conversion_to_iter
+
     def all_conversions_done(self):
         has_conversions = any(self.conversions())
         all_done = ((set(c.status for c in self.conversions()) -
                      set(['canceled', 'finished', 'failed'])) == set())
         return all_done and has_conversions
 
-    def get_image(self, path):
-        if path not in self.thumbnail_to_image:
-            try:
-                image = widgetset.Image(path)
-            except ValueError:
-                image = self.thumbnail_to_image[None]
-            self.thumbnail_to_image[path] = image
-        return self.thumbnail_to_image[path]
+    def get_row_index(self, conversion):
+        if len(self.row_indexes) != len(self.rows):
+            self.row_indexes = dict((c, i) for i, c in enumerate(self.rows))
+        return self.row_indexes[conversion]
 
-    def update_conversion(self, conversion):
+    def want_thumbnail(self, conversion):
+        """Called when the row for conversion is drawn without a
+        thumbnail.  Starts loading thumbnails for it and the rows around it.
+        """
+        if conversion in self.thumbnails_wanted:
+            return
         try:
-            output_size = os.stat(conversion.output).st_size
-        except OSError:
-            output_size = 0
+            index = self.get_row_index(conversion)
+        except KeyError:
+            # removed
+            return
+        for c in self.rows[max(index - self.OVERSCAN, 0):
+                           index + self.OVERSCAN + 1]:
+            if c not in self.thumbnails_wanted:
+                self.thumbnails_wanted.add(c)
+                app.widgetapp.update_conversion(c)
+
+    def mark_dirty(self, conversion):
+        """Note that conversion's row needs updating, the next time
+        flush() is called.
+        """
+        self.dirty[conversion] = None
+
+    def flush(self):
+        """Update the rows of the conversions passed to mark_dirty().
+
+        :returns: (rows_added, statuses_changed) tuple, saying whether any
+        rows were added and whether any conversion's status changed
+        """
+        dirty, self.dirty = self.dirty, collections.OrderedDict()
+        rows_added = statuses_changed = False
+        for conversion in dirty:
+            if conversion not in self.conversion_to_iter:
+                rows_added = True
+            if self.statuses.get(conversion) != conversion.status:
+                statuses_changed = True
+            self.update_conversion(conversion)
+        return rows_added, statuses_changed
 
+    def update_conversion(self, conversion):
+        self.dirty.pop(conversion, None)
+        self.statuses[conversion] = conversion.status
         def complete():
             # needs to do it on the update_conversion() from app object
             # which calls model_changed() and redraws for us
             app.widgetapp.update_conversion(conversion)
 
+        if conversion in self.thumbnails_wanted:
+            if (app.widgetapp.conversion_manager.create_thumbnails and
+                    conversion.converter.can_create_thumbnail(
+                        conversion.video)):
+                # create the thumbnail for the conversion in the same ffmpeg
+                # run as ours
+                extra = [conversion.get_thumbnail_spec()]
+            else:
+                extra = []
+            thumbnail = conversion.video.get_thumbnail(complete, 90, 70,
+                                                       extra=extra)
+        else:
+            thumbnail = None
+
         values = (conversion.video.filename,
-                  output_size,
+                  conversion.output_size or 0,
                   conversion.converter.name,
                   conversion.status,
                   conversion.duration or 0,
                   conversion.progress or 0,
                   conversion.eta or 0,
-                  self.get_image(conversion.video.get_thumbnail(complete, 90, 70)),
+                  thumbnail,
                   conversion
                   )
         iter_ = self.conversion_to_iter.get(conversion)
         if iter_ is None:
             self.conversion_to_iter[conversion] = self.append(*values)
+            self.row_indexes[conversion] = len(self.rows)
+            self.rows.append(conversion)
         else:
             self.update(iter_, *values)
 
+    def _forget(self, conversion):
+        del self.conversion_to_iter[conversion]
+        self.dirty.pop(conversion, None)
+        self.statuses.pop(conversion, None)
+        self.thumbnails_wanted.discard(conversion)
+        self.row_indexes = {}
+
     def remove(self, iter_):
         conversion = self[iter_][-1]
-        del self.conversion_to_iter[conversion]
+        self._forget(conversion)
+        self.rows.remove(conversion)
+        return super(ConversionModel, self).remove(iter_)
 
-        # XXX If we add/remove too quickly, we could still be processing
-        # thumbnails and this may return null, and the self.thumbnail_to_image
-        # dictionary may get out of sync
-        def complete(path):
-            logging.info('calling completion handler for get_thumbnail on '
-                         'removal')
+    def remove_many(self, conversions):
+        """Remove the rows for several conversions at once.
 
-        thumbnail_path = conversion.video.get_thumbnail(complete, 90, 70)
-        if thumbnail_path:
-            del self.thumbnail_to_image[thumbnail_path]
-        return super(ConversionModel, self).remove(iter_)
+        Unlike calling remove() for each one, this is O(n) overall.  Call
+        start_bulk_change() on the table first if there are a lot of them.
+
+        :returns: set of the conversions that were removed
+        """
+        removed = set()
+        for conversion in conversions:
+            iter_ = self.conversion_to_iter.get(conversion)
+            if iter_ is None or conversion in removed:
+                continue
+            removed.add(conversion)
+            self._forget(conversion)
+            super(ConversionModel, self).remove(iter_)
+        if removed:
+            self.rows = [c for c in self.rows if c not in removed]
+        return removed
+
+    def clear_finished(self):
+        """Remove the rows for conversions that have ended.
+
+        :returns: set of the conversions that were removed
+        """
+        return self.remove_many([c for c in self.rows if c.status in
+                                 ('finished', 'failed', 'canceled')])
 
 
 class IconWithText(cellpack.HBox):
@@ -753,6 +856,101 @@ class IconWithText(cellpack.HBox):
         self.pack(textbox)
 
 
+class ProgressPacker(cellpack.Packer):
+    """Progress bar and percent text for a row that's converting.
+
+    This is the only part of a converting row that changes as the conversion
+    goes on, so it's the only part that gets laid out again on each draw.
+    Its size is the same whatever the progress, so the cached layout
+    around it stays valid.
+    """
+    SPACING = 5
+
+    def __init__(self, renderer, layout_manager):
+        self.renderer = renderer
+        self.layout_manager = layout_manager
+        self.percent = 0
+
+    def set_percent(self, percent):
+        self.percent = percent
+
+    def _calc_size(self):
+        base = self.renderer.progressbar_base
+        text_width, text_height = self.renderer.get_percent_textbox(
+            self.layout_manager, 100).get_size()
+        return (base.width + self.SPACING + text_width,
+                max(base.height, text_height))
+
+    def _layout(self, context, x, y, width, height):
+        base = self.renderer.progressbar_base
+        bar_y = y + round((height - base.height) / 2.0)
+        base.draw(context, x, bar_y, base.width, base.height)
+        bar_width = max(int(self.percent * base.width / 100), 5)
+        self.renderer.draw_progressbar(context, x, bar_y, None, base.height,
+                                       bar_width)
+        textbox = self.renderer.get_percent_textbox(self.layout_manager,
+                                                    self.percent)
+        text_width = textbox.get_size()[0]
+        textbox.draw(context, x + base.width + self.SPACING, y, text_width,
+                     height)
+
+    def _find_child_at(self, x, y, width, height):
+        return None
+
+
+class ThumbnailPacker(cellpack.Packer):
+    """Draws a row's thumbnail.
+
+    Only the path and size are kept; the image itself is looked up in the
+    renderer's thumbnail cache each time it's drawn, so cached layouts don't
+    keep decoded images around.
+    """
+    def __init__(self, renderer, path):
+        self.renderer = renderer
+        self.path = path
+        surface = renderer.get_thumbnail_surface(path)
+        self.width, self.height = surface.width, surface.height
+
+    def _calc_size(self):
+        return self.width, self.height
+
+    def _layout(self, context, x, y, width, height):
+        surface = self.renderer.get_thumbnail_surface(self.path)
+        surface.draw(context, x, y, width, height)
+
+    def _find_child_at(self, x, y, width, height):
+        return None
+
+
+class ThumbnailSurfaceCache(Cache):
+    """Cache decoded thumbnails, limited by their size in memory."""
+    def __init__(self, size, max_bytes, default):
+        Cache.__init__(self, size, max_weight=max_bytes)
+        self.default = default
+
+    def create_new_value(self, path, invalidator=None):
+        try:
+            return widgetset.ImageSurface(widgetset.Image(path))
+        except ValueError:
+            return self.default
+
+    def get_weight(self, path, surface):
+        return surface.width * surface.height * 4
+
+
+class RowLayoutCache(Cache):
+    """Cache the layouts built by a ConversionCellRenderer.
+
+    Keys are the arguments to ConversionCellRenderer.build_layout().
+    """
+    def __init__(self, renderer, size):
+        Cache.__init__(self, size)
+        self.renderer = renderer
+
+    def create_new_value(self, key, invalidator=None):
+        return self.renderer.build_layout(*key)
+
+
 class ConversionCellRenderer(widgetset.CustomCellRenderer):
 
     IGNORE_PADDING = True
@@ -777,15 +975,90 @@ class ConversionCellRenderer(widgetset.CustomCellRenderer):
             image_path("item-error.png")))
     completed = widgetset.ImageSurface(widgetset.Image(
             image_path("item-completed.png")))
+    audio = widgetset.ImageSurface(widgetset.Image(
+            image_path("audio.png")))
 
-    def __init__(self):
+    # memory to use for decoded thumbnails.  Only the visible rows need
+    # theirs, this is enough for a few hundred.
+    THUMBNAIL_CACHE_BYTES = 8 * 1024 * 1024
+    # number of row layouts to keep around.  Enough that scrolling back and
+    # forth through a long queue doesn't rebuild them.
+    LAYOUT_CACHE_SIZE = 1024
+
+    def __init__(self, model):
         super(ConversionCellRenderer, self).__init__()
+        self.model = model
         self.alignment = None
+        # set by layout_bottom() when it lays out a converting row
+        self.progress_packer = None
+        self.layouts = RowLayoutCache(self, self.LAYOUT_CACHE_SIZE)
+        # maps (layout_manager, percent) -> textbox
+        self.percent_textboxes = {}
+        self.thumbnail_surfaces = ThumbnailSurfaceCache(
+            self.LAYOUT_CACHE_SIZE, self.THUMBNAIL_CACHE_BYTES, self.audio)
 
     def get_size(self, style, layout_manager):
         return TABLE_WIDTH, TABLE_HEIGHT
 
+    def get_thumbnail_surface(self, path):
+        if path is None:
+            return self.audio
+        return self.thumbnail_surfaces.get(path)
+
+    def get_percent(self):
+        if not self.duration:
+            return 0
+        return min(int(100 * self.progress / self.duration), 100)
+
+    def get_percent_textbox(self, layout_manager, percent):
+        key = (layout_manager, percent)
+        if key not in self.percent_textboxes:
+            layout_manager.set_text_color(TEXT_COLOR)
+            layout_manager.set_font(ITEM_ICONS_FONTSIZE,
+                                    family=ITEM_ICONS_FONT)
+            self.percent_textboxes[key] = layout_manager.textbox(
+                "%d%%" % percent)
+        return self.percent_textboxes[key]
+
+    def get_layout(self, layout_manager, hotspot):
+        """Get the layout for the row we're about to render.
+
+        Layouts are cached, keyed by everything that changes how the row
+        looks, apart from the progress of a converting row -- that gets
+        filled in by the layout's ProgressPacker when it's drawn.
+
+        :returns: (background, alignment, progress) tuple.  progress is the
+        ProgressPacker, or None if the row isn't converting.
+        """
+        if self.status == 'finished':
+            # only shown once we're done; Conversion.finalize() records it
+            output_size = self.output_size
+        else:
+            output_size = None
+        layout = self.layouts.get((layout_manager,
+                                   os.path.basename(self.input),
+                                   self.thumbnail, self.status, hotspot,
+                                   output_size))
+        progress = layout[2]
+        if progress is not None:
+            progress.set_percent(self.get_percent())
+        return layout
+
     def render(self, context, layout_manager, selected, hotspot, hover):
+        if self.thumbnail is None:
+            # we only make thumbnails for rows that get shown
+            self.model.want_thumbnail(self.conversion)
+        background, self.alignment, progress = self.get_layout(
+            layout_manager, hotspot)
+        background.render_layout(context)
+
+    def build_layout(self, layout_manager, title_text, thumbnail, status,
+                     hotspot, output_size):
+        """Build the layout for a row.  Use get_layout() rather than calling
+        this directly.
+        """
+        layout_manager.reset()
+        self.progress_packer = None
         left_right = cellpack.HBox()
         top_bottom = cellpack.VBox()
         left_right.pack(self.layout_left(layout_manager))
@@ -793,7 +1066,7 @@ class ConversionCellRenderer(widgetset.CustomCellRenderer):
         layout_manager.set_text_color(TEXT_COLOR)
         layout_manager.set_font(ITEM_TITLE_FONTSIZE, bold=True,
                                 family=ITEM_TITLE_FONT)
-        title = layout_manager.textbox(os.path.basename(self.input))
+        title = layout_manager.textbox(title_text)
         title.set_wrap_style('truncated-char')
         alignment = cellpack.Padding(cellpack.TruncatedTextLine(title),
                                      top=25)
@@ -806,11 +1079,11 @@ class ConversionCellRenderer(widgetset.CustomCellRenderer):
         left_right.pack(self.layout_right(layout_manager, hotspot))
 
         alignment = cellpack.Alignment(left_right, yscale=0, yalign=0.5)
-        self.alignment = alignment
 
         background = cellpack.Background(alignment)
         background.set_callback(self.draw_background)
-        background.render_layout(context)
+        progress, self.progress_packer = self.progress_packer, None
+        return background, alignment, progress
 
     @staticmethod
     def draw_background(context, x, y, width, height):
@@ -836,8 +1109,8 @@ class ConversionCellRenderer(widgetset.CustomCellRenderer):
         context.fill()
 
     def layout_left(self, layout_manager):
-        surface = widgetset.ImageSurface(self.thumbnail)
-        return cellpack.Padding(surface, 10, 10, 10, 10)
+        return cellpack.Padding(ThumbnailPacker(self, self.thumbnail),
+                                10, 10, 10, 10)
 
     def layout_right(self, layout_manager, hotspot):
         alignment_kwargs = dict(
@@ -862,24 +1135,8 @@ class ConversionCellRenderer(widgetset.CustomCellRenderer):
     def layout_bottom(self, layout_manager, hotspot):
         layout_manager.set_text_color(TEXT_COLOR)
         if self.status in ('converting', 'staging'):
-            box = cellpack.HBox(spacing=5)
-            stack = cellpack.Stack()
-            stack.pack(cellpack.Alignment(self.progressbar_base,
-                                          yalign=0.5,
-                                          xscale=0, yscale=0))
-            percent = self.progress / self.duration
-            width = max(int(percent * self.progressbar_base.width),
-                        5)
-            stack.pack(cellpack.DrawingArea(
-                    width, self.progressbar_base.height,
-                    self.draw_progressbar, width))
-            box.pack(cellpack.Alignment(stack,
-                                        yalign=0.5,
-                                        xscale=0, yscale=0))
-            textbox = layout_manager.textbox("%d%%" % (
-                        100 * percent))
-            box.pack(textbox)
-            return box
+            self.progress_packer = ProgressPacker(self, layout_manager)
+            return self.progress_packer
         elif self.status == 'initialized': # queued
             vbox = cellpack.VBox()
             vbox.pack_space(2)
@@ -923,9 +1180,10 @@ class ConversionCellRenderer(widgetset.CustomCellRenderer):
             return vbox
 
     def hotspot_test(self, style, layout_manager, x, y, width, height):
-        if self.alignment is None:
-            return
-        hotspot_info = self.alignment.find_hotspot(x, y, width, height)
+        # hotspots are in the same place whichever one is hovered, so any
+        # layout for this row will do
+        alignment = self.get_layout(layout_manager, None)[1]
+        hotspot_info = alignment.find_hotspot(x, y, width, height)
         if hotspot_info:
             return hotspot_info[0]
 
@@ -1023,6 +1281,8 @@ class Application(mvc.Application):
 	mvc.Application.__init__(self, simultaneous)
 	self.create_signal('window-shown')
 	self.sent_window_shown = False
+	# True while a call to flush_conversions() is waiting to run
+	self.flush_scheduled = False
 
     def startup(self):
         if self.started:
@@ -1041,6 +1301,7 @@ class Application(mvc.Application):
 
         # # table on top
         self.model = ConversionModel()
+        self.conversion_manager.listen_batch(self.conversions_changed)
         self.table = widgetset.TableView(self.model)
         self.table.draws_selection = False
         self.table.set_row_spacing(0)
@@ -1049,7 +1310,7 @@ class Application(mvc.Application):
         self.table.set_grid_lines(False, False)
         self.table.set_show_headers(False)
 
-        c = widgetset.TableColumn("Data", ConversionCellRenderer(),
+        c = widgetset.TableColumn("Data", ConversionCellRenderer(self.model),
                         **dict((n, v) for (v, n) in enumerate((
                         'input', 'output_size', 'converter', 'status',
                         'duration', 'progress', 'eta', 'thumbnail',
@@ -1060,17 +1321,6 @@ class Application(mvc.Application):
 
         # bottom buttons
         converter_types = ('apple', 'android', 'other', 'format')
-        converters = {}
-        for c in self.converter_manager.list_converters():
-            media_type = c.media_type
-            if media_type not in converter_types:
-                media_type = 'others'
-            brand = self.converter_manager.converter_to_brand(c)
-            # None = top level.  Otherwise tack on the brand name.
-            if brand is None:
-                converters.setdefault(media_type, set()).add(c)
-            else:
-                converters.setdefault(media_type, set()).add(brand)
 
         self.menus = []
 
@@ -1078,23 +1328,15 @@ class Application(mvc.Application):
         buttons = widgetset.HBox()
 
         for type_ in converter_types:
+            # the menus come sorted from the converter catalog, but "More
+            # Devices" always goes last.
             options = []
             more_devices = None
-            for c in converters[type_]:
-                if isinstance(c, str):
-                    rconverters = self.converter_manager.brand_to_converters(c)
-                    values = []
-                    for r in rconverters:
-                        values.append((r.name, r.identifier))
-                    # yuck
-                    if c == 'More Devices':
-                        more_devices = (c, values)
-                    else:
-                        options.append((c, values))
+            for option in self.converter_manager.get_menu(type_):
+                if option[0] == 'More Devices':
+                    more_devices = option
                 else:
-                    options.append((c.name, c.identifier))
-            # Don't sort if formats..
-            self.sort_converter_menu(type_, options)
+                    options.append(option)
             if more_devices:
                 options.append(more_devices)
             menu = SettingsButton(type_)
@@ -1167,19 +1409,6 @@ class Application(mvc.Application):
         self.window.show()
         self.update_table_size()
 
-    def sort_converter_menu(self, menu_type, options):
-        """Sort a list of converter options for the menus
-
-        :param menu_type: type of the menu
-        :param options: list of (name, menu) tuples, where menu is either a
-        ConverterInfo or list of ConverterInfos.
-        """
-        if menu_type == 'format':
-            order = ['Audio', 'Video', 'Ingest Formats', 'Same Format']
-            options.sort(key=lambda (name, menu): order.index(name))
-        else:
-            options.sort()
-
     def drag_finished(self, widget):
         self.drop_target.set_in_drag(False)
 
@@ -1321,7 +1550,7 @@ class Application(mvc.Application):
         #        # can't write to the destination directory; ask for a new one
         #        self.options.on_destination_clicked(None)
         try:
-            vf = VideoFile(filename)
+            vf = get_video_file(filename)
         except ValueError:
             logging.info('invalid file %r, cannot parse', filename,
                     exc_info=True)
@@ -1330,13 +1559,11 @@ class Application(mvc.Application):
             vf,
             self.current_converter,
             output_dir=self.options.options['destination'])
-        c.listen(self.update_conversion)
         if self.conversion_manager.running:
             # start running automatically if a conversion is already in
             # progress
             self.conversion_manager.run_conversion(c)
         self.update_conversion(c)
-        self.update_table_size()
 
     def on_select_converter(self, widget, identifier):
         self.current_converter = self.converter_manager.get_by_id(identifier)
@@ -1408,20 +1635,13 @@ class Application(mvc.Application):
                 # all done: no conversion job should be running at this point
                 all_done = self.model.all_conversions_done()
                 if all_done:
-                    # take stuff off one by one from the list until we have none!
-                    # might not be very efficient.
-                    iter_ = self.model.first_iter()
-                    while iter_ is not None:
-                        conversion = self.model[iter_][-1]
-                        if conversion.status in ('finished',
-                                                 'failed',
-                                                 'canceled',
-                                                 'initialized'):
-                            try:
-                                self.conversion_manager.remove(conversion)
-                            except ValueError:
-                                pass
-                        iter_ = self.model.remove(iter_)
+                    # every conversion has ended, clear them all out.
+                    # update_table_size() ends the bulk change.
+                    self.table.start_bulk_change()
+                    removed = self.model.clear_finished()
+                    self.conversion_manager.remove_many(removed)
+                    for conversion in removed:
+                        self.conversion_manager.forget(conversion)
                     self.update_table_size()
         else:
             for conversion in self.model.conversions():
@@ -1432,8 +1652,34 @@ class Application(mvc.Application):
         self.convert_button.enable()
 
     def update_conversion(self, conversion):
-        self.model.update_conversion(conversion)
-        self.update_table_size()
+        # Conversions change every time ffmpeg prints a progress line, so
+        # rather than redrawing for each change, note which rows changed and
+        # update them all at once when we get back to the main loop.
+        self.model.mark_dirty(conversion)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            idle_add(self.flush_conversions)
+
+    def conversions_changed(self, conversions):
+        # called once per check_notifications(), so we can redraw straight
+        # away
+        for conversion in conversions:
+            if self.model.has_conversion(conversion):
+                self.model.mark_dirty(conversion)
+        self.flush_conversions()
+
+    def flush_conversions(self):
+        """Update the rows for conversions that changed since the last
+        flush.
+        """
+        self.flush_scheduled = False
+        rows_added, statuses_changed = self.model.flush()
+        if rows_added:
+            self.update_table_size()
+        else:
+            if statuses_changed:
+                self.update_convert_button()
+            self.table.model_changed()
 
     def update_table_size(self):
         conversions = len(self.model)
@@ -1456,9 +1702,10 @@ class Application(mvc.Application):
             reveal_file(conversion.output)
         elif name == 'clear':
             self.model.remove(iter_)
+            self.conversion_manager.forget(conversion)
             self.update_table_size()
         elif name == 'show-log':
-            lines = ''.join(conversion.lines)
+            lines = conversion.lines.get_text()
             d = TextDialog('Log', '', self.window)
             d.set_text(lines)
             try:
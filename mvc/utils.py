@@ -1,8 +1,16 @@
+import collections
 import ctypes
+import errno
+import gzip
 import itertools
 import logging
 import os
+import Queue
+import re
+import shutil
 import sys
+import tempfile
+import threading
 
 def hms_to_seconds(hours, minutes, seconds):
     return (hours * 3600 +
@@ -73,6 +81,162 @@ def line_reader(handle):
     return _readlines()
 
 
+class LineSplitter(object):
+    """Incrementally split data read from a pipe into lines.
+
+    Like line_reader(), this breaks lines on both \\r and \\n and skips
+    empty lines, but it works on chunks of data that we have already read,
+    rather than reading a byte at a time from a handle.
+    """
+    LINE_BREAK_RE = re.compile(r'[\r\n]')
+
+    def __init__(self):
+        self.partial = ''
+
+    def feed(self, data):
+        """Add data and return a list of the lines that it completed."""
+        lines = self.LINE_BREAK_RE.split(self.partial + data)
+        self.partial = lines.pop()
+        return [line for line in lines if line]
+
+    def flush(self):
+        """Return any remaining data as lines, once there's no more input."""
+        partial, self.partial = self.partial, ''
+        if partial:
+            return [partial]
+        return []
+
+
+class WorkerPool(object):
+    """Run functions in a limited number of daemon threads.
+
+    Threads are started as they're needed, up to size.  Once started they
+    wait for more work until shutdown() is called.
+    """
+    def __init__(self, size, name='Worker'):
+        self.size = size
+        self.name = name
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.idle = 0
+
+    def add_task(self, func, *args):
+        with self.lock:
+            if not self.idle and len(self.threads) < self.size:
+                thread = threading.Thread(
+                    target=self._run,
+                    name='%s %i' % (self.name, len(self.threads)))
+                thread.setDaemon(True)
+                self.threads.append(thread)
+                thread.start()
+            self.queue.put((func, args))
+
+    def shutdown(self):
+        """Make the threads exit once they've run the tasks already added,
+        and wait for them.
+        """
+        with self.lock:
+            threads, self.threads = self.threads, []
+            for thread in threads:
+                self.queue.put((None, ()))
+        for thread in threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+            func, args = self.queue.get()
+            with self.lock:
+                self.idle -= 1
+            if func is None:
+                return
+            try:
+                func(*args)
+            except Exception:
+                logging.exception('%s: error running %r', self.name, func)
+
+
+class LineBuffer(object):
+    """Bounded storage for the output lines of a subprocess.
+
+    ffmpeg prints stream information at the start of its output and errors
+    at the end, with (potentially hundreds of thousands of) progress lines
+    in between.  LineBuffer keeps the first head_size lines and the last
+    tail_size lines and drops the rest.
+
+    If spill_path is given, every line is also written to a gzip-compressed
+    log file at that path, so that the complete output can still be shown.
+    Lines appended after close() are only kept in memory.
+    """
+    def __init__(self, head_size=100, tail_size=500, spill_path=None):
+        self.head_size = head_size
+        self.head = []
+        self.tail = collections.deque(maxlen=tail_size)
+        self.dropped = 0
+        self.spill_path = spill_path
+        self.spill_file = None
+        self.closed = False
+
+    def append(self, line):
+        if self.spill_path is not None and not self.closed:
+            self._spill(line)
+        if len(self.head) < self.head_size:
+            self.head.append(line)
+            return
+        if len(self.tail) == self.tail.maxlen:
+            self.dropped += 1
+        self.tail.append(line)
+
+    def _spill(self, line):
+        if self.spill_file is None:
+            try:
+                self.spill_file = gzip.open(self.spill_path, 'wb')
+            except EnvironmentError:
+                logging.warn('LineBuffer: cannot open %r', self.spill_path,
+                             exc_info=True)
+                self.spill_path = None
+                return
+        self.spill_file.write(line + '\n')
+
+    def close(self):
+        # reopening the log would truncate it, so stop spilling for good
+        self.closed = True
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+    def __iter__(self):
+        return itertools.chain(self.head, self.tail)
+
+    def __len__(self):
+        return len(self.head) + len(self.tail)
+
+    def get_text(self):
+        """Get the buffered output as a single string.
+
+        If we spilled to a log file, the complete output is read back from
+        it.  Otherwise the head and tail are returned, with a marker where
+        lines were dropped.
+        """
+        if self.spill_path is not None:
+            if self.spill_file is not None:
+                self.spill_file.flush()
+            try:
+                with gzip.open(self.spill_path, 'rb') as f:
+                    return f.read()
+            except (EnvironmentError, EOFError):
+                logging.warn('LineBuffer: cannot read %r', self.spill_path,
+                             exc_info=True)
+        lines = list(self.head)
+        if self.dropped:
+            lines.append('[... %i lines omitted ...]' % self.dropped)
+        lines.extend(self.tail)
+        return '\n'.join(lines)
+
+
 class Matrix(object):
     """2 Dimensional matrix.
 
@@ -127,61 +291,208 @@ class Matrix(object):
 
 
 class Cache(object):
-    def __init__(self, size):
+    """Least-recently-used cache.
+
+    Subclasses implement create_new_value() to make the value for a key
+    that isn't in the cache.
+
+    :param size: the most entries to keep
+    :param max_weight: if not None, also keep the total weight of the
+    entries under this.  get_weight() gives the weight of an entry, for
+    example its size in bytes.
+
+    The cache counts hits, misses and evictions, see get_stats().
+    """
+    def __init__(self, size, max_weight=None):
         self.size = size
-        self.dict = {}
-        self.counter = itertools.count()
-        self.access_times = {}
-        self.invalidators = {}
+        self.max_weight = max_weight
+        # maps key -> (value, invalidator, weight), least recently used
+        # first
+        self.entries = collections.OrderedDict()
+        self.total_weight = 0
+        self.hits = self.misses = self.evictions = 0
 
     def get(self, key, invalidator=None):
-        if key in self.dict:
-            existing_invalidator = self.invalidators[key]
-            if (existing_invalidator is None or
-                not existing_invalidator(key)):
-                self.access_times[key] = self.counter.next()
-                return self.dict[key]
+        """Get the value for key, creating it if it's not cached.
 
+        :param invalidator: function called with key when the key is looked
+        up later.  If it returns True, the cached value is thrown away and a
+        new one created.
+        """
+        found, value = self._lookup(key)
+        if found:
+            return value
         value = self.create_new_value(key, invalidator=invalidator)
         self.set(key, value, invalidator=invalidator)
         return value
 
+    def _lookup(self, key):
+        # returns (found, value)
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            value, invalidator, weight = entry
+            if invalidator is None or not invalidator(key):
+                self.entries[key] = entry
+                self.hits += 1
+                return True, value
+            self.total_weight -= weight
+        self.misses += 1
+        return False, None
+
     def set(self, key, value, invalidator=None):
-        if len(self.dict) == self.size:
-            self.shrink_size()
-        self.access_times[key] = self.counter.next()
-        self.dict[key] = value
-        self.invalidators[key] = invalidator
+        self.remove(key)
+        weight = self.get_weight(key, value)
+        self.entries[key] = (value, invalidator, weight)
+        self.total_weight += weight
+        self.shrink_size()
 
     def remove(self, key):
-        if key in self.dict:
-            del self.dict[key]
-            del self.access_times[key]
-        if key in self.invalidators:
-            del self.invalidators[key]
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_weight -= entry[2]
+
+    def clear(self):
+        self.entries.clear()
+        self.total_weight = 0
 
     def keys(self):
-        return self.dict.iterkeys()
+        return self.entries.iterkeys()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
 
     def shrink_size(self):
-        # shrink by LRU
-        to_sort = self.access_times.items()
-        to_sort.sort(key=lambda m: m[1])
-        new_dict = {}
-        new_access_times = {}
-        new_invalidators = {}
-        latest_times = to_sort[len(self.dict) // 2:]
-        for (key, time) in latest_times:
-            new_dict[key] = self.dict[key]
-            new_invalidators[key] = self.invalidators[key]
-            new_access_times[key] = time
-        self.dict = new_dict
-        self.access_times = new_access_times
+        """Evict least-recently-used entries until we're within our limits.
+
+        The most recently used entry is never evicted, even if it's heavier
+        than max_weight on its own.
+        """
+        while len(self.entries) > 1 and (
+            len(self.entries) > self.size or
+            (self.max_weight is not None and
+             self.total_weight > self.max_weight)):
+            key, (value, invalidator, weight) = self.entries.popitem(
+                last=False)
+            self.total_weight -= weight
+            self.evictions += 1
+
+    def get_stats(self):
+        """Get a dict with the hits, misses and evictions so far, and the
+        current number of entries and total weight.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'weight': self.total_weight,
+        }
+
+    def get_weight(self, key, value):
+        """Get the weight of an entry, for max_weight.  By default every
+        entry weighs 1.
+        """
+        return 1
 
     def create_new_value(self, val, invalidator=None):
         raise NotImplementedError()
 
 
+class ThreadSafeCache(Cache):
+    """Cache that can be used from several threads.
+
+    create_new_value() is called without the lock held, so a slow one
+    doesn't hold up other threads.  Two threads may both create a value for
+    the same key; the last one to finish wins.
+    """
+    def __init__(self, size, max_weight=None):
+        Cache.__init__(self, size, max_weight)
+        self.lock = threading.RLock()
+
+    def _lookup(self, key):
+        with self.lock:
+            return Cache._lookup(self, key)
+
+    def set(self, key, value, invalidator=None):
+        with self.lock:
+            Cache.set(self, key, value, invalidator)
+
+    def remove(self, key):
+        with self.lock:
+            Cache.remove(self, key)
+
+    def clear(self):
+        with self.lock:
+            Cache.clear(self)
+
+    def keys(self):
+        with self.lock:
+            return iter(self.entries.keys())
+
+    def shrink_size(self):
+        with self.lock:
+            Cache.shrink_size(self)
+
+    def get_stats(self):
+        with self.lock:
+            return Cache.get_stats(self)
+
+
+class IndexedQueue(object):
+    """First-in, first-out queue of hashable items that can also remove any
+    item in O(1), rather than O(n) like a deque.
+
+    Each item can only be in the queue once.
+    """
+    def __init__(self, items=()):
+        self.items = collections.OrderedDict()
+        for item in items:
+            self.append(item)
+
+    def append(self, item):
+        if item in self.items:
+            raise ValueError("%r is already queued" % (item,))
+        self.items[item] = None
+
+    def popleft(self):
+        if not self.items:
+            raise IndexError("pop from an empty queue")
+        return self.items.popitem(last=False)[0]
+
+    def remove(self, item):
+        """Remove item from the queue.
+
+        :raises ValueError: if item isn't queued
+        """
+        try:
+            del self.items[item]
+        except KeyError:
+            raise ValueError("%r is not queued" % (item,))
+
+    def remove_many(self, items):
+        """Remove the items that are queued, ignoring the ones that aren't.
+
+        :returns: list of the items that were removed
+        """
+        removed = []
+        for item in items:
+            if self.items.pop(item, True) is None:
+                removed.append(item)
+        return removed
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
 def size_string(nbytes):
     # when switching from the enclosure reported size to the
     # downloader reported size, it takes a while to get the new size
@@ -228,3 +539,123 @@ def convert_path_for_subprocess(path):
         logging.info("convert_path_for_subprocess: got short path %r",
                 short_path_buf.value)
 	return short_path_buf.value.encode('ascii')
+
+def _get_existing_path(path):
+    # the output directory might not have been created yet; look at the
+    # nearest parent that exists instead
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+def get_free_space(path):
+    """Get the number of bytes that we can write to the filesystem holding
+    path.
+
+    path doesn't have to exist yet.  Returns None if we can't tell.
+    """
+    path = _get_existing_path(path)
+    if sys.platform == 'win32':
+        free = ctypes.c_ulonglong(0)
+        if not ctypes.windll.kernel32.GetDiskFreeSpaceExW(
+            unicode(path), ctypes.byref(free), None, None):
+            return None
+        return free.value
+    try:
+        stat = os.statvfs(path)
+    except EnvironmentError:
+        return None
+    return stat.f_bavail * stat.f_frsize
+
+def get_device(path):
+    """Get an id for the filesystem holding path, which doesn't have to
+    exist yet.
+    """
+    try:
+        return os.stat(_get_existing_path(path)).st_dev
+    except EnvironmentError:
+        return None
+
+# bytes to copy at a time when moving a file between filesystems
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def _copy_file(source, outfile):
+    with open(source, 'rb') as f:
+        while True:
+            chunk = f.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            outfile.write(chunk)
+
+def _sync_directory(path):
+    # make the rename of a file in path durable.  Windows doesn't let us
+    # open directories, and doesn't need this.
+    if sys.platform == 'win32':
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except EnvironmentError:
+        return
+    try:
+        os.fsync(fd)
+    except EnvironmentError:
+        pass
+    finally:
+        os.close(fd)
+
+def install_file(source, destination, write_func=None):
+    """Move source to destination, replacing it atomically.
+
+    Readers of destination see either the old file or the complete new one,
+    never a partial copy, and the new one is flushed to disk before it
+    replaces the old one.  source is removed once destination is in place.
+
+    If write_func is given, it's called as write_func(source, outfile) to
+    write the new file, which lets us transform source on the way (for
+    example with qtfaststart) while making a single pass over the data.
+    Otherwise source is renamed if it's on the same filesystem as
+    destination, and copied in large sequential chunks if not.
+
+    If anything goes wrong, destination is left alone and nothing but
+    source is left behind.
+    """
+    directory = os.path.dirname(os.path.abspath(destination))
+    if write_func is None:
+        try:
+            with open(source, 'r+b') as f:
+                os.fsync(f.fileno())
+            _rename(source, destination)
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                raise
+        else:
+            return
+        write_func = _copy_file
+    temp = tempfile.NamedTemporaryFile(dir=directory, prefix='.',
+                                       delete=False)
+    try:
+        with temp:
+            write_func(source, temp)
+            temp.flush()
+            os.fsync(temp.fileno())
+        # NamedTemporaryFile is only readable by us; give the new file the
+        # permissions that source has, as a rename would
+        shutil.copymode(source, temp.name)
+        _rename(temp.name, destination)
+    except:
+        try:
+            os.unlink(temp.name)
+        except EnvironmentError:
+            pass
+        raise
+    _sync_directory(directory)
+    os.unlink(source)
+
+def _rename(source, destination):
+    if sys.platform == 'win32' and os.path.exists(destination):
+        # rename() doesn't replace files on Windows
+        os.unlink(destination)
+    os.rename(source, destination)
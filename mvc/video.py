@@ -1,37 +1,84 @@
+import collections
 import logging
 import os
+import Queue
 import re
-import tempfile
 import threading
+import time
+import weakref
 
 from mvc import execute
+from mvc import thumbnails
 from mvc.widgets import idle_add
 from mvc.settings import get_ffmpeg_executable_path
-from mvc.utils import hms_to_seconds, convert_path_for_subprocess
+from mvc.utils import (hms_to_seconds, convert_path_for_subprocess,
+                       WorkerPool)
 
 logger = logging.getLogger(__name__)
 
+# attributes of VideoFile that come from probing the file with ffmpeg
+PROBED_ATTRIBUTES = ('container', 'video_codec', 'audio_codec', 'width',
+                     'height', 'duration', 'title', 'artist', 'album',
+                     'track', 'genre', 'has_drm')
+
 class VideoFile(object):
-    def __init__(self, filename):
+    """Information about a media file.
+
+    Normally the file is probed when the VideoFile is created.  If lazy is
+    True, probing waits until one of the PROBED_ATTRIBUTES is first used, or
+    until probe_videos() or prefetch_probes() fills them in.  If the file
+    can't be parsed, that first access raises ValueError.
+    """
+    # There can be a VideoFile for every file in a large job list, so we keep
+    # them small by only storing the attributes we know about.
+    __slots__ = ('filename', 'probed', 'thumbnails',
+                 'pending_thumbnails', 'failed_thumbnails',
+                 '__weakref__') + PROBED_ATTRIBUTES
+
+    # seconds to wait before trying again to create a thumbnail that failed
+    THUMBNAIL_RETRY_DELAY = 60
+
+    def __init__(self, filename, lazy=False):
         self.filename = filename
-        self.container = None
-        self.video_codec = None
-        self.audio_codec = None
-        self.width = None
-        self.height = None
-        self.duration = None
+        self.probed = False
         self.thumbnails = {}
-        self.parse()
+        self.pending_thumbnails = set()
+        # key -> time of the last failed attempt
+        self.failed_thumbnails = {}
+        if not lazy:
+            self.parse()
+
+    def __getattr__(self, name):
+        # only called for slots that haven't been set yet, which means that
+        # we haven't been probed.
+        if name in PROBED_ATTRIBUTES:
+            self.parse()
+            return getattr(self, name)
+        raise AttributeError(name)
 
     def parse(self):
-        self.__dict__.update(
-            get_media_info(self.filename))
+        info = get_media_info(self.filename)
+        for key in PROBED_ATTRIBUTES:
+            setattr(self, key, info.get(key))
+        for key in set(info) - set(PROBED_ATTRIBUTES):
+            logger.debug('VideoFile: ignoring %r for %r', key, self.filename)
+        self.probed = True
 
     @property
     def audio_only(self):
         return self.video_codec is None
 
-    def get_thumbnail(self, completion, width=None, height=None, type_='.png'):
+    def get_thumbnail(self, completion, width=None, height=None, type_='.png',
+                      extra=()):
+        """Get a thumbnail for this file.
+
+        If the thumbnail isn't ready yet, this returns None and starts
+        creating it.  completion is called once it's ready.
+
+        :param extra: list of (width, height, skip) tuples for other
+        thumbnails to create in the same ffmpeg run.  These get put in the
+        thumbnail cache, for example so that Conversion can find them.
+        """
         if self.audio_only:
             # don't bother with thumbnails for audio files
             return None
@@ -47,18 +94,109 @@ class VideoFile(object):
 
         key = (width, height, type_)
 
-        def complete(name):
-            self.thumbnails[key] = name
+        def complete(paths):
+            self.pending_thumbnails.discard(key)
+            if paths[0] is None:
+                # maybe ffmpeg failed this time only; try again later
+                self.failed_thumbnails[key] = time.time()
+            else:
+                self.failed_thumbnails.pop(key, None)
+                self.thumbnails[key] = paths[0]
             completion()
 
         if key not in self.thumbnails:
-            temp_path = tempfile.mktemp(suffix=type_)
-            get_thumbnail(self.filename, width, height, temp_path, complete,
-                          skip=skip)
+            failed_at = self.failed_thumbnails.get(key)
+            if (failed_at is not None and
+                time.time() - failed_at < self.THUMBNAIL_RETRY_DELAY):
+                return None
+            # looking in the cache means reading the file to fingerprint it,
+            # so that's done by the worker as well, rather than blocking the
+            # caller (normally the GUI thread).  A cached thumbnail comes
+            # back without running ffmpeg.
+            if key not in self.pending_thumbnails:
+                self.pending_thumbnails.add(key)
+                specs = [(width, height, skip)] + list(extra)
+                get_cached_thumbnails(self.filename, specs, complete,
+                                      type_=type_)
             return None
 
         return self.thumbnails.get(key)
 
+class VideoFileRegistry(object):
+    """Share VideoFiles across the process, so that each file is only probed
+    once however many times it's added.
+
+    VideoFiles are keyed by their real path, size and modification time, so
+    a file that has been changed gets a new VideoFile.  They're held with
+    weak references, except for the keep most recently used ones, so that a
+    file that's removed and added again can still reuse its probe.
+    """
+    def __init__(self, keep=100):
+        self.lock = threading.Lock()
+        self.videos = weakref.WeakValueDictionary()
+        self.recent = collections.deque(maxlen=keep)
+
+    def get_key(self, filename):
+        path = os.path.realpath(filename)
+        try:
+            stat = os.stat(path)
+        except EnvironmentError:
+            return None
+        return (path, stat.st_size, stat.st_mtime)
+
+    def get(self, filename, lazy=False):
+        """Get the VideoFile for filename.
+
+        :raises ValueError: if lazy is False and the file can't be parsed
+        """
+        key = self.get_key(filename)
+        if key is None:
+            # let VideoFile report the error
+            return VideoFile(filename, lazy=lazy)
+        with self.lock:
+            video = self.videos.get(key)
+        if video is None:
+            video = VideoFile(filename, lazy=lazy)
+            with self.lock:
+                # another thread may have beaten us to it
+                video = self.videos.setdefault(key, video)
+        elif not lazy and not video.probed:
+            video.parse()
+        with self.lock:
+            self.recent.append(video)
+        return video
+
+    def invalidate(self, filename=None):
+        """Forget the VideoFiles for filename, or for every file if filename
+        is None.
+
+        Call this when a file is changed in a way that might not show up in
+        its size and modification time, for example when it's replaced by a
+        conversion output.
+        """
+        with self.lock:
+            if filename is None:
+                self.videos.clear()
+                self.recent.clear()
+                return
+            path = os.path.realpath(filename)
+            for key in self.videos.keys():
+                if key[0] == path:
+                    del self.videos[key]
+            for video in list(self.recent):
+                if os.path.realpath(video.filename) == path:
+                    self.recent.remove(video)
+
+_registry = VideoFileRegistry()
+
+def get_video_file(filename, lazy=False):
+    """Get the shared VideoFile for filename; see VideoFileRegistry."""
+    return _registry.get(filename, lazy=lazy)
+
+def invalidate_video_file(filename=None):
+    """Forget the shared VideoFile for filename, or for every file."""
+    _registry.invalidate(filename)
+
 class Node(object):
     def __init__(self, line="", children=None):
         self.line = line
@@ -258,30 +396,230 @@ def get_media_info(filepath):
     logger.info('get_media_info: %r', info)
     return info
 
+def probe_videos(videos, threads=4):
+    """Probe several lazy VideoFiles, running up to threads ffmpeg processes
+    at once.  Files that have already been probed are skipped.
+
+    :returns: dict mapping VideoFile -> exception for the files that
+    couldn't be parsed
+    """
+    pending = Queue.Queue()
+    for video in videos:
+        if not video.probed:
+            pending.put(video)
+    errors = {}
+
+    def run():
+        while True:
+            try:
+                video = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                video.parse()
+            except Exception, e:
+                errors[video] = e
+
+    workers = [threading.Thread(target=run, name='Probe %i' % i)
+               for i in range(min(threads, pending.qsize()))]
+    for thread in workers:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return errors
+
+# background probes are limited in the same way as thumbnails, so that they
+# don't compete too much with running conversions.
+probe_pool = WorkerPool(2, 'Probe')
+
+def prefetch_probes(videos):
+    """Start probing lazy VideoFiles in the background.
+
+    Errors are ignored here; they get raised again when the VideoFile's
+    attributes are used.
+    """
+    def probe(video):
+        if video.probed:
+            return
+        try:
+            video.parse()
+        except Exception:
+            logger.debug('prefetch_probes: error probing %r', video.filename,
+                         exc_info=True)
+    for video in videos:
+        if not video.probed:
+            probe_pool.add_task(probe, video)
+
+# thumbnails are created by a limited number of threads, so that adding a
+# lot of files at once doesn't start a lot of ffmpeg processes at once.
+thumbnail_pool = WorkerPool(2, 'Thumbnail')
+
 def get_thumbnail(filename, width, height, output, completion, skip=0):
-    name = 'Thumbnail - %r @ %sx%s' % (filename, width, height)
     def run():
-	rv = get_thumbnail_synchronous(filename, width, height, output, skip)
-	idle_add(lambda: completion(rv))
-    t = threading.Thread(target=run, name=name)
-    t.start()
+        rv = get_thumbnail_synchronous(filename, width, height, output, skip)
+        idle_add(lambda: completion(rv))
+    thumbnail_pool.add_task(run)
+
+def get_cached_thumbnails(filename, specs, completion, type_='.png'):
+    """Like get_thumbnail(), but create several thumbnails in the thumbnail
+    cache rather than writing to a given output path.
+
+    completion is called with the list of paths returned by
+    get_cached_thumbnails_synchronous().
+    """
+    def run():
+        try:
+            rv = get_cached_thumbnails_synchronous(filename, specs, type_)
+        except Exception:
+            # still call completion, so that the caller doesn't wait for
+            # these thumbnails forever
+            logger.exception('get_cached_thumbnails: error creating '
+                             'thumbnails for %r', filename)
+            rv = [None] * len(specs)
+        idle_add(lambda: completion(rv))
+    thumbnail_pool.add_task(run)
+
+def get_cached_thumbnails_synchronous(filename, specs, type_='.png'):
+    """Get thumbnails from the thumbnail cache, creating the missing ones
+    with a single ffmpeg run.
+
+    :param specs: list of (width, height, skip) tuples
+    :returns: list with the path for each thumbnail, or None for the ones
+    that couldn't be created
+    """
+    def create(missing):
+        get_thumbnails_synchronous(filename, missing)
+    return thumbnails.get_cache().create_many(filename, specs, type_, create)
+
+def get_cached_thumbnail_synchronous(filename, width, height, skip=0,
+                                     type_='.png'):
+    """Get the path to a thumbnail in the thumbnail cache, creating it if
+    needed.
+
+    :returns: the path to the thumbnail, or None if it couldn't be created
+    """
+    return get_cached_thumbnails_synchronous(filename,
+                                             [(width, height, skip)],
+                                             type_)[0]
 
 def get_thumbnail_synchronous(filename, width, height, output, skip=0):
+    return get_thumbnails_synchronous(filename,
+                                      [(width, height, skip, output)])[0]
+
+def get_thumbnails_synchronous(filename, specs):
+    """Create several thumbnails of a file with a single ffmpeg run.
+
+    The file is opened once for each distinct skip value and each of those
+    inputs is split and scaled to all the sizes wanted from it, so it only
+    gets decoded once per timestamp.
+
+    :param specs: list of (width, height, skip, output) tuples
+    :returns: list with the output path for each thumbnail that was created,
+    or None for the ones that weren't
+    """
     executable = get_ffmpeg_executable_path()
-    filter_ = 'scale=%i:%i' % (width, height)
+    path = convert_path_for_subprocess(filename)
+    skips = sorted(set(skip for (width, height, skip, output) in specs))
+    commandline = [executable]
+    filters = []
+    output_args = []
     # bz19571: temporary disable: libav ffmpeg does not support this filter
     #if 'ffmpeg' in executable:
     #    # supports the thumbnail filter, we hope
     #    filter_ = 'thumbnail,' + filter_
-    commandline = [executable,
-                   '-ss', str(skip),
-		   '-i', convert_path_for_subprocess(filename),
-		   '-vf', filter_, '-vframes', '1', output]
+    for input_index, skip in enumerate(skips):
+        commandline.extend(['-ss', str(skip), '-i', path])
+        group = [(width, height, output)
+                 for (width, height, spec_skip, output) in specs
+                 if spec_skip == skip]
+        if len(group) == 1:
+            sources = ['[%i:v]' % input_index]
+        else:
+            sources = ['[s%i_%i]' % (input_index, i)
+                       for i in range(len(group))]
+            filters.append('[%i:v]split=%i%s' % (input_index, len(group),
+                                                 ''.join(sources)))
+        for source, (width, height, output) in zip(sources, group):
+            label = '[t%i]' % (len(output_args),)
+            filters.append('%sscale=%i:%i%s' % (source, width, height, label))
+            output_args.append(['-map', label, '-vframes', '1', output])
+    commandline.extend(['-filter_complex', ';'.join(filters)])
+    for args in output_args:
+        commandline.extend(args)
+    try:
+        execute.check_output(commandline)
+    except execute.CalledProcessError, e:
+        logger.exception('error calling %r\ncode:%s\noutput:%s',
+                         commandline, e.returncode, e.output)
+    return [output if os.path.exists(output) else None
+            for (width, height, skip, output) in specs]
+
+def get_storyboard_synchronous(filename, duration, output, index_output,
+                               width, height, count=16, columns=4):
+    """Create a storyboard of a video.
+
+    The storyboard is a single image with count frames, taken evenly through
+    the video and tiled in a grid with columns columns.  A JSON index of the
+    frames is written to index_output (see
+    thumbnails.write_storyboard_index()).
+
+    :returns: (output, index_output) tuple, or None if the storyboard
+    couldn't be created
+    """
+    offset, interval, rows = thumbnails.get_storyboard_layout(duration,
+                                                              count, columns)
+    commandline = [get_ffmpeg_executable_path(),
+                   '-ss', '%.3f' % (offset,),
+                   '-i', convert_path_for_subprocess(filename),
+                   '-an', '-vf', thumbnails.get_storyboard_filter(
+                       duration, width, height, count, columns),
+                   '-vframes', '1', output]
+    try:
+        execute.check_output(commandline)
+    except execute.CalledProcessError, e:
+        logger.exception('error calling %r\ncode:%s\noutput:%s',
+                         commandline, e.returncode, e.output)
+        return None
+    if not os.path.exists(output):
+        return None
+    thumbnails.write_storyboard_index(index_output, duration, width, height,
+                                      count, columns)
+    return (output, index_output)
+
+def tile_storyboard_synchronous(frame_pattern, output, count=16, columns=4):
+    """Tile the separate frames of a storyboard into a single image.
+
+    :param frame_pattern: pattern for the frame filenames, for example
+    "frames/%03d.jpg"
+    :returns: output, or None if the storyboard couldn't be created
+    """
+    rows = (count + columns - 1) // columns
+    frame_dir = convert_path_for_subprocess(os.path.dirname(frame_pattern))
+    commandline = [get_ffmpeg_executable_path(),
+                   '-i', os.path.join(frame_dir,
+                                      os.path.basename(frame_pattern)),
+                   '-vf', 'tile=%ix%i' % (columns, rows),
+                   '-vframes', '1', output]
     try:
-	execute.check_output(commandline)
+        execute.check_output(commandline)
     except execute.CalledProcessError, e:
-	logger.exception('error calling %r\ncode:%s\noutput:%s',
-			  commandline, e.returncode, e.output)
-	return None
-    else:
-	return output
+        logger.exception('error calling %r\ncode:%s\noutput:%s',
+                         commandline, e.returncode, e.output)
+        return None
+    if not os.path.exists(output):
+        return None
+    return output
+
+def get_cached_storyboard_synchronous(filename, duration, width, height,
+                                      count=16, columns=4):
+    """Get a storyboard from the thumbnail cache, creating it if needed.
+
+    :returns: (image_path, index_path) tuple, or None if the storyboard
+    couldn't be created
+    """
+    def create(output, index_output):
+        get_storyboard_synchronous(filename, duration, output, index_output,
+                                   width, height, count, columns)
+    return thumbnails.get_cache().create_storyboard(filename, width, height,
+                                                    count, columns, create)
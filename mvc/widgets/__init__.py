@@ -1,24 +1,56 @@
+"""mvc.widgets -- Platform-independent access to the widget toolkit.
+
+The toolkit (GTK, or Cocoa on OS X) isn't imported until something here
+needs it, so that the console and the conversion code can be used without
+it.  Import mvc.widgets.widgetset to get the toolkit's widget classes.
+"""
+
 import logging
 import os
 import sys
 
-if sys.platform == 'darwin':
-    import osx as plat
-    from .osx import widgetset
-else:
-    import gtk as plat
-    from .gtk import widgetset
-
-attach_menubar = plat.attach_menubar
-mainloop_start = plat.mainloop_start
-mainloop_stop = plat.mainloop_stop
-idle_add = plat.idle_add
-idle_remove = plat.idle_remove
-reveal_file = plat.reveal_file
-get_conversion_directory = plat.get_conversion_directory
+_plat = None
+
+def get_platform():
+    """Get the module for the platform's toolkit, importing it if needed."""
+    global _plat
+    if _plat is None:
+        if sys.platform == 'darwin':
+            import osx as _plat
+        else:
+            import gtk as _plat
+    return _plat
+
+def attach_menubar():
+    return get_platform().attach_menubar()
+
+def mainloop_start():
+    return get_platform().mainloop_start()
+
+def mainloop_stop():
+    return get_platform().mainloop_stop()
+
+def idle_add(callback, periodic=None):
+    return get_platform().idle_add(callback, periodic)
+
+def idle_remove(id_):
+    return get_platform().idle_remove(id_)
+
+def reveal_file(filename):
+    return get_platform().reveal_file(filename)
+
+def _get_base_conversion_directory():
+    if sys.platform == 'darwin':
+        return get_platform().get_conversion_directory()
+    elif sys.platform == 'win32':
+        from mvc.windows import specialfolders
+        return specialfolders.base_movies_directory
+    else:
+        return os.path.expanduser('~')
 
 def get_conversion_directory():
-    return os.path.join(plat.get_conversion_directory(), 'Miro Video Converter')
+    return os.path.join(_get_base_conversion_directory(),
+                        'Miro Video Converter')
 
 def initialize(app):
     try:
@@ -26,4 +58,4 @@ def initialize(app):
     except EnvironmentError, e:
         logging.info('os.makedirs: %s', str(e))
     if app:
-        plat.initialize(app)
+        get_platform().initialize(app)
@@ -1482,7 +1482,16 @@ class TableModel(object):
         self._model.set(iter_, index, self.convert_value_for_gtk(value))
 
     def update(self, iter_, *column_values):
-        self._model[iter_] = self.convert_value_for_gtk(column_values)
+        # only set the columns that changed.  That way GTK gets a single
+        # row-changed signal (or none, if nothing changed) rather than one
+        # for each column, and only redraws the row once.
+        row = self._model[iter_]
+        changes = []
+        for index, value in enumerate(self.convert_row_for_gtk(column_values)):
+            if row[index] != value:
+                changes.extend((index, value))
+        if changes:
+            self._model.set(iter_, *changes)
 
     def remove(self, iter_):
         if self._model.remove(iter_):
@@ -135,7 +135,11 @@ class TableModelBase(signals.SignalEmitter):
         self.emit('row-changed', iter)
 
     def update(self, iter, *column_values):
-        iter.value().update_values(column_values)
+        row = iter.value()
+        if row.values == list(column_values):
+            # nothing to redraw
+            return
+        row.update_values(column_values)
         self.emit('row-changed', iter)
 
     def remove(self, iter):
@@ -1240,7 +1240,10 @@ class TableView(CocoaSelectionOwnerMixin, CocoaScrollbarOwnerMixin, Widget):
             self.model.connect_weak('structure-will-change',
                     self.on_model_structure_change),
         ]
-        self.iters_to_update = []
+        # maps row -> iter for the rows to redraw in model_changed().  Keyed
+        # by row so that a row that changes several times only gets redrawn
+        # once.
+        self.iters_to_update = {}
         self.height_changed = self.reload_needed = False
         self.old_selection = None
         self._resizing = False
@@ -1273,7 +1276,7 @@ class TableView(CocoaSelectionOwnerMixin, CocoaScrollbarOwnerMixin, Widget):
         self.emit('hotspot-clicked', tracker.name, tracker.iter)
 
     def on_row_change(self, model, iter):
-        self.iters_to_update.append(iter)
+        self.iters_to_update[iter.value()] = iter
         if not self.fixed_height:
             self.height_changed = True
         if self.tableview.hotspot_tracker is not None:
@@ -1444,10 +1447,10 @@ class TableView(CocoaSelectionOwnerMixin, CocoaScrollbarOwnerMixin, Widget):
             if self.fixed_height or not self.height_changed:
                 # our rows don't change height, just update cell areas
                 if self.is_tree():
-                    for iter in self.iters_to_update:
+                    for iter in self.iters_to_update.itervalues():
                         self.tableview.reloadItem_(iter.value())
                 else:
-                    for iter in self.iters_to_update:
+                    for iter in self.iters_to_update.itervalues():
                         row = self.row_of_iter(iter)
                         rect = self.tableview.rectOfRow_(row)
                         self.tableview.setNeedsDisplayInRect_(rect)
@@ -1455,7 +1458,7 @@ class TableView(CocoaSelectionOwnerMixin, CocoaScrollbarOwnerMixin, Widget):
                 # our rows can change height inform Cocoa that their heights
                 # might have changed (this will redraw them)
                 index_set = NSMutableIndexSet.alloc().init()
-                for iter in self.iters_to_update:
+                for iter in self.iters_to_update.itervalues():
                     try:
                         index_set.addIndex_(self.row_of_iter(iter))
                     except LookupError:
@@ -1469,7 +1472,7 @@ class TableView(CocoaSelectionOwnerMixin, CocoaScrollbarOwnerMixin, Widget):
         if size_changed:
             self.invalidate_size_request()
         self.height_changed = self.reload_needed = False
-        self.iters_to_update = []
+        self.iters_to_update = {}
 
     def width_for_columns(self, width):
         """If the table is width pixels big, how much width is available for
@@ -0,0 +1,15 @@
+"""mvc.widgets.widgetset -- The widget classes for the platform's toolkit.
+
+Importing this module imports the toolkit's widgetset module and puts it in
+our place, so that code can use "from mvc.widgets import widgetset" without
+mvc.widgets having to import the toolkit up front.
+"""
+
+import sys
+
+if sys.platform == 'darwin':
+    from mvc.widgets.osx import widgetset as _widgetset
+else:
+    from mvc.widgets.gtk import widgetset as _widgetset
+
+sys.modules[__name__] = _widgetset
@@ -73,6 +73,7 @@ def data_files():
     return list(itertools.chain(
         resource_data_files("images"),
         resource_data_files("converters", "*.py"),
+        resource_data_files("converters", "index.json"),
         ffmpeg_data_files(),
         winsparkle_data_files(),
         gtk_theme_data_files(),
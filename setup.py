@@ -26,6 +26,7 @@ setup_args = {
     'package_data': {
         'mvc.resources': [
             'converters/*.py',
+            'converters/index.json',
             'images/*.*',
         ],
     },
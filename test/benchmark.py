@@ -0,0 +1,47 @@
+"""benchmark.py -- Time the ffmpeg output parser.
+
+Runs FFmpegConverterInfo.process_status_line() over the recorded ffmpeg
+output in test/testdata/*.log.  This code runs for every line of output of
+every conversion, so it's worth keeping an eye on.
+
+    $ python2.7 test/benchmark.py [repeat count]
+"""
+
+import glob
+import os.path
+import sys
+import timeit
+
+try:
+    import mvc
+except ImportError:
+    mvc_path = os.path.join(os.path.dirname(__file__), '..')
+    sys.path.append(mvc_path)
+
+from mvc.converter import FFmpegConverterInfo
+
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), 'testdata')
+
+def load_lines(path):
+    with open(path, 'rb') as f:
+        return f.read().replace('\r', '\n').splitlines()
+
+def run(lines):
+    process_status_line = FFmpegConverterInfo.process_status_line
+    for line in lines:
+        process_status_line(None, line)
+
+def main(repeat=200):
+    for path in sorted(glob.glob(os.path.join(TESTDATA_DIR, '*.log'))):
+        lines = load_lines(path)
+        timer = timeit.Timer(lambda: run(lines))
+        best = min(timer.repeat(repeat=3, number=repeat))
+        per_line = best / (repeat * len(lines))
+        print '%s: %i lines, %.2f usec/line' % (
+            os.path.basename(path), len(lines), per_line * 1e6)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
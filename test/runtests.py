@@ -9,6 +9,11 @@ from test_video import *
 from test_converter import *
 from test_conversion import *
 from test_utils import *
+from test_thumbnails import *
+from test_capabilities import *
+from test_signals import *
+from test_stats import *
+from test_supervisor import *
 
 if __name__ == "__main__":
     import unittest
@@ -0,0 +1,152 @@
+import os
+import shutil
+import tempfile
+
+from mvc import capabilities
+import base
+import mock
+
+ENCODERS_OUTPUT = """\
+Encoders:
+ V..... = Video
+ A..... = Audio
+ ------
+ V....D libx264              libx264 H.264 / AVC / MPEG-4 AVC (codec h264)
+ V....D libvpx               libvpx VP8 (codec vp8)
+ A....D aac                  AAC (Advanced Audio Coding)
+"""
+
+MUXERS_OUTPUT = """\
+File formats:
+ D. = Demuxing supported
+ .E = Muxing supported
+ --
+  E 3g2             3GP2 (3GPP2 file format)
+  E mp4             MP4 (MPEG-4 Part 14)
+  E stream_segment,ssegment streaming segment muxer
+  Ed video4linux2,v4l2 Video4Linux2 output device
+"""
+
+FILTERS_OUTPUT = """\
+Filters:
+  T.. = Timeline support
+  A = Audio input/output
+  | = Source or sink filter
+ ... abench            A->A       Benchmark part of a filtergraph.
+ TSC scale             V->V       Scale the input video size.
+ ... tile              V->V       Tile several successive frames together.
+"""
+
+HWACCELS_OUTPUT = """\
+Hardware acceleration methods:
+vdpau
+vaapi
+
+"""
+
+class ParseTest(base.Test):
+    def test_version(self):
+        self.assertEqual(capabilities.parse_version(
+            'ffmpeg version 1.2.1 Copyright (c) 2000-2013 the FFmpeg '
+            'developers\nbuilt on...'), '1.2.1')
+        self.assertEqual(capabilities.parse_version(
+            'ffmpeg version N-45279-g4f8d7c5\n'), 'N-45279-g4f8d7c5')
+
+    def test_encoders(self):
+        self.assertEqual(capabilities.parse_encoders(ENCODERS_OUTPUT),
+                         set(['libx264', 'libvpx', 'aac']))
+
+    def test_muxers(self):
+        self.assertEqual(capabilities.parse_muxers(MUXERS_OUTPUT),
+                         set(['3g2', 'mp4', 'stream_segment', 'ssegment',
+                              'video4linux2', 'v4l2']))
+
+    def test_filters(self):
+        self.assertEqual(capabilities.parse_filters(FILTERS_OUTPUT),
+                         set(['abench', 'scale', 'tile']))
+
+    def test_hwaccels(self):
+        self.assertEqual(capabilities.parse_hwaccels(HWACCELS_OUTPUT),
+                         set(['vdpau', 'vaapi']))
+
+    def test_unsupported_option(self):
+        self.assertEqual(capabilities.parse_encoders(None), None)
+        self.assertEqual(capabilities.parse_filters(None), None)
+
+class CapabilitiesTest(base.Test):
+    def test_get_missing(self):
+        caps = capabilities.Capabilities('1.2', encoders=set(['aac']),
+                                         muxers=set(['mp4']))
+        self.assertEqual(caps.get_missing({'encoders': ['aac', 'libx264'],
+                                           'muxers': ['mp4', 'webm']}),
+                         [('encoders', 'libx264'), ('muxers', 'webm')])
+        # filters is None, so we don't know what's missing
+        self.assertEqual(caps.get_missing({'filters': ['scale']}), [])
+
+    def test_dict(self):
+        caps = capabilities.Capabilities('1.2', encoders=set(['aac']),
+                                         hwaccels=set())
+        copy = capabilities.Capabilities.from_dict(caps.to_dict())
+        self.assertEqual(copy.version, '1.2')
+        self.assertEqual(copy.encoders, set(['aac']))
+        self.assertEqual(copy.muxers, None)
+        self.assertEqual(copy.hwaccels, set())
+
+class CapabilityCacheTest(base.Test):
+    def setUp(self):
+        base.Test.setUp(self)
+        self.temp_dir = tempfile.mkdtemp()
+        self.executable = os.path.join(self.temp_dir, 'ffmpeg')
+        with open(self.executable, 'w') as f:
+            f.write('ffmpeg')
+        self.cache_path = os.path.join(self.temp_dir, 'cache',
+                                       'capabilities.json')
+        patcher = mock.patch('mvc.capabilities.detect_capabilities')
+        self.detect = patcher.start()
+        self.detect.side_effect = lambda executable: (
+            capabilities.Capabilities('1.2', encoders=set(['aac'])))
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+        base.Test.tearDown(self)
+
+    def test_get(self):
+        cache = capabilities.CapabilityCache(self.cache_path)
+        caps = cache.get(self.executable)
+        self.assertEqual(caps.encoders, set(['aac']))
+        self.assertTrue(cache.get(self.executable) is caps)
+        self.assertEqual(self.detect.call_count, 1)
+
+    def test_persistent(self):
+        capabilities.CapabilityCache(self.cache_path).get(self.executable)
+        caps = capabilities.CapabilityCache(self.cache_path).get(
+            self.executable)
+        self.assertEqual(caps.version, '1.2')
+        self.assertEqual(caps.encoders, set(['aac']))
+        self.assertEqual(self.detect.call_count, 1)
+
+    def test_executable_changed(self):
+        capabilities.CapabilityCache(self.cache_path).get(self.executable)
+        with open(self.executable, 'a') as f:
+            f.write(' upgraded')
+        capabilities.CapabilityCache(self.cache_path).get(self.executable)
+        self.assertEqual(self.detect.call_count, 2)
+
+    def test_unknown_version(self):
+        # ffmpeg didn't run properly, so try again next time
+        self.detect.side_effect = lambda executable: (
+            capabilities.Capabilities())
+        cache = capabilities.CapabilityCache(self.cache_path)
+        self.assertEqual(cache.get(self.executable).version, None)
+        self.assertEqual(cache.get(self.executable).version, None)
+        self.assertEqual(self.detect.call_count, 2)
+        self.assertFalse(os.path.exists(self.cache_path))
+
+    def test_corrupt_cache(self):
+        os.makedirs(os.path.dirname(self.cache_path))
+        with open(self.cache_path, 'w') as f:
+            f.write('not json')
+        caps = capabilities.CapabilityCache(self.cache_path).get(
+            self.executable)
+        self.assertEqual(caps.version, '1.2')
@@ -9,8 +9,10 @@ import time
 from mvc import video
 from mvc import converter
 from mvc import conversion
+from mvc import utils
 
 import base
+import mock
 
 
 class FakeConverterInfo(converter.ConverterInfo):
@@ -29,6 +31,33 @@ class FakeConverterInfo(converter.ConverterInfo):
         return json.loads(line)
 
 
+class FakeThumbnailConverterInfo(FakeConverterInfo):
+
+    def can_create_thumbnail(self, video):
+        return True
+
+    def get_thumbnail_arguments(self, video, output, width, height, skip=0):
+        return ['--thumbnail', output]
+
+
+class FakeProgressConverterInfo(FakeConverterInfo):
+
+    def uses_progress_pipe(self):
+        return True
+
+    def get_arguments(self, video, output):
+        return ['-u', os.path.join(
+                os.path.dirname(__file__), 'testdata',
+                'fake_progress_converter.py'),
+                video.filename, output]
+
+    def process_status_line(self, video, line):
+        if line.startswith('Error'):
+            return {'finished': True, 'error': line}
+
+    process_progress_line = converter.FFmpegConverterInfo.process_progress_line
+
+
 class ConversionManagerTest(base.Test):
 
     def setUp(self):
@@ -39,6 +68,7 @@ class ConversionManagerTest(base.Test):
         self.changes = []
 
     def tearDown(self):
+        self.manager.shutdown()
         base.Test.tearDown(self)
         shutil.rmtree(self.temp_dir, ignore_errors=True)
 
@@ -87,6 +117,7 @@ class ConversionManagerTest(base.Test):
         self.assertEqual(c.progress_percent, 1.0)
         self.assertTrue(os.path.exists(c.output))
         self.assertEqual(file(c.output).read(), 'blank')
+        self.assertEqual(c.output_size, len('blank'))
         self.assertEqual(self.changes, [
                 {'status': 'converting', 'duration': 5.0, 'eta': 5.0,
                  'progress': 0.0},
@@ -102,6 +133,18 @@ class ConversionManagerTest(base.Test):
                  'progress': 5.0}
                 ])
 
+    def test_forget(self):
+        filename = os.path.join(self.temp_dir, 'webm-0.webm')
+        shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                        filename)
+        c = self.start_conversion(filename)
+        self.assertEqual(self.manager.stats.to_dict()['counts']['finished'],
+                         1)
+        # clearing a finished conversion stops the stats holding on to it
+        self.manager.forget(c)
+        self.assertEqual(self.manager.stats.entries, {})
+        self.assertEqual(self.manager.stats.to_dict()['total'], 0)
+
     def test_conversion_with_error(self):
         filename = os.path.join(self.temp_dir, 'error.webm')
         shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
@@ -122,6 +165,18 @@ class ConversionManagerTest(base.Test):
         self.assertEqual(c.error, '%r does not exist' % missing)
         self.assertFalse(os.path.exists(c.output))
 
+    def test_conversion_with_unknown_version(self):
+        def get_arguments(video, output):
+            raise ValueError("can't get the ffmpeg version")
+        self.converter.get_arguments = get_arguments
+        filename = os.path.join(self.temp_dir, 'webm-0.webm')
+        shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                        filename)
+        c = self.start_conversion(filename)
+        self.assertEqual(c.status, 'failed')
+        self.assertEqual(c.error, "can't get the ffmpeg version")
+        self.assertFalse(os.path.exists(c.output))
+
     def test_multiple_simultaneous_conversions(self):
         filename = os.path.join(self.temp_dir, 'webm-0.webm')
         shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
@@ -154,6 +209,25 @@ class ConversionManagerTest(base.Test):
         self.assertEqual(c.status, 'finished')
         self.assertEqual(c2.status, 'finished')
 
+    def test_listen_batch(self):
+        batches = []
+        self.manager.listen_batch(lambda changed: batches.append(changed))
+        filename = os.path.join(self.temp_dir, 'webm-0.webm')
+        shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                        filename)
+        c = self.manager.start_conversion(video.VideoFile(filename),
+                                          self.converter)
+        c2 = self.manager.start_conversion(video.VideoFile(filename),
+                                           self.converter)
+        self.spin(5)
+        self.assertEqual(c.status, 'finished')
+        self.assertEqual(c2.status, 'finished')
+        for batch in batches:
+            self.assertTrue(batch)
+            self.assertEqual(len(set(batch)), len(batch))
+        self.assertEqual(set(c for batch in batches for c in batch),
+                         set([c, c2]))
+
     def test_unicode_characters(self):
         for filename in (
             u'"TAKE2\'s" REHEARSAL човен поўны вуграмі',
@@ -188,3 +262,316 @@ class ConversionManagerTest(base.Test):
         self.spin(1)
         self.assertEqual(c.status, 'canceled')
         self.assertEqual(c.error, 'manually stopped')
+
+    def test_remove_many(self):
+        self.manager.simultaneous = 0
+        filename = os.path.join(self.temp_dir, 'webm-0.webm')
+        shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                        filename)
+        jobs = [self.manager.queue_job(filename, self.converter,
+                                       output_dir=self.temp_dir)
+                for i in range(5)]
+        self.assertEqual(self.manager.remove_many(jobs[1:4] + jobs[1:2]),
+                         jobs[1:4])
+        self.assertEqual(list(self.manager.waiting), [jobs[0], jobs[4]])
+        self.manager.remove(jobs[4])
+        self.assertRaises(ValueError, self.manager.remove, jobs[4])
+        self.assertEqual(list(self.manager.waiting), [jobs[0]])
+
+    def test_disk_space(self):
+        self.manager.simultaneous = 2
+        self.converter.get_space_needed = lambda video: 1000
+        self.manager.disk_space_margin = 100
+        filenames = []
+        for i in range(3):
+            filename = os.path.join(self.temp_dir, 'webm-%i.webm' % i)
+            shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                            filename)
+            filenames.append(filename)
+        with mock.patch('mvc.utils.get_free_space', return_value=2000):
+            jobs = [self.manager.queue_job(filename, self.converter,
+                                           output_dir=self.temp_dir)
+                    for filename in filenames]
+            # there's a free slot, but not enough space for the second job
+            self.assertEqual(len(self.manager.in_progress), 1)
+            self.assertEqual(list(self.manager.waiting), jobs[1:])
+            self.spin(10)
+        self.assertEqual([job.status for job in jobs], ['finished'] * 3)
+
+    def test_stats_waiting_jobs(self):
+        self.manager.simultaneous = 1
+        self.manager.check_disk_space = False
+        filenames = []
+        for i in range(3):
+            filename = os.path.join(self.temp_dir, 'webm-%i.webm' % i)
+            shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                            filename)
+            filenames.append(filename)
+        with mock.patch('mvc.conversion.prefetch_probes'):
+            jobs = [self.manager.queue_job(filename, self.converter,
+                                           output_dir=self.temp_dir)
+                    for filename in filenames]
+        self.assertEqual(self.manager.probing_jobs, set(jobs[1:]))
+        # we don't know how long the waiting jobs are yet
+        data = self.manager.stats.to_dict()
+        self.assertEqual(data['unknown_durations'], 2)
+        self.assertEqual(data['eta'], None)
+        # pretend that the background probes finished
+        for job in jobs[1:]:
+            job.video.duration = 5.0
+            job.video.probed = True
+        self.manager.check_notifications()
+        self.assertEqual(self.manager.probing_jobs, set())
+        data = self.manager.stats.to_dict()
+        self.assertEqual(data['unknown_durations'], 0)
+        self.assertTrue(data['remaining_seconds'] >= 10.0)
+        self.spin(10)
+        self.assertEqual([job.status for job in jobs], ['finished'] * 3)
+
+    def test_disk_space_full(self):
+        self.converter.get_space_needed = lambda video: 1000
+        filename = os.path.join(self.temp_dir, 'webm-0.webm')
+        shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                        filename)
+        with mock.patch('mvc.utils.get_free_space', return_value=500):
+            job = self.manager.queue_job(filename, self.converter,
+                                         output_dir=self.temp_dir)
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.error, 'not enough disk space')
+        self.assertEqual(list(self.manager.finished_jobs), [job])
+        self.manager.check_disk_space = False
+        job = self.manager.queue_job(filename, self.converter,
+                                     output_dir=self.temp_dir)
+        self.assertNotEqual(job.conversion, None)
+        self.spin(5)
+
+    def test_scratch_dir(self):
+        scratch_dir = os.path.join(self.temp_dir, 'scratch')
+        self.manager.scratch_dir = scratch_dir
+        filename = os.path.join(self.temp_dir, 'webm-0.webm')
+        shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                        filename)
+        c = self.start_conversion(filename)
+        self.assertEqual(c.status, 'finished')
+        self.assertEqual(os.path.dirname(c.temp_output), scratch_dir)
+        self.assertEqual(file(c.output).read(), 'blank')
+        self.assertEqual(os.listdir(scratch_dir), [])
+
+    def test_scratch_dir_reserved(self):
+        scratch_dir = os.path.join(self.temp_dir, 'scratch')
+        os.mkdir(scratch_dir)
+        # a trailing slash is normalized away
+        self.manager.scratch_dir = scratch_dir + os.sep
+        self.manager.check_disk_space = False
+        self.assertEqual(self.manager.get_scratch_dir(None), scratch_dir)
+        c = mock.Mock(temp_output=os.path.join(scratch_dir, 'temp'),
+                      space_needs=[(scratch_dir + os.sep, 1000)])
+        with open(c.temp_output, 'wb') as f:
+            f.write('x' * 300)
+        self.manager.in_progress.add(c)
+        # what's already written to the temp output isn't reserved again
+        self.assertEqual(self.manager.get_space_reserved(
+            utils.get_device(scratch_dir)), 700)
+
+    def test_scratch_dir_full(self):
+        scratch_dir = os.path.join(self.temp_dir, 'scratch')
+        self.manager.scratch_dir = scratch_dir
+        self.converter.get_space_needed = lambda video: 1000
+        self.converter.get_output_size_guess = lambda video: 1000
+        filename = os.path.join(self.temp_dir, 'webm-0.webm')
+        shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                        filename)
+        def get_free_space(path):
+            if path == scratch_dir:
+                return 0
+            return 10 ** 9
+        with mock.patch('mvc.utils.get_free_space', get_free_space):
+            with mock.patch('mvc.utils.get_device', lambda path: path):
+                job = self.manager.queue_job(filename, self.converter,
+                                             output_dir=self.temp_dir)
+        # there's no room in the scratch directory, so the output is
+        # written next to the final one instead
+        self.assertEqual(job.conversion.scratch_dir, None)
+        self.assertEqual(os.path.dirname(job.conversion.temp_output),
+                         self.temp_dir)
+        self.spin(5)
+        self.assertEqual(job.status, 'finished')
+
+    def test_queue_job(self):
+        self.manager.simultaneous = 1
+        filenames = []
+        for i in range(3):
+            filename = os.path.join(self.temp_dir, 'webm-%i.webm' % i)
+            shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                            filename)
+            filenames.append(filename)
+        changed_jobs = []
+        self.manager.listen_jobs(lambda job: changed_jobs.append(job))
+        jobs = [self.manager.queue_job(filename, self.converter,
+                                       output_dir=self.temp_dir)
+                for filename in filenames]
+        # only the first job has been turned into a Conversion
+        self.assertNotEqual(jobs[0].conversion, None)
+        self.assertEqual(jobs[1].conversion, None)
+        self.assertEqual(list(self.manager.waiting), jobs[1:])
+        # the waiting jobs are probed ahead of time
+        self.assertNotEqual(jobs[1].video, None)
+        self.spin(10)
+        self.assertFalse(self.manager.running)
+        self.assertEqual(list(self.manager.finished_jobs), jobs)
+        for job in jobs:
+            self.assertEqual(job.status, 'finished')
+            self.assertEqual(job.conversion, None)
+            self.assertEqual(job.video, None)
+            self.assertEqual(file(job.output).read(), 'blank')
+            self.assertTrue(job in changed_jobs)
+
+    def test_queue_job_parse_error(self):
+        changed_jobs = []
+        self.manager.listen_jobs(lambda job: changed_jobs.append(job))
+        filename = os.path.join(self.temp_dir, 'does-not-exist.webm')
+        job = self.manager.queue_job(filename, self.converter)
+        self.spin(1)
+        self.assertFalse(self.manager.running)
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.error, 'could not parse %r' % (filename,))
+        self.assertEqual(changed_jobs, [job])
+        self.assertEqual(list(self.manager.finished_jobs), [job])
+
+    def test_inline_thumbnail(self):
+        self.converter = FakeThumbnailConverterInfo('Fake', 320, 240)
+        self.manager.create_thumbnails = True
+        filename = os.path.join(self.temp_dir, 'webm-0.webm')
+        shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                        filename)
+        c = self.start_conversion(filename)
+        self.assertEqual(c.status, 'finished')
+        self.assertEqual(c.progress_percent, 1.0)
+        thumbnail_path = os.path.join(self.temp_dir, 'thumbnails',
+                                      'webm-0.fake.png')
+        self.assertEqual(file(thumbnail_path).read(), 'thumbnail')
+        self.assertFalse(os.path.exists(c.thumbnail_output))
+        self.assertEqual(sorted(os.listdir(self.temp_dir)),
+                         ['thumbnails', 'webm-0.fake.fake', 'webm-0.webm'])
+
+    def test_inline_thumbnail_error(self):
+        self.converter = FakeThumbnailConverterInfo('Fake', 320, 240)
+        self.manager.create_thumbnails = True
+        filename = os.path.join(self.temp_dir, 'error.webm')
+        shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                        filename)
+        c = self.start_conversion(filename)
+        self.assertEqual(c.status, 'failed')
+        self.assertEqual(os.listdir(self.temp_dir), ['error.webm'])
+
+    def test_stall_timeout(self):
+        self.manager.stall_timeout = 0.5
+        filename = os.path.join(self.temp_dir, 'stall.webm')
+        shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                        filename)
+        c = self.start_conversion(filename)
+        self.assertEqual(c.status, 'failed')
+        self.assertTrue(c.error.startswith('stalled'), c.error)
+        self.assertFalse(os.path.exists(c.output))
+
+    def test_log_path(self):
+        self.manager.log_dir = os.path.join(self.temp_dir, 'logs')
+        paths = []
+        for directory in ('one', 'two'):
+            vf = mock.Mock(filename=os.path.join(self.temp_dir, 'a.webm'))
+            c = conversion.Conversion(vf, self.converter, self.manager)
+            c.output = os.path.join(self.temp_dir, directory, 'a.fake')
+            paths.append(c.get_log_path())
+        # same output name, different directories
+        self.assertNotEqual(paths[0], paths[1])
+        for path in paths:
+            self.assertEqual(os.path.dirname(path), self.manager.log_dir)
+            self.assertTrue(os.path.basename(path).startswith('a.fake.'))
+            self.assertTrue(path.endswith('.log.gz'))
+
+    def test_stall_stopped_once(self):
+        self.manager.stall_timeout = 1
+        vf = mock.Mock(filename=os.path.join(self.temp_dir, 'stall.webm'),
+                       duration=5.0)
+        c = conversion.Conversion(vf, self.converter, self.manager)
+        c.status = 'converting'
+        c.started_at = c.last_progress_at = time.time() - 10
+        c.popen = popen = mock.Mock()
+        self.manager.in_progress.add(c)
+        # the process hasn't ended yet the second time round, so the
+        # conversion is still converting; it shouldn't be stopped again
+        self.manager.check_stalled()
+        self.manager.check_stalled()
+        self.assertEqual(popen.kill.call_count, 1)
+        self.assertEqual(c.status, 'converting')
+        self.assertTrue(c.error.startswith('stalled'), c.error)
+
+    def test_time_budget(self):
+        # 5 second duration, so the budget is 0.25 seconds
+        self.manager.time_budget_factor = 0.01
+        self.manager.time_budget_minimum = 0.2
+        filename = os.path.join(self.temp_dir, 'stall.webm')
+        shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                        filename)
+        c = self.start_conversion(filename)
+        self.assertEqual(c.status, 'failed')
+        self.assertTrue(c.error.startswith('timed out'), c.error)
+
+    def test_time_budget_not_exceeded(self):
+        self.manager.stall_timeout = 1
+        self.manager.time_budget_factor = 1
+        self.manager.time_budget_minimum = 1
+        filename = os.path.join(self.temp_dir, 'webm-0.webm')
+        shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                        filename)
+        c = self.start_conversion(filename)
+        self.assertEqual(c.status, 'finished')
+
+    def test_retry_after_stall(self):
+        self.manager.stall_timeout = 0.5
+        self.manager.max_retries = 1
+        self.manager.retry_backoff = 0.1
+        filename = os.path.join(self.temp_dir, 'stall.webm')
+        shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                        filename)
+        c = self.start_conversion(filename, timeout=6)
+        self.assertEqual(c.status, 'failed')
+        self.assertEqual(c.retries, 1)
+        self.assertEqual(self.manager.retry_queue, [])
+        statuses = [change['status'] for change in self.changes]
+        self.assertEqual(statuses.count('failed'), 2)
+
+    def test_progress_pipe(self):
+        self.converter = FakeProgressConverterInfo('Fake')
+        filename = os.path.join(self.temp_dir, 'webm-0.webm')
+        shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                        filename)
+        c = self.start_conversion(filename)
+        self.assertEqual(c.status, 'finished')
+        self.assertEqual(c.progress_percent, 1.0)
+        self.assertEqual([change['progress'] for change in self.changes
+                          if change['status'] == 'converting'][-4:],
+                         [0.1, 0.2, 0.3, 0.4])
+        self.assertTrue(os.path.exists(c.output))
+        self.assertEqual(list(c.lines),
+                         ['this line is only in the log'] * 5)
+
+    def test_progress_pipe_error(self):
+        self.converter = FakeProgressConverterInfo('Fake')
+        filename = os.path.join(self.temp_dir, 'error.webm')
+        shutil.copyfile(os.path.join(self.testdata_dir, 'webm-0.webm'),
+                        filename)
+        c = self.start_conversion(filename)
+        self.assertEqual(c.status, 'failed')
+        self.assertEqual(c.error, 'Error while opening encoder')
+        self.assertFalse(os.path.exists(c.output))
+
+
+class ThreadedConversionManagerTest(ConversionManagerTest):
+    """Run the ConversionManager tests using a thread per conversion, rather
+    than the supervisor.
+    """
+
+    def setUp(self):
+        ConversionManagerTest.setUp(self)
+        self.manager = conversion.ConversionManager(use_supervisor=False)
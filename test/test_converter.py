@@ -1,8 +1,14 @@
 import argparse
 import os.path
+import shutil
+import struct
+import tempfile
 
 from mvc.video import VideoFile
+from mvc import capabilities
 from mvc import converter
+from mvc import execute
+from mvc import resources
 from mvc import settings
 
 import base
@@ -79,6 +85,13 @@ class ConverterManagerTest(base.Test):
     def setUp(self):
         base.Test.setUp(self)
         self.manager = converter.ConverterManager()
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        # don't touch the real converter catalog in startup()
+        patcher = mock.patch('mvc.converter.get_converter_cache_path')
+        patcher.start().return_value = os.path.join(self.temp_dir,
+                                                    'cache.json')
+        self.addCleanup(patcher.stop)
 
     def test_startup(self):
         self.manager.startup()
@@ -100,6 +113,182 @@ class ConverterManagerTest(base.Test):
         self.assertRaises(KeyError, self.manager.get_by_id,
                           'doesnotexist')
 
+    def write_script(self, name, converter_name, media_type='video',
+                     extension='mp4', brand='Brand', size=(320, 240)):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'w') as f:
+            f.write('from mvc.converter import FFmpegConverterInfo\n'
+                    'class Converter(FFmpegConverterInfo):\n'
+                    '    media_type = %r\n'
+                    '    extension = %r\n'
+                    'converter = Converter(%r, %r, %r)\n'
+                    'converters = [(%r, [converter])]\n' % (
+                        media_type, extension, converter_name, size[0],
+                        size[1], brand))
+            if brand is None:
+                f.write('converters = [converter]\n')
+        return path
+
+    def test_converter_index(self):
+        scripts = [self.write_script('one.py', 'One'),
+                   self.write_script('two.py', 'Two', media_type='audio')]
+        index_path = os.path.join(self.temp_dir, 'index.json')
+        converter.write_converter_index(index_path, scripts[:1])
+        self.manager.load_converter_index(index_path, scripts)
+        # two.py isn't in the index, so it's run straight away
+        self.assertEqual(self.manager.converters.keys(), ['two'])
+        self.assertEqual(self.manager.unloaded.keys(), ['one'])
+        self.assertEqual(sorted(self.manager.list_metadata()), [
+            {'identifier': 'one', 'name': 'One', 'brand': 'Brand',
+             'media_type': 'video', 'extension': 'mp4', 'audio_only': False,
+             'width': 320, 'height': 240, 'requirements': {}},
+            {'identifier': 'two', 'name': 'Two', 'brand': 'Brand',
+             'media_type': 'audio', 'extension': 'mp4', 'audio_only': False,
+             'width': 320, 'height': 240, 'requirements': {}},
+            ])
+        one = self.manager.get_by_id('one')
+        self.assertEqual(one.name, 'One')
+        self.assertEqual(self.manager.unloaded, {})
+        self.assertEqual(self.manager.converter_to_brand(one), 'Brand')
+
+    def test_converter_index_missing(self):
+        self.manager.load_converter_index('/does/not/exist.json',
+                                          resources.converter_scripts())
+        self.assertEqual(self.manager.unloaded, {})
+        self.assertTrue(self.manager.converters)
+
+    def test_converter_index_version(self):
+        script = self.write_script('one.py', 'One')
+        index_path = os.path.join(self.temp_dir, 'index.json')
+        index = converter.build_converter_index([script])
+        index['version'] = converter.CONVERTER_CATALOG_VERSION - 1
+        converter.write_converter_index(index_path, index=index)
+        self.assertEqual(converter.read_converter_index(index_path), None)
+        self.manager.load_converter_index(index_path, [script])
+        self.assertEqual(self.manager.converters.keys(), ['one'])
+
+    def test_converter_cache(self):
+        script = self.write_script('one.py', 'One')
+        index_path = os.path.join(self.temp_dir, 'index.json')
+        cache_path = os.path.join(self.temp_dir, 'cache', 'converters.json')
+        converter.write_converter_index(index_path, [script])
+        # the script is touched, but hasn't changed: we can still use the
+        # index, and we save the new mtime in the cache.
+        stat = os.stat(script)
+        os.utime(script, (stat.st_atime, stat.st_mtime + 10))
+        self.manager.load_converter_index(index_path, [script], cache_path)
+        self.assertEqual(self.manager.unloaded.keys(), ['one'])
+        cache = converter.read_converter_index(cache_path)
+        self.assertEqual(cache['scripts']['one.py']['mtime'],
+                         os.stat(script).st_mtime)
+        # the script changes: it gets run, and the cache is updated
+        self.write_script('one.py', 'One Changed')
+        manager = converter.ConverterManager()
+        manager.load_converter_index(index_path, [script], cache_path)
+        self.assertEqual(manager.unloaded, {})
+        self.assertEqual(manager.converters.keys(), ['onechanged'])
+        manager = converter.ConverterManager()
+        manager.load_converter_index(index_path, [script], cache_path)
+        self.assertEqual(manager.unloaded.keys(), ['onechanged'])
+
+    def test_shipped_index_up_to_date(self):
+        # if this fails, run "python -m mvc.converter" to rebuild the index
+        shipped = converter.read_converter_index(resources.converter_index())
+        built = converter.build_converter_index(
+            resources.converter_scripts())
+        self.assertEqual(sorted(shipped['scripts']),
+                         sorted(built['scripts']))
+        for name, entry in built['scripts'].items():
+            self.assertEqual(shipped['scripts'][name]['sha1'], entry['sha1'])
+            self.assertEqual(shipped['scripts'][name]['converters'],
+                             entry['converters'])
+
+    def test_list_converters_loads_scripts(self):
+        self.manager.startup()
+        self.assertTrue(self.manager.unloaded)
+        identifiers = set(c.identifier
+                          for c in self.manager.list_converters())
+        self.assertEqual(self.manager.unloaded, {})
+        self.assertEqual(identifiers,
+                         set(m['identifier']
+                             for m in self.manager.list_metadata()))
+
+    def test_find_converters(self):
+        scripts = [
+            self.write_script('one.py', 'One'),
+            self.write_script('two.py', 'Two', extension='webm',
+                              size=(640, 480)),
+            self.write_script('three.py', 'Three', media_type='audio',
+                              extension='mp3', brand=None),
+            ]
+        index_path = os.path.join(self.temp_dir, 'index.json')
+        converter.write_converter_index(index_path, scripts)
+        self.manager.load_converter_index(index_path, scripts)
+
+        def find(**criteria):
+            return [m['identifier']
+                    for m in self.manager.find_converters(**criteria)]
+        self.assertEqual(find(), ['one', 'three', 'two'])
+        self.assertEqual(find(extension='mp4'), ['one'])
+        self.assertEqual(find(media_type='video'), ['one', 'two'])
+        self.assertEqual(find(size=(640, 480)), ['two'])
+        self.assertEqual(find(brand='Brand'), ['one', 'two'])
+        self.assertEqual(find(brand=None), ['three'])
+        self.assertEqual(find(brand='Brand', extension='webm'), ['two'])
+        self.assertEqual(find(extension='ogg'), [])
+        self.assertRaises(TypeError, find, bitrate=1000)
+        # none of that needed the scripts
+        self.assertEqual(self.manager.converters, {})
+        self.assertEqual([c.identifier for c in
+                          self.manager.brand_to_converters('Brand')],
+                         ['one', 'two'])
+        self.assertEqual(self.manager.unloaded.keys(), ['three'])
+        self.assertEqual(self.manager.brand_to_converters('Nope'), None)
+
+    def test_check_capabilities(self):
+        scripts = [
+            self.write_script('one.py', 'One'),
+            self.write_script('two.py', 'Two', extension='webm'),
+            ]
+        with open(scripts[1], 'a') as f:
+            f.write('converter.parameters = "-vcodec libvpx -f webm"\n')
+        index_path = os.path.join(self.temp_dir, 'index.json')
+        converter.write_converter_index(index_path, scripts)
+        self.manager.load_converter_index(index_path, scripts)
+        self.manager.check_capabilities(capabilities.Capabilities(
+            '1.2', encoders=set(['libx264']), muxers=set(['mp4', 'webm'])))
+        self.assertEqual(self.manager.get_missing('two'),
+                         [('encoders', 'libvpx')])
+        self.assertEqual(self.manager.get_missing('one'), [])
+        self.assertEqual(
+            [m['identifier'] for m in self.manager.find_converters()],
+            ['one'])
+        self.assertEqual(
+            len(self.manager.find_converters(include_unsupported=True)), 2)
+        self.assertEqual(self.manager.get_menu('video'),
+                         [('Brand', [('One', 'one')])])
+        # loading the script keeps the result of the check
+        self.manager.get_by_id('two')
+        self.assertEqual(self.manager.get_missing('two'),
+                         [('encoders', 'libvpx')])
+
+    def test_get_menu(self):
+        self.manager.startup()
+        menu = self.manager.get_menu('format')
+        self.assertEqual([name for (name, submenu) in menu],
+                         converter.ConverterManager.FORMAT_MENU_ORDER)
+        self.assertTrue(('MP4', 'mp4') in dict(menu)['Video'])
+        self.assertTrue(self.manager.get_menu('format') is menu)
+        menu = self.manager.get_menu('apple')
+        self.assertEqual(menu, sorted(menu))
+        self.assertTrue(menu)
+        # building the menus doesn't run any scripts
+        self.assertTrue(self.manager.unloaded)
+        # menus are rebuilt when converters are added
+        self.manager.add_converter(TEST_CONVERTER)
+        self.assertTrue(('Test Converter', 'testconverter') in
+                        self.manager.get_menu('video'))
+
 
 class ConverterInfoTest(base.Test):
 
@@ -116,11 +305,90 @@ class ConverterInfoTest(base.Test):
         self.assertEqual(self.converter_info.get_output_filename(self.video),
                          'mp4-0.testconverter.test')
 
+    def test_get_requirements(self):
+        self.assertEqual(self.converter_info.get_requirements(), {})
+
     def test_get_output_size_guess(self):
         self.assertEqual(self.converter_info.get_output_size_guess(self.video),
                          self.video.duration * self.converter_info.bitrate / 8)
 
 
+def make_atom(atom_type, data):
+    return struct.pack('>L4s', len(data) + 8, atom_type) + data
+
+def make_mp4(media, moov_first=False):
+    """Make a minimal MP4 file with one chunk of media.
+
+    :returns: (data, chunk_offset) tuple
+    """
+    ftyp = make_atom('ftyp', 'isom\0\0\0\0')
+    def make_moov(offset):
+        stco = make_atom('stco', struct.pack('>2LL', 0, 1, offset))
+        for atom_type in ('stbl', 'minf', 'mdia', 'trak', 'moov'):
+            stco = make_atom(atom_type, stco)
+        return stco
+    moov_size = len(make_moov(0))
+    mdat = make_atom('mdat', media)
+    if moov_first:
+        offset = len(ftyp) + moov_size + 8
+        return ftyp + make_moov(offset) + mdat, offset
+    offset = len(ftyp) + 8
+    return ftyp + mdat + make_moov(offset), offset
+
+
+class FinalizeTest(base.Test):
+
+    def setUp(self):
+        base.Test.setUp(self)
+        self.temp_dir = tempfile.mkdtemp()
+        self.temp_output = os.path.join(self.temp_dir, 'temp')
+        self.output = os.path.join(self.temp_dir, 'output.mp4')
+        self.converter_info = converter.FFmpegConverterInfo('MP4 Test')
+        self.converter_info.media_type = 'format'
+        self.converter_info.extension = 'mp4'
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+        base.Test.tearDown(self)
+
+    def write_temp_output(self, data):
+        with open(self.temp_output, 'wb') as f:
+            f.write(data)
+
+    def test_faststart(self):
+        data, offset = make_mp4('media data')
+        self.write_temp_output(data)
+        self.converter_info.finalize(self.temp_output, self.output)
+        output = open(self.output, 'rb').read()
+        self.assertEqual(len(output), len(data))
+        self.assertEqual(output[4:8], 'ftyp')
+        moov_pos = output.index('moov') - 4
+        self.assertTrue(moov_pos < output.index('mdat'))
+        # the chunk offset was moved along by the size of moov
+        new_offset = output.index('media data')
+        stco_pos = output.index('stco') - 4
+        self.assertEqual(struct.unpack('>L', output[stco_pos + 16:
+                                                    stco_pos + 20]),
+                         (new_offset,))
+        self.assertEqual(os.listdir(self.temp_dir), ['output.mp4'])
+
+    def test_already_faststart(self):
+        data, offset = make_mp4('media data', moov_first=True)
+        self.write_temp_output(data)
+        self.converter_info.finalize(self.temp_output, self.output)
+        self.assertEqual(open(self.output, 'rb').read(), data)
+        self.assertEqual(os.listdir(self.temp_dir), ['output.mp4'])
+
+    def test_invalid(self):
+        self.write_temp_output('not an mp4 file')
+        with open(self.output, 'wb') as f:
+            f.write('old output')
+        self.assertRaises(EnvironmentError, self.converter_info.finalize,
+                          self.temp_output, self.output)
+        self.assertEqual(open(self.output, 'rb').read(), 'old output')
+        self.assertEqual(os.listdir(self.temp_dir), ['output.mp4'])
+
+
 class ConverterInfoTestMixin(object):
 
     def setUp(self):
@@ -164,6 +432,154 @@ class FFmpegConverterInfoTest(ConverterInfoTestMixin, base.Test):
         converter_info.dont_upsize = dont_upsize
         return converter_info.get_target_size(mock_video)
 
+    def test_get_requirements(self):
+        self.converter_info.parameters = ('-acodec aac -vcodec libx264 '
+                                          '-c:a aac -f mp4 -crf 22')
+        self.assertEqual(self.converter_info.get_requirements(), {
+            'encoders': ['aac', 'libx264'],
+            'muxers': ['mp4'],
+            })
+        self.converter_info.parameters = ['-vcodec', 'copy', '-f', 'mov']
+        self.assertEqual(self.converter_info.get_requirements(),
+                         {'muxers': ['mov']})
+
+    def test_parse_bitrate(self):
+        self.assertEqual(converter.parse_bitrate('112k'), 112000)
+        self.assertEqual(converter.parse_bitrate('2M'), 2000000)
+        self.assertEqual(converter.parse_bitrate('1.5M'), 1500000)
+        self.assertEqual(converter.parse_bitrate('64000'), 64000)
+        self.assertEqual(converter.parse_bitrate('fast'), None)
+
+    def test_get_bitrate(self):
+        mock_video = mock.Mock(audio_only=False, duration=100,
+                               filename=self.video.filename)
+        self.converter_info.parameters = '-vcodec libvpx -b:v 2M -ab 112k'
+        self.assertEqual(self.converter_info.get_bitrate(mock_video),
+                         2112000)
+        self.assertEqual(
+            self.converter_info.get_output_size_guess(mock_video),
+            2112000 * 100 / 8)
+        self.converter_info.parameters = '-vcodec libvpx -b 512000'
+        self.assertEqual(self.converter_info.get_bitrate(mock_video),
+                         512000 + converter.FFmpegConverterInfo.DEFAULT_AUDIO_BITRATE)
+        self.converter_info.parameters = '-f ogg -vn -acodec libvorbis -ab 64k'
+        self.assertEqual(self.converter_info.get_bitrate(mock_video), 64000)
+
+    def test_get_bitrate_from_input(self):
+        mock_video = mock.Mock(audio_only=False, duration=100,
+                               filename=self.video.filename)
+        input_bitrate = os.path.getsize(self.video.filename) * 8 / 100.0
+        self.converter_info.parameters = '-vcodec copy -acodec copy'
+        self.assertEqual(self.converter_info.get_bitrate(mock_video),
+                         input_bitrate)
+        # with -crf, we can only go by the input until we've made an output
+        self.converter_info.parameters = '-vcodec libx264 -crf 22'
+        self.assertEqual(self.converter_info.get_bitrate(mock_video),
+                         input_bitrate)
+        self.converter_info.record_output_size(mock_video, 1000000)
+        self.assertEqual(self.converter_info.get_bitrate(mock_video), 80000)
+        self.converter_info.record_output_size(mock_video, 2000000)
+        self.assertEqual(self.converter_info.get_bitrate(mock_video), 100000)
+
+    def test_get_space_needed(self):
+        mock_video = mock.Mock(audio_only=False, duration=100)
+        self.converter_info.parameters = '-b:v 1M -ab 128k'
+        self.converter_info.media_type = 'format'
+        self.converter_info.extension = 'webm'
+        self.assertEqual(self.converter_info.get_space_needed(mock_video),
+                         1128000 * 100 / 8)
+        # qtfaststart makes a second copy of mp4 files
+        self.converter_info.extension = 'mp4'
+        self.assertEqual(self.converter_info.get_space_needed(mock_video),
+                         1128000 * 100 / 8 * 2)
+        self.assertEqual(self.converter_info.get_space_needed(
+                mock.Mock(audio_only=False, duration=None)), None)
+
+    def test_get_pcm_bitrate(self):
+        self.assertEqual(converter.get_pcm_bitrate('pcm_s16be'), 1536000)
+        self.assertEqual(converter.get_pcm_bitrate('pcm_s24le', 44100, 6),
+                         44100 * 6 * 24)
+        self.assertEqual(converter.get_pcm_bitrate('pcm_mulaw', 8000, 1),
+                         64000)
+        self.assertEqual(converter.get_pcm_bitrate('aac'), None)
+
+    def test_get_prores_bitrate(self):
+        self.assertEqual(converter.get_prores_bitrate('2', 1920, 1080,
+                                                      29.97), 147000000)
+        self.assertEqual(converter.get_prores_bitrate('hq', 1920, 1080,
+                                                      29.97), 220000000)
+        self.assertEqual(converter.get_prores_bitrate(None, 960, 540,
+                                                      29.97), 36750000)
+
+    def test_get_bitrate_uncompressed(self):
+        mock_video = mock.Mock(audio_only=False, duration=100, width=1280,
+                               height=720, filename=self.video.filename)
+        self.converter_info.parameters = ('-vcodec prores -profile:v 3 '
+                                          '-r 60 -acodec pcm_s24le -ar 96000')
+        width, height = self.converter_info.get_target_size(mock_video)
+        self.assertEqual(self.converter_info.get_bitrate(mock_video),
+                         converter.get_prores_bitrate(3, width, height, 60) +
+                         96000 * 2 * 24)
+
+    def test_get_thumbnail_arguments(self):
+        mock_video = mock.Mock(audio_only=False)
+        self.assertTrue(self.converter_info.can_create_thumbnail(mock_video))
+        output = os.path.join(self.testdata_dir, 'thumbnail.png')
+        self.assertEqual(self.converter_info.get_thumbnail_arguments(
+                mock_video, output, 320, 240),
+                         ['-an', '-vf', 'scale=320:240', '-vframes', '1',
+                          output])
+        self.assertEqual(self.converter_info.get_thumbnail_arguments(
+                mock_video, output, 320, 240, skip=10)[:2],
+                         ['-ss', '10'])
+
+    def test_get_storyboard_arguments(self):
+        mock_video = mock.Mock(audio_only=False, duration=120)
+        pattern = os.path.join(self.testdata_dir, '%03d.jpg')
+        self.assertEqual(self.converter_info.get_storyboard_arguments(
+                mock_video, pattern, 160, 90, 16),
+                         ['-an',
+                          '-vf', 'trim=start=3.750,setpts=PTS-STARTPTS,'
+                          'fps=fps=2/15:round=up,scale=160:90',
+                          '-vframes', '16', pattern])
+
+    def test_storyboard_output(self):
+        # run a real ffmpeg on a video whose frame N has brightness 3 * N,
+        # so that we can tell which frames ended up in the storyboard
+        ffmpeg = settings.get_ffmpeg_executable_path()
+        if ffmpeg is None:
+            self.skipTest('no ffmpeg')
+        temp_dir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(temp_dir, 'source.mkv')
+            execute.check_output([
+                    ffmpeg, '-f', 'lavfi', '-i',
+                    "nullsrc=s=16x16:r=10:d=8,format=gray,geq=lum='N*3'",
+                    '-c:v', 'ffv1', source])
+            mock_video = mock.Mock(audio_only=False, duration=8.0)
+            pattern = os.path.join(temp_dir, '%03d.pgm')
+            execute.check_output(
+                [ffmpeg, '-i', source, '-f', 'null', '-'] +
+                self.converter_info.get_storyboard_arguments(
+                    mock_video, pattern, 16, 16, 4))
+            frames = sorted(name for name in os.listdir(temp_dir)
+                            if name.endswith('.pgm'))
+            self.assertEqual(len(frames), 4)
+            brightness = [ord(open(os.path.join(temp_dir, name),
+                                   'rb').read()[-1])
+                          for name in frames]
+            # frames at 1, 3, 5 and 7 seconds, matching the storyboard index
+            self.assertEqual(brightness, [30, 90, 150, 210])
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def test_can_create_thumbnail_audio(self):
+        self.assertFalse(self.converter_info.can_create_thumbnail(
+                mock.Mock(audio_only=True)))
+        self.converter_info.audio_only = True
+        self.assertFalse(self.converter_info.can_create_thumbnail(
+                mock.Mock(audio_only=False)))
+
     def test_get_target_size(self):
         self.assertEqual(self.run_get_target_size((1024, 768), (640, 480)),
                          (640, 480))
@@ -210,6 +626,70 @@ class FFmpegConverterInfoTest(ConverterInfoTestMixin, base.Test):
             'bitrate=1335.3kbits/s dup=16 drop=0',
             finished=True)
 
+    def test_process_status_line_progress_not_available(self):
+        self.assertStatusLineOutput(
+            'frame=    0 fps=0.0 q=0.0 size=       0kB time=N/A '
+            'bitrate=N/A speed=N/A')
+
+    def test_process_status_line_audio_finished(self):
+        self.assertStatusLineOutput(
+            'Lsize=    2697kB time=00:02:52.59 bitrate= 128.0kbits/s ',
+            finished=True)
+
+    def test_parse_progress_line(self):
+        stats = self.converter_info.parse_progress_line(
+            'frame= 3401 fps=344 q=4.0 size=    3584KiB time=00:01:53.36 '
+            'bitrate= 259.0kbits/s speed=11.5x    ')
+        self.assertEqual(stats, {'final': False,
+                                 'frame': 3401,
+                                 'fps': 344.0,
+                                 'q': 4.0,
+                                 'size': 3584 * 1024,
+                                 'time': 113.36,
+                                 'bitrate': 259.0,
+                                 'speed': 11.5})
+
+    def test_process_status_line_recorded_output(self):
+        for filename, finished in (('ffmpeg-webm.log', True),
+                                   ('ffmpeg-mp3.log', False)):
+            path = os.path.join(self.testdata_dir, filename)
+            with open(path, 'rb') as f:
+                lines = f.read().replace('\r', '\n').splitlines()
+            statuses = [
+                self.converter_info.process_status_line(self.video, line)
+                for line in lines]
+            statuses = [s for s in statuses if s is not None]
+            self.assertEqual(statuses[0], {'duration': 120.0})
+            progress = [s['progress'] for s in statuses if 'progress' in s]
+            self.assertTrue(progress)
+            self.assertEqual(progress, sorted(progress))
+            self.assertEqual(statuses[-1] == {'finished': True}, finished)
+            self.assertFalse(any('error' in s for s in statuses))
+
+    def test_process_progress_line(self):
+        process_progress_line = self.converter_info.process_progress_line
+        self.assertEqual(process_progress_line(self.video,
+                                               'out_time=00:01:53.360000'),
+                         {'progress': 113.36})
+        self.assertEqual(process_progress_line(self.video,
+                                               'out_time=N/A'), None)
+        self.assertEqual(process_progress_line(self.video,
+                                               'frame=3401'), None)
+        self.assertEqual(process_progress_line(self.video,
+                                               'progress=continue'), None)
+        self.assertEqual(process_progress_line(self.video, 'progress=end'),
+                         {'finished': True})
+
+    def test_uses_progress_pipe_unknown_version(self):
+        with mock.patch('mvc.settings.get_ffmpeg_executable_path') as path:
+            path.return_value = '/usr/bin/ffmpeg'
+            with mock.patch('mvc.settings.get_ffmpeg_version') as version:
+                version.side_effect = ValueError("can't get the version")
+                self.assertFalse(self.converter_info.uses_progress_pipe())
+                version.side_effect = None
+                version.return_value = (1, 2, 1)
+                self.assertTrue(self.converter_info.uses_progress_pipe())
+
     def test_process_status_line_error(self):
         line = ('Error while opening encoder for output stream #0:1 - '
                 'maybe incorrect parameters such as bit_rate, rate, width or '
@@ -234,7 +714,11 @@ class TestConverterDefinitions(base.Test):
     def setUp(self):
         base.Test.setUp(self)
         self.manager = converter.ConverterManager()
-        self.manager.startup()
+        with mock.patch('mvc.converter.get_converter_cache_path') as path:
+            path.return_value = None
+            self.manager.startup()
+        # check every converter, not just the ones loaded at startup
+        self.manager.load_all()
         self.input_path = os.path.join(self.testdata_dir, 'mp4-0.mp4')
         self.output_path = os.path.join(self.testdata_dir, 'output.mp4')
 
@@ -331,6 +815,24 @@ class TestConverterDefinitions(base.Test):
         })
         self.check_size('proresingest720p', 1080, 720)
 
+    def test_prores_bitrate(self):
+        # ProRes and PCM audio don't take a bitrate, but they're a lot
+        # bigger than the input
+        mock_video = mock.Mock(audio_only=False, duration=100, width=1920,
+                               height=1080, filename=self.input_path)
+        pcm_bitrate = 48000 * 2 * 16
+        for converter_id in ('proresingest1080p', 'proresingest720p'):
+            converter_obj = self.manager.converters[converter_id]
+            width, height = converter_obj.get_target_size(mock_video)
+            bitrate = converter_obj.get_bitrate(mock_video)
+            self.assertEqual(bitrate, converter.get_prores_bitrate(
+                    2, width, height) + pcm_bitrate)
+            self.assertTrue(
+                converter_obj.get_space_needed(mock_video) >=
+                bitrate * 100 / 8)
+        self.assertTrue(self.manager.converters[
+                'proresingest1080p'].get_bitrate(mock_video) > 140000000)
+
     def test_droidx2(self):
         self.check_ffmpeg_arguments('droidx2', {
             'ab': '160k',
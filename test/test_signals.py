@@ -0,0 +1,63 @@
+import gc
+
+from mvc import signals
+import base
+
+class Listener(object):
+    def __init__(self):
+        self.calls = []
+
+    def callback(self, emitter, *args):
+        self.calls.append(args)
+
+class SignalEmitterTest(base.Test):
+
+    def setUp(self):
+        base.Test.setUp(self)
+        self.emitter = signals.SignalEmitter('changed', 'other')
+
+    def test_emit(self):
+        listener = Listener()
+        self.emitter.connect('changed', listener.callback, 'extra')
+        self.emitter.emit('changed', 1)
+        self.emitter.emit('other', 2)
+        self.assertEqual(listener.calls, [(1, 'extra')])
+        self.assertRaises(KeyError, self.emitter.emit, 'missing')
+
+    def test_already_connected(self):
+        listener = Listener()
+        self.emitter.connect('changed', listener.callback)
+        self.assertRaises(ValueError, self.emitter.connect, 'changed',
+                          listener.callback)
+        self.assertRaises(ValueError, self.emitter.connect_weak, 'changed',
+                          listener.callback)
+        # other signals and other objects are fine
+        self.emitter.connect('other', listener.callback)
+        self.emitter.connect('changed', Listener().callback)
+        # so are functions that can't be hashed
+        calls = []
+        self.emitter.connect('changed', calls.append)
+        self.assertRaises(ValueError, self.emitter.connect, 'changed',
+                          calls.append)
+
+    def test_disconnect(self):
+        listener = Listener()
+        handle = self.emitter.connect('changed', listener.callback)
+        self.emitter.disconnect(handle)
+        self.emitter.emit('changed', 1)
+        self.assertEqual(listener.calls, [])
+        # we can connect again once disconnected
+        self.emitter.connect('changed', listener.callback)
+        self.emitter.emit('changed', 2)
+        self.assertEqual(listener.calls, [(2,)])
+
+    def test_weak(self):
+        listener = Listener()
+        self.emitter.connect_weak('changed', listener.callback)
+        self.emitter.emit('changed', 1)
+        self.assertEqual(listener.calls, [(1,)])
+        del listener
+        gc.collect()
+        self.emitter.emit('changed', 2)
+        self.assertEqual(self.emitter.get_callbacks('changed'), {})
+        self.assertEqual(self.emitter.signal_functions['changed'], {})
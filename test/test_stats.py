@@ -0,0 +1,166 @@
+import json
+import os
+import tempfile
+import urllib2
+
+from mvc import stats
+import base
+
+class FakeConversion(object):
+    def __init__(self, filename, output, duration=None):
+        self.video = FakeVideo(filename, duration)
+        self.output = output
+        self.job = None
+        self.status = 'initialized'
+        self.duration = None
+        self.progress = None
+
+class FakeVideo(object):
+    def __init__(self, filename, duration, probed=True):
+        self.filename = filename
+        self.duration = duration
+        self.probed = probed
+
+class FakeJob(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.output = None
+        self.status = 'initialized'
+        self.video = None
+
+class ConversionStatsTest(base.Test):
+
+    def setUp(self):
+        base.Test.setUp(self)
+        self.now = 100.0
+        self.stats = stats.ConversionStats(window=10.0,
+                                           clock=lambda: self.now)
+        self.input = tempfile.NamedTemporaryFile()
+        self.input.write('x' * 1000)
+        self.input.flush()
+        self.output = tempfile.NamedTemporaryFile()
+        self.output.write('x' * 300)
+        self.output.flush()
+
+    def make_conversion(self, duration=100.0):
+        return FakeConversion(self.input.name, self.output.name, duration)
+
+    def test_counts(self):
+        c1 = self.make_conversion()
+        c2 = self.make_conversion()
+        self.stats.update(c1)
+        self.stats.update(c2)
+        data = self.stats.to_dict()
+        self.assertEqual(data['total'], 2)
+        self.assertEqual(data['counts']['initialized'], 2)
+        self.assertEqual(data['total_seconds'], 200.0)
+        self.assertEqual(data['bytes_in'], 2000)
+        c1.status = 'finished'
+        self.stats.update(c1)
+        data = self.stats.to_dict()
+        self.assertEqual(data['counts']['initialized'], 1)
+        self.assertEqual(data['counts']['finished'], 1)
+        self.assertEqual(data['completed_seconds'], 100.0)
+        self.assertEqual(data['remaining_seconds'], 100.0)
+        self.assertEqual(data['bytes_out'], 300)
+        self.stats.remove(c1)
+        self.stats.remove(c2)
+        data = self.stats.to_dict()
+        self.assertEqual(data['total'], 0)
+        self.assertEqual(sum(data['counts'].values()), 0)
+        self.assertEqual(data['total_seconds'], 0)
+        self.assertEqual(data['bytes_in'], 0)
+        self.assertEqual(data['bytes_out'], 0)
+
+    def test_job(self):
+        job = FakeJob(self.input.name)
+        self.stats.update(job)
+        self.assertEqual(self.stats.to_dict()['total_seconds'], 0)
+        conversion = self.make_conversion()
+        conversion.job = job
+        conversion.status = 'converting'
+        self.stats.update(conversion)
+        data = self.stats.to_dict()
+        # the conversion updated the job's entry
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(data['counts']['converting'], 1)
+        self.assertEqual(data['total_seconds'], 100.0)
+        self.assertEqual(data['bytes_in'], 1000)
+
+    def test_realtime_factor(self):
+        conversion = self.make_conversion()
+        conversion.status = 'converting'
+        conversion.duration = 100.0
+        conversion.progress = 0.0
+        self.stats.update(conversion)
+        self.assertEqual(self.stats.to_dict()['eta'], None)
+        for i in range(5):
+            self.now += 1
+            conversion.progress += 2
+            self.stats.update(conversion)
+        data = self.stats.to_dict()
+        self.assertEqual(data['realtime_factor'], 2.0)
+        self.assertEqual(data['remaining_seconds'], 90.0)
+        self.assertEqual(data['eta'], 45.0)
+        # old samples fall out of the window
+        for i in range(20):
+            self.now += 1
+            conversion.progress += 1
+            self.stats.update(conversion)
+        self.assertEqual(self.stats.get_realtime_factor(), 1.0)
+        conversion.status = 'finished'
+        self.stats.update(conversion)
+        data = self.stats.to_dict()
+        self.assertEqual(data['realtime_factor'], None)
+        self.assertEqual(data['eta'], 0.0)
+        self.assertTrue(self.stats.all_done())
+
+    def test_waiting_jobs(self):
+        conversion = self.make_conversion()
+        conversion.status = 'converting'
+        conversion.duration = 100.0
+        conversion.progress = 0.0
+        self.stats.update(conversion)
+        job = FakeJob(self.input.name)
+        self.stats.update(job)
+        for i in range(5):
+            self.now += 1
+            conversion.progress += 10
+            self.stats.update(conversion)
+        # the waiting job could be any length, so we can't tell how long
+        # it'll all take
+        data = self.stats.to_dict()
+        self.assertEqual(data['unknown_durations'], 1)
+        self.assertEqual(data['remaining_seconds'], 50.0)
+        self.assertEqual(data['eta'], None)
+        # once it's been probed, it counts towards the totals
+        job.video = FakeVideo(self.input.name, 150.0, probed=False)
+        self.stats.update(job)
+        self.assertEqual(self.stats.to_dict()['eta'], None)
+        job.video.probed = True
+        self.stats.update(job)
+        data = self.stats.to_dict()
+        self.assertEqual(data['unknown_durations'], 0)
+        self.assertEqual(data['total_seconds'], 250.0)
+        self.assertEqual(data['remaining_seconds'], 200.0)
+        self.assertEqual(data['realtime_factor'], 10.0)
+        self.assertEqual(data['eta'], 20.0)
+        # removing the job takes it back out
+        self.stats.remove(job)
+        self.assertEqual(self.stats.to_dict()['eta'], 5.0)
+
+class StatsServerTest(base.Test):
+
+    def test_get(self):
+        conversion_stats = stats.ConversionStats()
+        conversion_stats.update(FakeJob(os.devnull))
+        server = stats.StatsServer(conversion_stats)
+        server.start()
+        try:
+            data = json.load(urllib2.urlopen(server.url))
+            self.assertEqual(data['total'], 1)
+            self.assertEqual(data['counts']['initialized'], 1)
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+                              server.url.replace('/stats', '/other'))
+        finally:
+            server.stop()
@@ -0,0 +1,113 @@
+import os
+import threading
+
+from mvc import supervisor
+import base
+import mock
+
+class Pipe(object):
+    """A pipe to watch, with a record of what the Supervisor did with it."""
+    def __init__(self):
+        read_fd, self.write_fd = os.pipe()
+        self.read_file = os.fdopen(read_fd, 'rb', 0)
+        self.lines = []
+        self.finished = threading.Event()
+
+    def line(self, line):
+        self.lines.append(line)
+
+    def finish(self):
+        self.finished.set()
+
+    def write(self, data):
+        os.write(self.write_fd, data)
+
+    def close(self):
+        os.close(self.write_fd)
+
+class SupervisorTest(base.Test):
+
+    def setUp(self):
+        base.Test.setUp(self)
+        if not supervisor.is_supported():
+            self.skipTest('select() does not work on pipes')
+        self.supervisor = supervisor.Supervisor()
+
+    def tearDown(self):
+        self.supervisor.close()
+        base.Test.tearDown(self)
+
+    def watch(self, pipe):
+        self.supervisor.watch(pipe.read_file, pipe.line, pipe.finish)
+
+    def test_lines(self):
+        pipe = Pipe()
+        self.watch(pipe)
+        pipe.write('one\ntwo\nthr')
+        pipe.write('ee\nfour')
+        pipe.close()
+        self.assertTrue(pipe.finished.wait(5))
+        self.assertEqual(pipe.lines, ['one', 'two', 'three', 'four'])
+
+    def test_bad_fd(self):
+        bad = Pipe()
+        self.watch(bad)
+        good = Pipe()
+        # close the pipe from under the supervisor.  It finds out when
+        # watching good wakes it up.
+        os.close(bad.read_file.fileno())
+        bad.close()
+        self.watch(good)
+        self.assertTrue(bad.finished.wait(5))
+        # the supervisor carries on with the other pipes
+        good.write('line\n')
+        good.close()
+        self.assertTrue(good.finished.wait(5))
+        self.assertEqual(good.lines, ['line'])
+
+    def test_read_error(self):
+        pipe = Pipe()
+        with mock.patch.object(self.supervisor, '_read') as read:
+            read.side_effect = ValueError('read error')
+            self.watch(pipe)
+            pipe.write('line\n')
+            self.assertTrue(pipe.finished.wait(5))
+        self.assertEqual(self.supervisor.watches, {})
+        pipe.close()
+        other = Pipe()
+        self.watch(other)
+        other.close()
+        self.assertTrue(other.finished.wait(5))
+
+    def test_thread_restarted(self):
+        with mock.patch.object(self.supervisor, '_run') as run:
+            run.side_effect = ValueError('supervisor error')
+            self.watch(Pipe())
+            thread = self.supervisor.thread
+            if thread is not None:
+                thread.join(5)
+        self.assertEqual(self.supervisor.thread, None)
+        pipe = Pipe()
+        self.watch(pipe)
+        self.assertNotEqual(self.supervisor.thread, None)
+        pipe.close()
+        self.assertTrue(pipe.finished.wait(5))
+
+    def test_close(self):
+        pipe = Pipe()
+        self.watch(pipe)
+        thread = self.supervisor.thread
+        wakeup_fds = (self.supervisor.wakeup_read,
+                      self.supervisor.wakeup_write)
+        self.supervisor.close()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.supervisor.thread, None)
+        # pipes still being watched are finished off
+        self.assertTrue(pipe.finished.wait(5))
+        self.assertTrue(pipe.read_file.closed)
+        for fd in wakeup_fds:
+            self.assertRaises(OSError, os.fstat, fd)
+        self.assertEqual(self.supervisor.finisher.threads, [])
+        self.assertRaises(ValueError, self.watch, Pipe())
+        # closing twice is fine
+        self.supervisor.close()
@@ -0,0 +1,175 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from mvc import thumbnails
+import base
+
+class ThumbnailCacheTest(base.Test):
+
+    def setUp(self):
+        base.Test.setUp(self)
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+        self.cache = thumbnails.ThumbnailCache(self.cache_dir, max_bytes=250)
+        self.source = self.make_source('source.ogv', 'video data')
+        self.created = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+        base.Test.tearDown(self)
+
+    def make_source(self, name, data):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def create_func(self, size=100):
+        def create(output):
+            self.created.append(output)
+            with open(output, 'wb') as f:
+                f.write('x' * size)
+            return output
+        return create
+
+    def create(self, width, height, source=None, size=100):
+        if source is None:
+            source = self.source
+        return self.cache.create(source, width, height, 0, '.png',
+                                 self.create_func(size))
+
+    def test_create(self):
+        path = self.create(90, 70)
+        self.assertEqual(os.path.dirname(path), self.cache_dir)
+        self.assertEqual(file(path).read(), 'x' * 100)
+        self.assertEqual(self.cache.get(self.source, 90, 70, 0), path)
+        self.assertEqual(self.create(90, 70), path)
+        self.assertEqual(len(self.created), 1)
+        # the temporary file got moved into place
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(path)])
+
+    def test_key(self):
+        path = self.create(90, 70)
+        self.assertEqual(self.cache.get(self.source, 90, 70, 10), None)
+        self.assertEqual(self.cache.get(self.source, 100, 70, 0), None)
+        self.assertEqual(self.cache.get(self.source, 90, 70, 0, '.jpg'), None)
+        self.assertNotEqual(self.create(100, 70), path)
+
+    def test_content_addressed(self):
+        path = self.create(90, 70)
+        copy = self.make_source('copy.ogv', 'video data')
+        self.assertEqual(self.cache.get(copy, 90, 70, 0), path)
+        other = self.make_source('other.ogv', 'other data')
+        self.assertEqual(self.cache.get(other, 90, 70, 0), None)
+
+    def test_source_changed(self):
+        self.create(90, 70)
+        self.make_source('source.ogv', 'new video data')
+        self.assertEqual(self.cache.get(self.source, 90, 70, 0), None)
+
+    def test_create_failed(self):
+        path = self.cache.create(self.source, 90, 70, 0, '.png',
+                                 lambda output: None)
+        self.assertEqual(path, None)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_lru(self):
+        path1 = self.create(1, 1)
+        path2 = self.create(2, 2)
+        # using path1 makes path2 the least recently used
+        self.cache.get(self.source, 1, 1, 0)
+        path3 = self.create(3, 3)
+        self.assertEqual(self.cache.total_bytes, 200)
+        self.assertTrue(os.path.exists(path1))
+        self.assertFalse(os.path.exists(path2))
+        self.assertTrue(os.path.exists(path3))
+        self.assertEqual(self.cache.get(self.source, 2, 2, 0), None)
+
+    def test_keep_newest(self):
+        path = self.create(1, 1, size=1000)
+        self.assertTrue(os.path.exists(path))
+
+    def test_persistent(self):
+        path1 = self.create(1, 1)
+        path2 = self.create(2, 2)
+        now = time.time()
+        os.utime(path1, (now, now))
+        os.utime(path2, (now - 10, now - 10))
+        cache = thumbnails.ThumbnailCache(self.cache_dir, max_bytes=250)
+        self.assertEqual(cache.get(self.source, 1, 1, 0), path1)
+        self.assertEqual(cache.total_bytes, 200)
+        cache.create(self.source, 3, 3, 0, '.png', self.create_func())
+        # path2 was least recently used, based on its mtime
+        self.assertFalse(os.path.exists(path2))
+        self.assertTrue(os.path.exists(path1))
+
+    def test_storyboard(self):
+        def create(image_path, index_path):
+            self.created.append(image_path)
+            with open(image_path, 'wb') as f:
+                f.write('image')
+            thumbnails.write_storyboard_index(index_path, 60, 160, 90, 6, 4)
+        self.cache.max_bytes = 10000
+        self.assertEqual(self.cache.get_storyboard(self.source, 160, 90, 6, 4),
+                         None)
+        image_path, index_path = self.cache.create_storyboard(
+            self.source, 160, 90, 6, 4, create)
+        self.assertEqual(os.path.dirname(image_path), self.cache_dir)
+        self.assertEqual(file(image_path).read(), 'image')
+        self.assertEqual(json.load(open(index_path))['rows'], 2)
+        self.assertEqual(self.cache.create_storyboard(
+                self.source, 160, 90, 6, 4, create), (image_path, index_path))
+        self.assertEqual(len(self.created), 1)
+        self.assertEqual(self.cache.get_storyboard(self.source, 160, 90, 6, 3),
+                         None)
+
+    def test_storyboard_failed(self):
+        def create(image_path, index_path):
+            with open(image_path, 'wb') as f:
+                f.write('image')
+        self.assertEqual(self.cache.create_storyboard(
+                self.source, 160, 90, 6, 4, create), None)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+class StoryboardTest(base.Test):
+
+    def test_layout(self):
+        self.assertEqual(thumbnails.get_storyboard_layout(120, 16, 4),
+                         (3.75, 7.5, 4))
+        self.assertEqual(thumbnails.get_storyboard_layout(60, 6, 4),
+                         (5.0, 10.0, 2))
+
+    def test_filter(self):
+        self.assertEqual(thumbnails.get_storyboard_filter(120, 160, 90, 16, 4),
+                         'fps=fps=2/15:round=up,scale=160:90,tile=4x4')
+        self.assertEqual(thumbnails.get_storyboard_filter(120, 160, 90, 16),
+                         'fps=fps=2/15:round=up,scale=160:90')
+        self.assertEqual(thumbnails.get_storyboard_filter(
+                120, 160, 90, 16, offset=3.75),
+                         'trim=start=3.750,setpts=PTS-STARTPTS,'
+                         'fps=fps=2/15:round=up,scale=160:90')
+
+    def test_rate(self):
+        self.assertEqual(thumbnails.get_storyboard_rate(60, 6), '1/10')
+        self.assertEqual(thumbnails.get_storyboard_rate(5.005, 16),
+                         '3200/1001')
+
+    def test_index(self):
+        index_file = tempfile.NamedTemporaryFile(suffix='.json')
+        thumbnails.write_storyboard_index(index_file.name, 60, 160, 90, 6, 4)
+        index = json.load(open(index_file.name))
+        self.assertEqual(index['columns'], 4)
+        self.assertEqual(index['rows'], 2)
+        self.assertEqual((index['width'], index['height']), (160, 90))
+        self.assertEqual(index['frames'], [
+                {'time': 5.0, 'x': 0, 'y': 0},
+                {'time': 15.0, 'x': 160, 'y': 0},
+                {'time': 25.0, 'x': 320, 'y': 0},
+                {'time': 35.0, 'x': 480, 'y': 0},
+                {'time': 45.0, 'x': 0, 'y': 90},
+                {'time': 55.0, 'x': 160, 'y': 90},
+                ])
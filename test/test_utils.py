@@ -1,8 +1,15 @@
+import errno
+import os.path
+import Queue
+import shutil
+import stat
+import tempfile
 from StringIO import StringIO
 
 from mvc import utils
 
 import base
+import mock
 
 class UtilsTest(base.Test):
 
@@ -46,3 +53,231 @@ line5"""
         expected = ['line1', 'line2', 'line3', 'line4', 'line5']
         self.assertEqual(list(utils.line_reader(StringIO(lines))), expected)
 
+
+    def test_line_buffer(self):
+        buf = utils.LineBuffer(head_size=2, tail_size=3)
+        for i in range(10):
+            buf.append('line%i' % i)
+        self.assertEqual(list(buf),
+                         ['line0', 'line1', 'line7', 'line8', 'line9'])
+        self.assertEqual(len(buf), 5)
+        self.assertEqual(buf.dropped, 5)
+        self.assertEqual(buf.get_text(),
+                         'line0\nline1\n[... 5 lines omitted ...]\n'
+                         'line7\nline8\nline9')
+
+    def test_line_buffer_spill(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            spill_path = os.path.join(temp_dir, 'output.log.gz')
+            buf = utils.LineBuffer(head_size=2, tail_size=3,
+                                   spill_path=spill_path)
+            for i in range(10):
+                buf.append('line%i' % i)
+            buf.close()
+            self.assertEqual(len(buf), 5)
+            self.assertEqual(buf.get_text(),
+                             ''.join('line%i\n' % i for i in range(10)))
+            # lines after close() don't reopen (and truncate) the log
+            buf.append('line10')
+            self.assertEqual(buf.get_text(),
+                             ''.join('line%i\n' % i for i in range(10)))
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def test_line_splitter(self):
+        splitter = utils.LineSplitter()
+        self.assertEqual(splitter.feed('line1\nli'), ['line1'])
+        self.assertEqual(splitter.feed('ne2\rline3\r\n\nline4'),
+                         ['line2', 'line3'])
+        self.assertEqual(splitter.flush(), ['line4'])
+        self.assertEqual(splitter.flush(), [])
+
+    def test_worker_pool(self):
+        pool = utils.WorkerPool(2)
+        results = Queue.Queue()
+        for i in range(10):
+            pool.add_task(results.put, i)
+        self.assertEqual(sorted(results.get(timeout=1) for i in range(10)),
+                         range(10))
+        self.assertTrue(len(pool.threads) <= 2)
+
+    def test_worker_pool_shutdown(self):
+        pool = utils.WorkerPool(2)
+        results = []
+        for i in range(5):
+            pool.add_task(results.append, i)
+        threads = list(pool.threads)
+        pool.shutdown()
+        # the tasks that were already added still run
+        self.assertEqual(sorted(results), range(5))
+        self.assertEqual(pool.threads, [])
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+
+
+class LengthCache(utils.Cache):
+    # caches len() of strings, weighted by the length
+    def __init__(self, size, max_weight=None):
+        utils.Cache.__init__(self, size, max_weight)
+        self.created = []
+
+    def create_new_value(self, key, invalidator=None):
+        self.created.append(key)
+        return len(key)
+
+    def get_weight(self, key, value):
+        return value
+
+
+class CacheTest(base.Test):
+
+    def test_get(self):
+        cache = LengthCache(10)
+        self.assertEqual(cache.get('abc'), 3)
+        self.assertEqual(cache.get('abc'), 3)
+        self.assertEqual(cache.created, ['abc'])
+        stats = cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_lru(self):
+        cache = LengthCache(2)
+        cache.get('a')
+        cache.get('b')
+        # using 'a' makes 'b' the least recently used
+        cache.get('a')
+        cache.get('c')
+        self.assertEqual(sorted(cache.keys()), ['a', 'c'])
+        self.assertEqual(cache.get_stats()['evictions'], 1)
+
+    def test_weight(self):
+        cache = LengthCache(10, max_weight=5)
+        cache.get('aa')
+        cache.get('bbb')
+        self.assertEqual(cache.total_weight, 5)
+        cache.get('c')
+        self.assertEqual(sorted(cache.keys()), ['bbb', 'c'])
+        self.assertEqual(cache.total_weight, 4)
+        # the newest entry stays, even if it's too heavy on its own
+        cache.get('dddddd')
+        self.assertEqual(list(cache.keys()), ['dddddd'])
+        cache.remove('dddddd')
+        self.assertEqual(cache.total_weight, 0)
+
+    def test_invalidator(self):
+        cache = LengthCache(2)
+        invalid = set()
+        invalidator = lambda key: key in invalid
+        cache.get('a', invalidator)
+        cache.get('b', invalidator)
+        cache.get('c', invalidator)
+        # invalidators go with their evicted entries
+        self.assertEqual(len(cache.entries), 2)
+        invalid.add('c')
+        cache.get('c', invalidator)
+        self.assertEqual(cache.created, ['a', 'b', 'c', 'c'])
+        self.assertEqual(cache.total_weight, 2)
+
+    def test_thread_safe(self):
+        class SquareCache(utils.ThreadSafeCache):
+            def create_new_value(self, key, invalidator=None):
+                return key * key
+        cache = SquareCache(50)
+        pool = utils.WorkerPool(4)
+        results = Queue.Queue()
+        for i in range(200):
+            pool.add_task(lambda i: results.put((i, cache.get(i % 80))), i)
+        for _ in range(200):
+            i, square = results.get(timeout=5)
+            self.assertEqual(square, (i % 80) ** 2)
+        self.assertEqual(len(cache), 50)
+
+
+class IndexedQueueTest(base.Test):
+
+    def test_queue(self):
+        queue = utils.IndexedQueue(['a', 'b', 'c', 'd'])
+        self.assertEqual(queue.popleft(), 'a')
+        queue.remove('c')
+        self.assertRaises(ValueError, queue.remove, 'c')
+        self.assertRaises(ValueError, queue.append, 'b')
+        queue.append('e')
+        self.assertEqual(list(queue), ['b', 'd', 'e'])
+        self.assertTrue('d' in queue)
+        self.assertEqual(len(queue), 3)
+
+    def test_remove_many(self):
+        queue = utils.IndexedQueue(range(10))
+        self.assertEqual(queue.remove_many([8, 2, 11, 2, 5]), [8, 2, 5])
+        self.assertEqual(list(queue), [0, 1, 3, 4, 6, 7, 9])
+        self.assertEqual(queue.remove_many(range(10)), [0, 1, 3, 4, 6, 7, 9])
+        self.assertRaises(IndexError, queue.popleft)
+
+class InstallFileTest(base.Test):
+
+    def setUp(self):
+        base.Test.setUp(self)
+        self.temp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.temp_dir, 'source')
+        self.destination = os.path.join(self.temp_dir, 'destination')
+        with open(self.source, 'wb') as f:
+            f.write('new data')
+        with open(self.destination, 'wb') as f:
+            f.write('old data')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+        base.Test.tearDown(self)
+
+    def test_rename(self):
+        utils.install_file(self.source, self.destination)
+        self.assertEqual(open(self.destination).read(), 'new data')
+        self.assertEqual(os.listdir(self.temp_dir), ['destination'])
+
+    def test_other_filesystem(self):
+        rename = os.rename
+        def cross_device_rename(source, destination):
+            if source == self.source:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            rename(source, destination)
+        with mock.patch('os.rename', cross_device_rename):
+            utils.install_file(self.source, self.destination)
+        self.assertEqual(open(self.destination).read(), 'new data')
+        self.assertEqual(os.listdir(self.temp_dir), ['destination'])
+
+    def test_write_func(self):
+        def write_upper(source, outfile):
+            outfile.write(open(source).read().upper())
+        utils.install_file(self.source, self.destination, write_upper)
+        self.assertEqual(open(self.destination).read(), 'NEW DATA')
+        self.assertEqual(os.listdir(self.temp_dir), ['destination'])
+
+    def test_permissions(self):
+        os.chmod(self.source, 0644)
+        def write_upper(source, outfile):
+            outfile.write(open(source).read().upper())
+        utils.install_file(self.source, self.destination, write_upper)
+        self.assertEqual(stat.S_IMODE(os.stat(self.destination).st_mode),
+                         0644)
+
+    def test_permissions_other_filesystem(self):
+        os.chmod(self.source, 0644)
+        rename = os.rename
+        def cross_device_rename(source, destination):
+            if source == self.source:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            rename(source, destination)
+        with mock.patch('os.rename', cross_device_rename):
+            utils.install_file(self.source, self.destination)
+        self.assertEqual(stat.S_IMODE(os.stat(self.destination).st_mode),
+                         0644)
+
+    def test_error(self):
+        def write_partial(source, outfile):
+            outfile.write('partial')
+            raise IOError('disk full')
+        self.assertRaises(IOError, utils.install_file, self.source,
+                          self.destination, write_partial)
+        # the old file is untouched, and the partial copy is gone
+        self.assertEqual(open(self.destination).read(), 'old data')
+        self.assertEqual(sorted(os.listdir(self.temp_dir)),
+                         ['destination', 'source'])
@@ -1,10 +1,12 @@
 import os, os.path
+import shutil
 import tempfile
 import threading
 import unittest
 
 import mock
 
+from mvc import thumbnails
 from mvc import video
 import base
 
@@ -149,13 +151,13 @@ class GetThumbnailTest(base.Test):
     def generate_thumbnail(self, width, height):
         completion = mock.Mock()
         with mock.patch('mvc.video.idle_add') as mock_idle_add:
-            with mock.patch('threading.Thread') as mock_thread:
+            with mock.patch('mvc.video.thumbnail_pool') as mock_pool:
                 video.get_thumbnail(self.video_path, width, height,
                                     self.temp_path.name, completion,
                                     skip=0)
-                # get_thumbnail() creates a thread to create the thumbnail.
-                # Run the function for that thread now.
-                mock_thread.call_args[1]['target']()
+                # get_thumbnail() queues a task to create the thumbnail.
+                # Run it now.
+                mock_pool.add_task.call_args[0][0]()
                 self.assertEquals(mock_idle_add.call_count, 1)
                 # At the end of the thread it uses add_idle() to call the
                 # completion function.  Run that now.
@@ -186,6 +188,46 @@ class GetThumbnailTest(base.Test):
         self.assertEqual(thumbnail.width, 100)
         self.assertEqual(thumbnail.height, 100)
 
+    def test_multiple_thumbnails(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        outputs = [os.path.join(temp_dir, '%i.png' % i) for i in range(3)]
+        specs = [(100, 100, 0, outputs[0]),
+                 (200, -1, 0, outputs[1]),
+                 (-1, 152, 1, outputs[2])]
+        check_output = video.execute.check_output
+        with mock.patch('mvc.execute.check_output') as mock_check_output:
+            mock_check_output.side_effect = check_output
+            paths = video.get_thumbnails_synchronous(self.video_path, specs)
+            # everything is created with one ffmpeg run
+            self.assertEqual(mock_check_output.call_count, 1)
+        self.assertEqual(paths, outputs)
+        sizes = [(thumbnail.width, thumbnail.height)
+                 for thumbnail in map(video.VideoFile, paths)]
+        self.assertEqual(sizes, [(100, 100), (200, 152), (200, 152)])
+
+    def test_multiple_thumbnails_command(self):
+        specs = [(100, 100, 0, 'a.png'),
+                 (200, -1, 0, 'b.png'),
+                 (-1, 152, 5, 'c.png')]
+        with mock.patch('mvc.execute.check_output') as check_output:
+            video.get_thumbnails_synchronous(self.video_path, specs)
+        commandline = check_output.call_args[0][0]
+        self.assertEqual(commandline[1:5], ['-ss', '0', '-i',
+                                            self.video_path])
+        self.assertEqual(commandline[5:9], ['-ss', '5', '-i',
+                                            self.video_path])
+        filter_index = commandline.index('-filter_complex')
+        self.assertEqual(commandline[filter_index + 1],
+                         '[0:v]split=2[s0_0][s0_1];'
+                         '[s0_0]scale=100:100[t0];'
+                         '[s0_1]scale=200:-1[t1];'
+                         '[1:v]scale=-1:152[t2]')
+        self.assertEqual(commandline[filter_index + 2:], [
+            '-map', '[t0]', '-vframes', '1', 'a.png',
+            '-map', '[t1]', '-vframes', '1', 'b.png',
+            '-map', '[t2]', '-vframes', '1', 'c.png'])
+
 class VideoFileTest(base.Test):
 
     def setUp(self):
@@ -194,25 +236,31 @@ class VideoFileTest(base.Test):
                                        'theora.ogv')
         self.video = video.VideoFile(self.video_path)
         self.video.thumbnails = {}
+        self.cache_dir = tempfile.mkdtemp()
+        thumbnails.set_cache(thumbnails.ThumbnailCache(self.cache_dir))
+
+    def tearDown(self):
+        thumbnails.set_cache(None)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        base.Test.tearDown(self)
 
     def get_thumbnail_from_video(self, **kwargs):
         """Run Video.get_thumbnail()
 
-        This method uses mock to intercept the threading and idle_add calls and
-        just runs the code in the current thread
+        This method uses mock to intercept the thread pool and idle_add calls
+        and just runs the code in the current thread
         """
         completion = mock.Mock()
         with mock.patch('mvc.video.idle_add') as mock_idle_add:
-            with mock.patch('threading.Thread') as mock_thread:
+            with mock.patch('mvc.video.thumbnail_pool') as mock_pool:
                 initial_rv = self.video.get_thumbnail(completion, **kwargs)
                 if initial_rv is not None:
                     # we already had a thumbnail and didn't have to do
                     # anything synchrously
                     return video.VideoFile(initial_rv)
                 # We don't already have a thumbnail, so get_thumbnail()
-                # created a thread to create it.  Run the function for that
-                # thread.
-                mock_thread.call_args[1]['target']()
+                # queued a task to create it.  Run it.
+                mock_pool.add_task.call_args[0][0]()
                 self.assertEquals(mock_idle_add.call_count, 1)
                 # At the end of the thread it uses add_idle() to call the
                 # completion function.  Run that now.
@@ -256,3 +304,193 @@ class VideoFileTest(base.Test):
             pass
         self.assertEqual(audio.get_thumbnail(complete), None)
         self.assertEqual(audio.get_thumbnail(complete, 90, 70), None)
+
+    def test_get_thumbnail_pending(self):
+        completion = mock.Mock()
+        with mock.patch('mvc.video.thumbnail_pool') as mock_pool:
+            self.assertEqual(self.video.get_thumbnail(completion, 90, 70),
+                             None)
+            self.assertEqual(self.video.get_thumbnail(completion, 90, 70),
+                             None)
+        # we only start creating the thumbnail once
+        self.assertEqual(mock_pool.add_task.call_count, 1)
+
+    def test_get_thumbnail_error(self):
+        completion = mock.Mock()
+        with mock.patch('mvc.video.thumbnail_pool') as mock_pool:
+            with mock.patch('mvc.video.idle_add') as mock_idle_add:
+                with mock.patch('mvc.video.get_cached_thumbnails_synchronous'
+                                ) as mock_create:
+                    mock_create.side_effect = OSError('gone')
+                    self.video.get_thumbnail(completion, 90, 70)
+                    mock_pool.add_task.call_args[0][0]()
+                    # the completion still runs, so the thumbnail isn't left
+                    # pending
+                    mock_idle_add.call_args[0][0]()
+        self.assertEqual(completion.call_count, 1)
+        self.assertEqual(self.video.pending_thumbnails, set())
+        self.assertEqual(self.video.get_thumbnail(completion, 90, 70), None)
+
+    def test_get_thumbnail_missing_source(self):
+        vf = video.VideoFile('/does/not/exist.ogv', lazy=True)
+        vf.video_codec = 'theora'
+        vf.duration = 5.0
+        completion = mock.Mock()
+        with mock.patch('mvc.video.thumbnail_pool') as mock_pool:
+            with mock.patch('mvc.video.idle_add') as mock_idle_add:
+                # the file is only looked at by the worker, so this doesn't
+                # raise
+                self.assertEqual(vf.get_thumbnail(completion, 90, 70), None)
+                mock_pool.add_task.call_args[0][0]()
+                mock_idle_add.call_args[0][0]()
+                self.assertEqual(completion.call_count, 1)
+                # we don't try again straight away...
+                self.assertEqual(vf.get_thumbnail(completion, 90, 70), None)
+                self.assertEqual(mock_pool.add_task.call_count, 1)
+                # ...but we do once the retry delay has passed
+                with mock.patch('time.time') as mock_time:
+                    mock_time.return_value = (
+                        vf.failed_thumbnails[(90, 70, '.png')] +
+                        vf.THUMBNAIL_RETRY_DELAY)
+                    self.assertEqual(vf.get_thumbnail(completion, 90, 70),
+                                     None)
+                self.assertEqual(mock_pool.add_task.call_count, 2)
+
+    def test_get_thumbnail_extra(self):
+        thumbnail = self.get_thumbnail_from_video(width=100, height=100,
+                                                  extra=[(200, -1, 0)])
+        self.assertEqual(thumbnail.width, 100)
+        path = thumbnails.get_cache().get(self.video_path, 200, -1, 0)
+        self.assertNotEquals(path, None)
+        self.assertEqual(video.VideoFile(path).width, 200)
+
+    def test_parse_unknown_keys(self):
+        info = {'container': 'ogg', 'duration': 5.0, 'unknown_key': 'value'}
+        with mock.patch('mvc.video.get_media_info') as get_media_info:
+            get_media_info.return_value = info
+            vf = video.VideoFile(self.video_path)
+        self.assertEqual(vf.container, 'ogg')
+        self.assertEqual(vf.duration, 5.0)
+        self.assertEqual(vf.video_codec, None)
+        self.assertFalse(hasattr(vf, 'unknown_key'))
+
+class LazyProbeTest(base.Test):
+    def setUp(self):
+        base.Test.setUp(self)
+        self.info = {'container': 'ogg', 'duration': 5.0,
+                     'video_codec': 'theora', 'width': 320, 'height': 240}
+        patcher = mock.patch('mvc.video.get_media_info')
+        self.get_media_info = patcher.start()
+        self.get_media_info.side_effect = self.fake_get_media_info
+        self.addCleanup(patcher.stop)
+
+    def fake_get_media_info(self, filename):
+        if 'error' in filename:
+            raise ValueError('cannot parse %r' % filename)
+        return self.info
+
+    def test_eager(self):
+        vf = video.VideoFile('/fake/video.ogv')
+        self.assertTrue(vf.probed)
+        self.assertEqual(self.get_media_info.call_count, 1)
+
+    def test_lazy(self):
+        vf = video.VideoFile('/fake/video.ogv', lazy=True)
+        self.assertFalse(vf.probed)
+        self.assertEqual(vf.filename, '/fake/video.ogv')
+        self.assertEqual(self.get_media_info.call_count, 0)
+        self.assertEqual(vf.width, 320)
+        self.assertTrue(vf.probed)
+        self.assertEqual(vf.duration, 5.0)
+        self.assertEqual(vf.audio_codec, None)
+        self.assertFalse(vf.audio_only)
+        self.assertEqual(self.get_media_info.call_count, 1)
+
+    def test_lazy_error(self):
+        vf = video.VideoFile('/fake/error.ogv', lazy=True)
+        self.assertRaises(ValueError, getattr, vf, 'duration')
+        self.assertFalse(vf.probed)
+        self.assertRaises(AttributeError, getattr, vf, 'unknown_key')
+
+    def test_probe_videos(self):
+        videos = [video.VideoFile('/fake/video-%i.ogv' % i, lazy=True)
+                  for i in range(5)]
+        videos.append(video.VideoFile('/fake/error.ogv', lazy=True))
+        errors = video.probe_videos(videos, threads=3)
+        self.assertEqual(errors.keys(), [videos[-1]])
+        self.assertTrue(isinstance(errors[videos[-1]], ValueError))
+        self.assertEqual(self.get_media_info.call_count, 6)
+        for vf in videos[:-1]:
+            self.assertTrue(vf.probed)
+            self.assertEqual(vf.container, 'ogg')
+        # already probed files are skipped
+        video.probe_videos(videos[:-1])
+        self.assertEqual(self.get_media_info.call_count, 6)
+
+    def test_prefetch_probes(self):
+        videos = [video.VideoFile('/fake/video.ogv', lazy=True),
+                  video.VideoFile('/fake/error.ogv', lazy=True)]
+        with mock.patch('mvc.video.probe_pool') as probe_pool:
+            video.prefetch_probes(videos)
+            self.assertEqual(probe_pool.add_task.call_count, 2)
+            for call in probe_pool.add_task.call_args_list:
+                func, vf = call[0]
+                func(vf)
+        self.assertTrue(videos[0].probed)
+        self.assertEqual(videos[0].width, 320)
+        self.assertFalse(videos[1].probed)
+
+class VideoFileRegistryTest(base.Test):
+    def setUp(self):
+        base.Test.setUp(self)
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'video.ogv')
+        with open(self.path, 'wb') as f:
+            f.write('video data')
+        self.registry = video.VideoFileRegistry(keep=1)
+        patcher = mock.patch('mvc.video.get_media_info')
+        self.get_media_info = patcher.start()
+        self.get_media_info.return_value = {'container': 'ogg'}
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+        base.Test.tearDown(self)
+
+    def test_shared(self):
+        vf = self.registry.get(self.path)
+        link = os.path.join(self.temp_dir, 'link.ogv')
+        os.symlink(self.path, link)
+        self.assertTrue(self.registry.get(link) is vf)
+        self.assertEqual(self.get_media_info.call_count, 1)
+
+    def test_lazy(self):
+        vf = self.registry.get(self.path, lazy=True)
+        self.assertEqual(self.get_media_info.call_count, 0)
+        self.assertTrue(self.registry.get(self.path) is vf)
+        self.assertTrue(vf.probed)
+        self.assertEqual(self.get_media_info.call_count, 1)
+
+    def test_changed(self):
+        vf = self.registry.get(self.path)
+        with open(self.path, 'ab') as f:
+            f.write('more data')
+        self.assertFalse(self.registry.get(self.path) is vf)
+
+    def test_invalidate(self):
+        vf = self.registry.get(self.path)
+        self.registry.invalidate(self.path)
+        self.assertFalse(self.registry.get(self.path) is vf)
+        vf = self.registry.get(self.path)
+        self.registry.invalidate()
+        self.assertFalse(self.registry.get(self.path) is vf)
+
+    def test_weak(self):
+        other = os.path.join(self.temp_dir, 'other.ogv')
+        with open(other, 'wb') as f:
+            f.write('other data')
+        self.registry.get(self.path)
+        # keep=1, so getting another file drops the last strong reference
+        self.registry.get(other)
+        self.assertEqual(len(self.registry.videos), 1)
+        self.assertEqual(self.get_media_info.call_count, 2)
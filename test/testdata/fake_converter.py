@@ -4,6 +4,10 @@ import os
 import json
 
 filename, output = sys.argv[1:3]
+if sys.argv[3:4] == ['--thumbnail']:
+    thumbnail = sys.argv[4]
+else:
+    thumbnail = None
 if 'error' in filename:
     print json.dumps({'finished': True, 'error': 'test error'})
     sys.exit(1)
@@ -16,6 +20,9 @@ if os.path.exists(output):
 
 time.sleep(0.5)
 RANGE = 5
+if 'stall' in filename:
+    print json.dumps({'duration': RANGE, 'progress': 0, 'eta': RANGE})
+    time.sleep(30)
 for i in range(RANGE):
     print json.dumps({
             'filename': filename,
@@ -28,4 +35,7 @@ for i in range(RANGE):
 
 with file(output, 'w') as f:
     f.write('blank')
+if thumbnail is not None:
+    with file(thumbnail, 'w') as f:
+        f.write('thumbnail')
 print json.dumps({'finished': True})
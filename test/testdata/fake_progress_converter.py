@@ -0,0 +1,21 @@
+import time
+import sys
+import os
+
+filename, output = sys.argv[1:3]
+if 'error' in filename:
+    sys.stderr.write('Error while opening encoder\n')
+    sys.exit(1)
+
+time.sleep(0.5)
+RANGE = 5
+for i in range(RANGE):
+    print 'frame=%i' % (i * 25)
+    print 'out_time=00:00:00.%i00000' % i
+    print 'progress=continue'
+    sys.stderr.write('this line is only in the log\n')
+    time.sleep(0.1)
+
+with file(output, 'w') as f:
+    f.write('blank')
+print 'progress=end'